@@ -0,0 +1 @@
+""" Benchmarks for disclaimr, that run without an MTA or network """
@@ -0,0 +1,62 @@
+""" Read mail corpora for the benchmarks """
+import email.parser
+import mailbox
+import os
+
+CHUNK_SIZE = 65535
+
+""" The size of the body chunks sent by Postfix and Sendmail """
+
+
+def read_corpus(paths):
+
+    """ Read the mails of a corpus
+
+    :param paths: Paths of .eml files, mbox files or directories holding them
+    :return: A generator of (name, mail text) tuples
+    """
+
+    for path in paths:
+
+        if os.path.isdir(path):
+
+            for name in sorted(os.listdir(path)):
+
+                if name.startswith("."):
+
+                    continue
+
+                for mail in read_corpus([os.path.join(path, name)]):
+
+                    yield mail
+
+            continue
+
+        with open(path, "rb") as mail_file:
+
+            is_mbox = mail_file.read(5) == "From "
+
+        if not is_mbox:
+
+            with open(path, "rb") as mail_file:
+
+                yield (path, mail_file.read())
+
+            continue
+
+        for index, message in enumerate(mailbox.mbox(path, create=False)):
+
+            yield ("%s:%d" % (path, index), message.as_string())
+
+
+def split_mail(text):
+
+    """ Split a mail into the headers and the body like the MTA sends them
+
+    :param text: The mail text
+    :return: A tuple of the header list of (key, value) tuples and the body
+    """
+
+    message = email.parser.HeaderParser().parsestr(text)
+
+    return message.items(), message.get_payload()
@@ -0,0 +1,824 @@
+""" A load generator speaking the milter protocol
+
+Replays a corpus of mails to a running milter like Postfix or Sendmail do
+and measures the latency of every milter phase. This benchmarks the fork,
+threads and async modes end to end without an MTA:
+
+    python disclaimr.py -s inet:127.0.0.1:5000 --mode async
+    python -m benchmarks.loadgen -s inet:127.0.0.1:5000 -c 16 <corpus>...
+
+A corpus is a .eml file, an mbox file or a directory containing them.
+
+Phases the milter doesn't reply to (see the SMFIP_NR_* protocol options) are
+measured until their command is sent. The milter's processing time of them
+is part of the next phase with a reply.
+"""
+import argparse
+import email.utils
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+
+import libmilter as lm
+
+from benchmarks.corpus import CHUNK_SIZE, read_corpus, split_mail
+from benchmarks.stats import print_stages, summarize
+
+PHASES = ("negotiate", "connect", "mail_from", "rcpt", "header", "eoh",
+          "body", "eob")
+
+""" The measured phases in the order of the milter protocol """
+
+OFFERED_PROTOCOL = lm.SMFIP_ALLPROTOS & ~lm.SMFIP_HDR_LEADSPC
+
+""" The protocol options offered to the milter. Like Postfix, all steps may
+be skipped or left without a reply. """
+
+FINAL_REPLIES = (
+    lm.SMFIR_ACCEPT,
+    lm.SMFIR_DISCARD,
+    lm.SMFIR_REJECT,
+    lm.SMFIR_TEMPFAIL,
+    lm.SMFIR_REPLYCODE
+)
+
+""" Replies, that end the processing of a mail """
+
+MODIFICATIONS = (
+    lm.SMFIR_REPLBODY,
+    lm.SMFIR_ADDHEADER,
+    lm.SMFIR_CHGHEADER,
+    lm.SMFIR_INSHEADER
+)
+
+""" Modifications of a mail at the end of the body """
+
+REPLY_NAMES = {
+    lm.SMFIR_ACCEPT: "accept",
+    lm.SMFIR_CONTINUE: "continue",
+    lm.SMFIR_DISCARD: "discard",
+    lm.SMFIR_REJECT: "reject",
+    lm.SMFIR_TEMPFAIL: "tempfail",
+    lm.SMFIR_REPLYCODE: "replycode"
+}
+
+""" Names of the final replies in the results """
+
+
+class MilterError(Exception):
+
+    """ The milter closed the connection or broke the protocol
+    """
+
+    pass
+
+
+def open_socket(address, timeout=60):
+
+    """ Connect to a milter
+
+    :param address: The milter socket in the form inet:<ip>:<port> or a path
+        to a unix socket
+    :param timeout: The socket timeout in seconds
+    :return: The connected socket
+    """
+
+    if address.lower().startswith("inet:"):
+
+        ip = address[5:address.rfind(":")]
+        port = int(address[address.rfind(":") + 1:])
+
+        sock = socket.create_connection((ip, port), timeout)
+
+        # Like an MTA, don't delay the small milter packets
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return sock
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(address)
+
+    return sock
+
+
+class MilterClient(object):
+
+    """ The MTA side of a milter connection
+    """
+
+    def __init__(self, sock):
+
+        """ Use a connected socket
+
+        :param sock: The socket connected to the milter
+        :return: The client
+        """
+
+        self.sock = sock
+
+        self.protocol = 0
+
+        """ The protocol options negotiated with the milter """
+
+    def send(self, command, data=""):
+
+        """ Send a command
+
+        :param command: The command character
+        :param data: The data of the command
+        """
+
+        self.sock.sendall(struct.pack("!I", len(data) + 1) + command + data)
+
+    def read(self, size):
+
+        """ Read an exact number of bytes
+
+        :param size: The number of bytes
+        :return: The bytes
+        """
+
+        data = ""
+
+        while len(data) < size:
+
+            chunk = self.sock.recv(size - len(data))
+
+            if not chunk:
+
+                raise MilterError("The milter closed the connection")
+
+            data += chunk
+
+        return data
+
+    def receive(self):
+
+        """ Receive a reply, skipping progress replies
+
+        :return: A tuple of the reply character and its data
+        """
+
+        while True:
+
+            length = struct.unpack("!I", self.read(4))[0]
+
+            data = self.read(length)
+
+            if data[0] != lm.SMFIR_PROGRESS:
+
+                return data[0], data[1:]
+
+    def request(self, command, data, no_reply):
+
+        """ Send a command and receive its reply, if the milter sends one
+
+        :param command: The command character
+        :param data: The data of the command
+        :param no_reply: The SMFIP_NR_* option of the command
+        :return: The reply character or None, if there is no reply
+        """
+
+        self.send(command, data)
+
+        if self.protocol & no_reply:
+
+            return None
+
+        return self.receive()[0]
+
+    def skips(self, option):
+
+        """ Check, whether the milter doesn't want a step
+
+        :param option: The SMFIP_NO* option of the step
+        :return: True, if the step is skipped
+        """
+
+        return self.protocol & option != 0
+
+    def macros(self, command, macros):
+
+        """ Define macros for the next command
+
+        :param command: The command character
+        :param macros: A dictionary of macro names and values
+        """
+
+        self.send(lm.SMFIC_MACRO, command + "".join(
+            "%s\0%s\0" % (name, value) for name, value in macros.items()
+        ))
+
+    def negotiate(self):
+
+        """ Negotiate the protocol options
+        """
+
+        self.send(lm.SMFIC_OPTNEG, struct.pack(
+            "!III", 6, lm.SMFIF_ALLOPTS, OFFERED_PROTOCOL
+        ))
+
+        reply, data = self.receive()
+
+        if reply != lm.SMFIC_OPTNEG:
+
+            raise MilterError("Unexpected option negotiation reply %r" % reply)
+
+        self.protocol = struct.unpack("!III", data[:12])[2]
+
+    def connect(self, hostname, ip, port=25):
+
+        """ Send the connection information
+
+        :param hostname: The hostname of the client
+        :param ip: The IP address of the client
+        :param port: The port of the client
+        :return: The reply character or None
+        """
+
+        if self.skips(lm.SMFIP_NOCONNECT):
+
+            return None
+
+        family = "6" if ":" in ip else "4"
+
+        return self.request(
+            lm.SMFIC_CONNECT,
+            "%s\0%s%s%s\0" % (hostname, family, struct.pack("!H", port), ip),
+            lm.SMFIP_NR_CONN
+        )
+
+    def end_of_body(self):
+
+        """ Send the end of the body and receive the modifications
+
+        :return: A tuple of the final reply character and the list of
+            modification characters
+        """
+
+        self.send(lm.SMFIC_BODYEOB)
+
+        modifications = []
+
+        while True:
+
+            reply, data = self.receive()
+
+            if reply in MODIFICATIONS:
+
+                modifications.append(reply)
+
+                continue
+
+            return reply, modifications
+
+    def close(self):
+
+        """ Quit the connection
+        """
+
+        try:
+
+            self.send(lm.SMFIC_QUIT)
+
+        except socket.error:
+
+            pass
+
+        self.sock.close()
+
+
+def send_mail(client, text, envelope, timings, queue_id, chunk_size=CHUNK_SIZE):
+
+    """ Send a mail to the milter like an MTA
+
+    :param client: A negotiated and connected MilterClient
+    :param text: The mail text
+    :param envelope: A dictionary with the "sender" and "recipient" of the
+        mail. An empty sender or recipient is taken from the headers.
+    :param timings: A dictionary of phase names and lists, the durations in
+        seconds are appended to
+    :param queue_id: The queue id of the mail
+    :param chunk_size: The size of the body chunks
+    :return: The result of the mail: "modified" or the final reply
+        character
+    """
+
+    headers, body = split_mail(text)
+
+    sender = envelope["sender"]
+    recipient = envelope["recipient"]
+
+    for key, value in headers:
+
+        if sender == "" and key.lower() == "from":
+
+            sender = email.utils.parseaddr(value)[1]
+
+        if recipient == "" and key.lower() == "to":
+
+            recipient = email.utils.parseaddr(value)[1]
+
+    def run(phase, command, data, no_reply):
+
+        start = time.time()
+
+        reply = client.request(command, data, no_reply)
+
+        timings[phase].append(time.time() - start)
+
+        return reply
+
+    if not client.skips(lm.SMFIP_NOMAIL):
+
+        client.macros(lm.SMFIC_MAIL, {"i": queue_id})
+
+        reply = run(
+            "mail_from", lm.SMFIC_MAIL, "<%s>\0" % sender, lm.SMFIP_NR_MAIL
+        )
+
+        if reply in FINAL_REPLIES:
+
+            return reply
+
+    if not client.skips(lm.SMFIP_NORCPT):
+
+        reply = run(
+            "rcpt", lm.SMFIC_RCPT, "<%s>\0" % recipient, lm.SMFIP_NR_RCPT
+        )
+
+        if reply in FINAL_REPLIES:
+
+            return reply
+
+    if not client.skips(lm.SMFIP_NOHDRS):
+
+        client.macros(lm.SMFIC_HEADER, {"i": queue_id})
+
+        start = time.time()
+
+        for key, value in headers:
+
+            reply = client.request(
+                lm.SMFIC_HEADER, "%s\0%s\0" % (key, value), lm.SMFIP_NR_HDR
+            )
+
+            if reply in FINAL_REPLIES:
+
+                return reply
+
+        timings["header"].append(time.time() - start)
+
+    if not client.skips(lm.SMFIP_NOEOH):
+
+        reply = run("eoh", lm.SMFIC_EOH, "", lm.SMFIP_NR_EOH)
+
+        if reply in FINAL_REPLIES:
+
+            return reply
+
+    if not client.skips(lm.SMFIP_NOBODY):
+
+        start = time.time()
+
+        for offset in range(0, len(body), chunk_size):
+
+            reply = client.request(
+                lm.SMFIC_BODY,
+                body[offset:offset + chunk_size],
+                lm.SMFIP_NR_BODY
+            )
+
+            if reply in FINAL_REPLIES:
+
+                return reply
+
+            if reply == lm.SMFIR_SKIP:
+
+                break
+
+        timings["body"].append(time.time() - start)
+
+    client.macros(lm.SMFIC_BODYEOB, {"i": queue_id})
+
+    start = time.time()
+
+    reply, modifications = client.end_of_body()
+
+    timings["eob"].append(time.time() - start)
+
+    if len(modifications) > 0:
+
+        return "modified"
+
+    return reply
+
+
+class LoadGenerator(object):
+
+    """ Send mails to a milter over concurrent connections
+    """
+
+    def __init__(self, address, mails, envelope, connections=1, count=0,
+                 rate=0, mails_per_connection=1, chunk_size=CHUNK_SIZE,
+                 timeout=60):
+
+        """ Set up the load generator
+
+        :param address: The milter socket
+        :param mails: A list of (name, mail text) tuples, that are sent in a
+            round robin
+        :param envelope: A dictionary with the "ip", "sender" and
+            "recipient" of the mails. An empty sender or recipient is taken
+            from the headers.
+        :param connections: The number of concurrent connections
+        :param count: The number of mails to send. 0 sends every mail once.
+        :param rate: The target rate in mails per second. 0 sends as fast
+            as possible.
+        :param mails_per_connection: How many mails are sent over one
+            connection
+        :param chunk_size: The size of the body chunks
+        :param timeout: The socket timeout in seconds
+        :return: The load generator
+        """
+
+        self.address = address
+        self.mails = mails
+        self.envelope = envelope
+        self.connections = connections
+        self.count = count or len(mails)
+        self.rate = rate
+        self.mails_per_connection = mails_per_connection
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+
+        """ Serializes the scheduling of mails and collecting the results """
+
+        self.scheduled = 0
+
+        self.next_slot = 0
+
+        self.timings = dict((phase, []) for phase in PHASES + ("total",))
+
+        self.results = {}
+
+        self.errors = 0
+
+    def schedule(self):
+
+        """ Take the next mail and the time, it should be sent at
+
+        :return: A tuple of the mail index and the send time or None, if all
+            mails are sent
+        """
+
+        with self.lock:
+
+            if self.scheduled >= self.count:
+
+                return None
+
+            index = self.scheduled
+
+            self.scheduled += 1
+
+            slot = time.time()
+
+            if self.rate > 0:
+
+                slot = max(slot, self.next_slot)
+
+                self.next_slot = slot + 1.0 / self.rate
+
+            return index, slot
+
+    def worker(self):
+
+        """ Send mails over one connection after the other
+        """
+
+        timings = dict((phase, []) for phase in self.timings.keys())
+
+        results = {}
+
+        errors = 0
+
+        job = self.schedule()
+
+        while job is not None:
+
+            client = None
+
+            try:
+
+                start = time.time()
+
+                client = MilterClient(open_socket(self.address, self.timeout))
+
+                client.negotiate()
+
+                timings["negotiate"].append(time.time() - start)
+
+                start = time.time()
+
+                reply = client.connect("localhost", self.envelope["ip"])
+
+                timings["connect"].append(time.time() - start)
+
+                for mail_number in range(self.mails_per_connection):
+
+                    if mail_number > 0:
+
+                        job = self.schedule()
+
+                        if job is None:
+
+                            break
+
+                    index, slot = job
+
+                    job = None
+
+                    time.sleep(max(0, slot - time.time()))
+
+                    if reply in FINAL_REPLIES:
+
+                        # The milter accepted the whole connection
+
+                        result = reply
+
+                    else:
+
+                        result = send_mail(
+                            client,
+                            self.mails[index % len(self.mails)][1],
+                            self.envelope,
+                            timings,
+                            "BENCH%X" % index,
+                            self.chunk_size
+                        )
+
+                        if result != lm.SMFIR_CONTINUE \
+                                and result != "modified":
+
+                            # The mail ended early
+
+                            client.send(lm.SMFIC_ABORT)
+
+                    # Measured from the scheduled time, so a slow milter
+                    # isn't hidden by a waiting load generator
+
+                    timings["total"].append(time.time() - slot)
+
+                    result = REPLY_NAMES.get(result, result)
+
+                    results[result] = results.get(result, 0) + 1
+
+            except (socket.error, MilterError), e:
+
+                errors += 1
+
+                sys.stderr.write("Connection failed: %s\n" % e)
+
+            finally:
+
+                if client is not None:
+
+                    client.close()
+
+            job = self.schedule()
+
+        with self.lock:
+
+            for phase, values in timings.items():
+
+                self.timings[phase].extend(values)
+
+            for result, count in results.items():
+
+                self.results[result] = self.results.get(result, 0) + count
+
+            self.errors += errors
+
+    def run(self):
+
+        """ Send all mails and measure them
+
+        :return: A dictionary with the number of mails, errors, the results
+            by reply, the seconds, the throughput and the phase summary
+        """
+
+        start = time.time()
+
+        threads = []
+
+        for index in range(self.connections):
+
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+
+            threads.append(thread)
+
+        for thread in threads:
+
+            thread.join()
+
+        seconds = time.time() - start
+
+        return {
+            "mails": len(self.timings["total"]),
+            "errors": self.errors,
+            "results": self.results,
+            "seconds": seconds,
+            "mails_per_second":
+                len(self.timings["total"]) / seconds if seconds else 0,
+            "phases": summarize(self.timings)
+        }
+
+
+def print_report(result, out=sys.stdout):
+
+    """ Print a load generator result
+
+    :param result: The result as returned by LoadGenerator.run
+    :param out: The file to print to
+    """
+
+    out.write("%d mails, %d errors, %.3f s, %.1f mails/s\n" % (
+        result["mails"], result["errors"], result["seconds"],
+        result["mails_per_second"]
+    ))
+
+    out.write("Results: %s\n\n" % ", ".join(
+        "%s %d" % (reply, count)
+        for reply, count in sorted(result["results"].items())
+    ))
+
+    print_stages(result["phases"], PHASES + ("total",), out)
+
+
+def main(argv=None):
+
+    """ Run the load generator
+
+    :param argv: The command line arguments
+    :return: The exit code
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Send mails to a milter over the milter protocol and "
+                    "report the latency of every phase"
+    )
+
+    parser.add_argument(
+        "corpus",
+        nargs="+",
+        help=".eml files, mbox files or directories containing them"
+    )
+
+    parser.add_argument(
+        "-s",
+        "--socket",
+        dest="socket",
+        default="inet:127.0.0.1:5000",
+        help="Milter socket. IP-Sockets need to be in the form "
+             "inet:<ip>:<port> [inet:127.0.0.1:5000]"
+    )
+
+    parser.add_argument(
+        "-c",
+        "--connections",
+        dest="connections",
+        type=int,
+        default=1,
+        help="Number of concurrent connections [1]"
+    )
+
+    parser.add_argument(
+        "-n",
+        "--count",
+        dest="count",
+        type=int,
+        default=0,
+        help="Number of mails to send. The corpus is repeated as needed "
+             "[the size of the corpus]"
+    )
+
+    parser.add_argument(
+        "-r",
+        "--rate",
+        dest="rate",
+        type=float,
+        default=0,
+        help="Target rate in mails per second. 0 sends as fast as "
+             "possible [0]"
+    )
+
+    parser.add_argument(
+        "-m",
+        "--mails-per-connection",
+        dest="mails_per_connection",
+        type=int,
+        default=1,
+        help="Number of mails sent over one connection [1]"
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Size of the body chunks [%d]" % CHUNK_SIZE
+    )
+
+    parser.add_argument(
+        "--ip",
+        dest="ip",
+        default="127.0.0.1",
+        help="IP address of the SMTP client [127.0.0.1]"
+    )
+
+    parser.add_argument(
+        "--sender",
+        dest="sender",
+        default="",
+        help="Envelope sender [the From header]"
+    )
+
+    parser.add_argument(
+        "--recipient",
+        dest="recipient",
+        default="",
+        help="Envelope recipient [the To header]"
+    )
+
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=60,
+        help="Socket timeout in seconds [60]"
+    )
+
+    parser.add_argument(
+        "-j",
+        "--json",
+        dest="json",
+        default=None,
+        help="Also write the result as JSON to this file"
+    )
+
+    options = parser.parse_args(argv)
+
+    if not 0 < options.chunk_size <= CHUNK_SIZE:
+
+        parser.error("The chunk size has to be between 1 and %d" % CHUNK_SIZE)
+
+    mails = list(read_corpus(options.corpus))
+
+    if len(mails) == 0:
+
+        sys.stderr.write("No mails found\n")
+
+        return 1
+
+    generator = LoadGenerator(
+        options.socket,
+        mails,
+        {
+            "ip": options.ip,
+            "sender": options.sender,
+            "recipient": options.recipient
+        },
+        options.connections,
+        options.count,
+        options.rate,
+        options.mails_per_connection,
+        options.chunk_size,
+        options.timeout
+    )
+
+    result = generator.run()
+
+    print_report(result)
+
+    if options.json is not None:
+
+        with open(options.json, "w") as json_file:
+
+            json.dump(result, json_file, indent=2, sort_keys=True)
+
+    return 0 if result["errors"] == 0 else 2
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+""" Generate synthetic mails for the benchmarks
+
+The mails cover the shapes seen in practice: plain text, HTML, alternative
+and mixed multiparts and (nested) forwarded mails. Their text parts use
+different transfer encodings and charsets:
+
+    python -m benchmarks.messages -o corpus -n 100 --sizes 1K,100K,10M
+"""
+import argparse
+import base64
+import email.utils
+import itertools
+import os
+import quopri
+import random
+import sys
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+
+SHAPES = ("plain", "html", "alternative", "mixed", "forward")
+
+""" The structures of the generated mails """
+
+ENCODINGS = ("base64", "quoted-printable", "8bit")
+
+""" The transfer encodings of the text parts """
+
+WORDS = {
+    "us-ascii": u"the quick brown fox jumps over a lazy dog and sends some "
+                u"mail to the team",
+    "utf-8": u"gr\xfc\xdfe 你好 привет "
+             u"γειά caf\xe9 na\xefve € price",
+    "iso-8859-1": u"gr\xfc\xdfe aus m\xfcnchen caf\xe9 na\xefve fa\xe7ade "
+                  u"se\xf1or \xe0 bient\xf4t",
+    "iso-8859-15": u"preis in € f\xfcr die b\xf6rse œuvre "
+                   u"škoda",
+    "windows-1252": u"“quoted” text – with dashes… and "
+                    u"€ signs",
+    "koi8-r": u"привет мир "
+              u"письмо для "
+              u"вас",
+    "iso-8859-7": u"γειά σου "
+                  u"κόσμε μήνυ"
+                  u"μα",
+    "shift_jis": u"こんにちは 世界 "
+                 u"メール です",
+    "gb2312": u"你好 世界 邮件 测试"
+}
+
+""" Words to build texts from, which can be encoded in their charset """
+
+CHARSETS = tuple(sorted(WORDS.keys()))
+
+""" The charsets of the text parts """
+
+UNITS = {"": 1, "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(value):
+
+    """ Parse a size like 1K, 50M or 300
+
+    :param value: The size with an optional unit
+    :return: The size in bytes
+    """
+
+    value = value.strip().upper()
+
+    unit = value[-1:] if value[-1:] in UNITS else ""
+
+    return int(float(value[:len(value) - len(unit)]) * UNITS[unit])
+
+
+def make_text(rng, charset, size):
+
+    """ Build a text of about the given size
+
+    A paragraph of random words is repeated, so large texts are built fast.
+
+    :param rng: The random generator
+    :param charset: The charset of the text
+    :param size: The size of the encoded text in bytes
+    :return: The unicode text
+    """
+
+    words = WORDS[charset].split()
+
+    lines = []
+
+    for line in range(20):
+
+        lines.append(u" ".join(rng.choice(words) for word in range(10)))
+
+    paragraph = u"\n".join(lines) + u"\n\n"
+
+    repeat = max(1, size // len(paragraph.encode(charset)) + 1)
+
+    text = paragraph * repeat
+
+    # Cut the text to the size, but not within a character
+
+    return text.encode(charset)[:size].decode(charset, "ignore")
+
+
+def make_text_part(text, subtype, charset, encoding):
+
+    """ Build a text part
+
+    :param text: The unicode text
+    :param subtype: The text subtype (plain or html)
+    :param charset: The charset
+    :param encoding: The transfer encoding
+    :return: The part
+    """
+
+    part = MIMENonMultipart("text", subtype, charset=charset)
+
+    payload = text.encode(charset)
+
+    if encoding == "base64":
+
+        payload = base64.encodestring(payload)
+
+    elif encoding == "quoted-printable":
+
+        payload = quopri.encodestring(payload)
+
+    part["Content-Transfer-Encoding"] = encoding
+
+    part.set_payload(payload)
+
+    return part
+
+
+def make_html(text):
+
+    """ Wrap a text in HTML
+
+    :param text: The unicode text
+    :return: The HTML
+    """
+
+    paragraphs = u"".join(
+        u"<p>%s</p>\n" % paragraph.replace(u"\n", u"<br>\n")
+        for paragraph in text.split(u"\n\n")
+        if paragraph != u""
+    )
+
+    return u"<html>\n<head><title>Mail</title></head>\n<body>\n%s</body>\n" \
+           u"</html>\n" % paragraphs
+
+
+def make_body(rng, shape, encoding, charset, size, depth=1):
+
+    """ Build the body structure of a mail
+
+    :param rng: The random generator
+    :param shape: The shape of the mail
+    :param encoding: The transfer encoding of the text parts
+    :param charset: The charset of the text parts
+    :param size: The approximate size of the content in bytes
+    :param depth: How deep forwarded mails are nested
+    :return: The message
+    """
+
+    if shape == "plain":
+
+        return make_text_part(
+            make_text(rng, charset, size), "plain", charset, encoding
+        )
+
+    if shape == "html":
+
+        return make_text_part(
+            make_html(make_text(rng, charset, size)), "html", charset,
+            encoding
+        )
+
+    if shape == "alternative":
+
+        text = make_text(rng, charset, size // 2)
+
+        message = MIMEMultipart("alternative")
+
+        message.attach(make_text_part(text, "plain", charset, encoding))
+        message.attach(
+            make_text_part(make_html(text), "html", charset, encoding)
+        )
+
+        return message
+
+    if shape == "mixed":
+
+        message = MIMEMultipart("mixed")
+
+        message.attach(make_body(
+            rng, "alternative", encoding, charset, size // 4
+        ))
+
+        attachment = MIMEApplication(
+            "".join(chr(rng.randint(0, 255)) for byte in range(1024)) *
+            max(1, size * 3 // 4 // 1024)
+        )
+
+        attachment.add_header(
+            "Content-Disposition", "attachment", filename="data.bin"
+        )
+
+        message.attach(attachment)
+
+        return message
+
+    # A forwarded mail with a comment. Forwards of forwards are nested.
+
+    message = MIMEMultipart("mixed")
+
+    message.attach(make_text_part(
+        make_text(rng, charset, min(size // 4, 4096)), "plain", charset,
+        encoding
+    ))
+
+    if depth > 1:
+
+        forwarded = make_body(
+            rng, "forward", encoding, charset, size * 3 // 4, depth - 1
+        )
+
+    else:
+
+        forwarded = make_body(
+            rng, rng.choice(SHAPES[:4]), encoding, charset, size * 3 // 4
+        )
+
+    add_headers(rng, forwarded)
+
+    message.attach(MIMEMessage(forwarded))
+
+    return message
+
+
+def add_headers(rng, message):
+
+    """ Add the usual headers of a mail
+
+    :param rng: The random generator
+    :param message: The message
+    """
+
+    user = rng.choice(("alice", "bob", "carol", "dave", "sales", "support"))
+    domain = rng.choice(("example.com", "example.org", "dept1.example.net"))
+
+    message["From"] = "%s <%s@%s>" % (user.title(), user, domain)
+    message["To"] = "recipient%d@example.com" % rng.randint(1, 100)
+    message["Subject"] = rng.choice(
+        ("Invoice %d", "Meeting %d", "Re: Report %d", "Fwd: Offer %d")
+    ) % rng.randint(1, 10000)
+    message["Date"] = email.utils.formatdate(
+        1400000000 + rng.randint(0, 100000000)
+    )
+    message["Message-ID"] = "<%d.%d@%s>" % (
+        rng.randint(0, 2 ** 32), rng.randint(0, 2 ** 32), domain
+    )
+
+
+def generate(count, shapes=SHAPES, encodings=ENCODINGS, charsets=CHARSETS,
+             sizes=(1024,), depth=1, seed=0):
+
+    """ Generate mails, cycling through all combinations of the variants
+
+    :param count: The number of mails
+    :param shapes: The shapes to use
+    :param encodings: The transfer encodings to use
+    :param charsets: The charsets to use
+    :param sizes: The approximate sizes of the mails in bytes
+    :param depth: How deep forwarded mails are nested
+    :param seed: The seed of the random generator
+    :return: A generator of (name, mail text) tuples
+    """
+
+    rng = random.Random(seed)
+
+    # The shape changes with every mail, then the encoding, the charset and
+    # the size
+
+    variants = itertools.cycle(
+        itertools.product(sizes, charsets, encodings, shapes)
+    )
+
+    for index in range(count):
+
+        (size, charset, encoding, shape) = next(variants)
+
+        message = make_body(rng, shape, encoding, charset, size, depth)
+
+        add_headers(rng, message)
+
+        name = "%05d-%s-%s-%s-%d" % (index, shape, encoding, charset, size)
+
+        yield name, message.as_string()
+
+
+def main(argv=None):
+
+    """ Write generated mails to a directory
+
+    :param argv: The command line arguments
+    :return: The exit code
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic mails for the benchmarks"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        required=True,
+        help="Directory to write the .eml files to"
+    )
+
+    parser.add_argument(
+        "-n",
+        "--count",
+        dest="count",
+        type=int,
+        default=len(SHAPES) * len(ENCODINGS),
+        help="Number of mails [%d]" % (len(SHAPES) * len(ENCODINGS))
+    )
+
+    parser.add_argument(
+        "--shapes",
+        dest="shapes",
+        default=",".join(SHAPES),
+        help="Comma separated shapes [%s]" % ",".join(SHAPES)
+    )
+
+    parser.add_argument(
+        "--encodings",
+        dest="encodings",
+        default=",".join(ENCODINGS),
+        help="Comma separated transfer encodings [%s]" % ",".join(ENCODINGS)
+    )
+
+    parser.add_argument(
+        "--charsets",
+        dest="charsets",
+        default=",".join(CHARSETS),
+        help="Comma separated charsets [%s]" % ",".join(CHARSETS)
+    )
+
+    parser.add_argument(
+        "--sizes",
+        dest="sizes",
+        default="1K",
+        help="Comma separated sizes like 1K, 100K or 50M [1K]"
+    )
+
+    parser.add_argument(
+        "--depth",
+        dest="depth",
+        type=int,
+        default=1,
+        help="How deep forwarded mails are nested [1]"
+    )
+
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=0,
+        help="Seed of the random generator [0]"
+    )
+
+    options = parser.parse_args(argv)
+
+    variants = {}
+
+    for name, choices in (
+        ("shapes", SHAPES), ("encodings", ENCODINGS), ("charsets", CHARSETS)
+    ):
+
+        variants[name] = getattr(options, name).split(",")
+
+        for variant in variants[name]:
+
+            if variant not in choices:
+
+                parser.error("Unknown %s: %s" % (name[:-1], variant))
+
+    if not os.path.isdir(options.output):
+
+        os.makedirs(options.output)
+
+    for name, text in generate(
+        options.count,
+        variants["shapes"],
+        variants["encodings"],
+        variants["charsets"],
+        [parse_size(size) for size in options.sizes.split(",")],
+        options.depth,
+        options.seed
+    ):
+
+        with open(os.path.join(options.output, name + ".eml"), "w") as mail:
+
+            mail.write(text)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,620 @@
+""" Microbenchmarks of the single processing steps of MilterHelper
+
+Every step is timed on its own with a generated rule set and generated
+mails, so a slow step shows up even if it's hidden in the noise of a whole
+mail. The results can be stored as a baseline and later runs compared
+against it:
+
+    python -m benchmarks.micro --save baseline.json
+    python -m benchmarks.micro --compare baseline.json --threshold 10
+
+The comparison exits with 1, if a step got slower by more than the
+threshold. The rules are loaded into a test database, so the configured
+rules aren't touched.
+"""
+import argparse
+import email
+import email.parser
+import json
+import os
+import random
+import sys
+import timeit
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "disclaimrweb.settings")
+import django
+django.setup()
+
+from django.core import serializers
+from django.db import connection
+
+from benchmarks import messages, rules
+from disclaimr.configuration_helper import build_configuration
+from disclaimr.milter_helper import MilterHelper
+from disclaimrwebadmin import models
+
+IP = "127.0.0.1"
+
+""" The IP address of the benchmark client. It's in the match network of the
+generated rule set. """
+
+SENDER = "alice@example.com"
+
+RECIPIENT = "recipient1@example.com"
+
+TEMPLATE = u"""--
+Sent by {header["from"]} to {header["to"]}
+Subject: {header["subject"]}
+{rt}Phone: {resolver["telephonenumber"]}{/rt}
+{resolver["cn"]}
+This mail is confidential. If you aren't the intended recipient, please
+delete it and notify the sender.
+"""
+
+""" The disclaimer used by the template and HTML benchmarks """
+
+
+def make_context(rule_count=50, requirement_count=20, size=64 * 1024):
+
+    """ Load a generated rule set and build the data shared by the
+    benchmarks. Has to be called with a test database.
+
+    :param rule_count: The number of rules
+    :param requirement_count: The number of requirements per rule
+    :param size: The size of the mail parts in bytes
+    :return: A dictionary with the configuration, a disclaimer action, mail
+        headers and mail parts
+    """
+
+    fixture = rules.generate(
+        rule_count, requirement_count, match_ratio=0.5, deny_ratio=0
+    )
+
+    for item in serializers.deserialize("json", json.dumps(fixture)):
+
+        item.save()
+
+    rng = random.Random(0)
+
+    headers = [
+        ("Received", "from host%d.example.com by mx.example.com" % index)
+        for index in range(10)
+    ] + [
+        ("From", "Alice <%s>" % SENDER),
+        ("To", RECIPIENT),
+        ("Subject", "Invoice 1234"),
+        ("Date", "Mon, 19 Oct 2026 10:00:00 +0000"),
+        ("Message-ID", "<1234@example.com>"),
+        ("X-Mailer", "Benchmark")
+    ]
+
+    disclaimer = models.Disclaimer(
+        name="Benchmark",
+        text=TEMPLATE,
+        text_charset="utf-8",
+        text_use_template=True,
+        html_use_text=True
+    )
+
+    action = models.Action(
+        name="Benchmark",
+        disclaimer=disclaimer,
+        resolve_sender=False
+    )
+
+    text = messages.make_text(rng, "utf-8", size)
+
+    parts = {}
+
+    for encoding in messages.ENCODINGS:
+
+        part = messages.make_text_part(text, "plain", "utf-8", encoding)
+
+        for key, value in headers:
+
+            part[key] = value
+
+        # Parse the part like the milter does
+
+        parts[encoding] = email.message_from_string(part.as_string())
+
+    return {
+        "configuration": build_configuration(),
+        "action": action,
+        "headers": headers,
+        "html": messages.make_html(text).encode("utf-8"),
+        "parts": parts
+    }
+
+
+def make_helper(context):
+
+    """ Build a helper, that has received the envelope and headers of a mail
+
+    :param context: The benchmark context
+    :return: The helper
+    """
+
+    helper = MilterHelper(context["configuration"])
+
+    helper.connect("localhost", "", IP, "", {})
+
+    helper.mail_from(SENDER, {})
+
+    helper.rcpt(RECIPIENT, {})
+
+    for key, value in context["headers"]:
+
+        helper.header(key, value, {})
+
+    return helper
+
+
+def bench_connect(context):
+
+    """ Match the client IP against the networks of all requirements """
+
+    configuration = context["configuration"]
+
+    def run():
+
+        MilterHelper(configuration).connect("localhost", "", IP, "", {})
+
+    return run
+
+
+def bench_requirements(context):
+
+    """ Check the envelope and header requirements of the requirements
+    matching the client IP """
+
+    helper = MilterHelper(context["configuration"])
+
+    helper.connect("localhost", "", IP, "", {})
+
+    headers = context["headers"]
+
+    def run():
+
+        helper.reset()
+
+        helper.mail_from(SENDER, {})
+
+        helper.rcpt(RECIPIENT, {})
+
+        for key, value in headers:
+
+            helper.header(key, value, {})
+
+        helper.eoh({})
+
+    return run
+
+
+def bench_template(context):
+
+    """ Replace the template tags of a disclaimer """
+
+    helper = make_helper(context)
+
+    action = context["action"]
+
+    def run():
+
+        helper.build_disclaimer(action, "text/plain", "utf-8")
+
+    return run
+
+
+def bench_make_html(context):
+
+    """ Convert a text disclaimer to HTML """
+
+    text = TEMPLATE * 10
+
+    def run():
+
+        MilterHelper.make_html(text)
+
+    return run
+
+
+def make_decode(encoding):
+
+    """ Build the benchmark of decoding a mail part
+
+    :param encoding: The transfer encoding of the part
+    :return: The benchmark
+    """
+
+    def bench_decode(context):
+
+        part = context["parts"][encoding]
+
+        def run():
+
+            MilterHelper.decode_mail(part)
+
+        return run
+
+    bench_decode.__doc__ = "Decode a %s encoded text part" % encoding
+
+    return bench_decode
+
+
+def bench_html_insert(context):
+
+    """ Insert a HTML disclaimer into the body of a HTML part """
+
+    html = context["html"]
+
+    disclaimer = "<html><body><p>%s</p></body></html>" % \
+                 MilterHelper.make_html(TEMPLATE)
+
+    def run():
+
+        MilterHelper.insert_html(html, disclaimer)
+
+    return run
+
+
+def bench_addpart(context):
+
+    """ Wrap a part into a multipart with a disclaimer part """
+
+    part = context["parts"]["base64"]
+
+    def run():
+
+        MilterHelper.add_part(part, "text/plain", TEMPLATE, "utf-8")
+
+    return run
+
+
+def bench_eob_headers(context):
+
+    """ Compare the headers of the original and the modified mail """
+
+    part = context["parts"]["base64"]
+
+    orig_mail = email.parser.HeaderParser().parsestr(
+        "".join("%s: %s\n" % header for header in context["headers"])
+    )
+
+    mail = MilterHelper.add_part(part, "text/plain", TEMPLATE, "utf-8")
+
+    def run():
+
+        MilterHelper.diff_headers(orig_mail, mail)
+
+    return run
+
+
+BENCHMARKS = (
+    ("connect", bench_connect),
+    ("requirements", bench_requirements),
+    ("template", bench_template),
+    ("make_html", bench_make_html),
+    ("decode_base64", make_decode("base64")),
+    ("decode_quoted_printable", make_decode("quoted-printable")),
+    ("html_insert", bench_html_insert),
+    ("addpart", bench_addpart),
+    ("eob_headers", bench_eob_headers)
+)
+
+""" The benchmarks in the order they are run """
+
+
+def measure(function, repeat=5, min_time=0.2):
+
+    """ Time a function
+
+    The number of calls per run is raised until a run takes at least
+    min_time, so short functions are measured reliably.
+
+    :param function: The function to time
+    :param repeat: The number of runs
+    :param min_time: The minimum duration of a run in seconds
+    :return: A dictionary with the number of calls per run and the best and
+        median time of a call in seconds
+    """
+
+    timer = timeit.Timer(function)
+
+    number = 1
+
+    while True:
+
+        duration = timer.timeit(number)
+
+        if duration >= min_time or number >= 1000000:
+
+            break
+
+        number *= 10 if duration < min_time / 10 else 2
+
+    times = sorted(
+        duration / number for duration in timer.repeat(repeat, number)
+    )
+
+    return {
+        "number": number,
+        "best": times[0],
+        "median": times[len(times) // 2]
+    }
+
+
+def run_benchmarks(context, names=None, repeat=5, min_time=0.2):
+
+    """ Run the benchmarks
+
+    :param context: The benchmark context as returned by make_context
+    :param names: The names of the benchmarks to run or None for all
+    :param repeat: The number of runs of every benchmark
+    :param min_time: The minimum duration of a run in seconds
+    :return: A dictionary of benchmark names and measurements
+    """
+
+    results = {}
+
+    for name, bench in BENCHMARKS:
+
+        if names and name not in names:
+
+            continue
+
+        results[name] = measure(bench(context), repeat, min_time)
+
+    return results
+
+
+def compare(baseline, results, threshold=10.0):
+
+    """ Compare results against a baseline
+
+    The best times are compared, as they are the least disturbed by other
+    processes.
+
+    :param baseline: The measurements of the baseline
+    :param results: The current measurements
+    :param threshold: The change in percent, that counts as a regression or
+        improvement
+    :return: A list of tuples of the benchmark name, the baseline and current
+        best time, the change in percent and the status ("ok", "regression",
+        "improvement" or "new")
+    """
+
+    report = []
+
+    for name, bench in BENCHMARKS:
+
+        if name not in results:
+
+            continue
+
+        current = results[name]["best"]
+
+        if name not in baseline:
+
+            report.append((name, None, current, None, "new"))
+
+            continue
+
+        base = baseline[name]["best"]
+
+        change = (current - base) / base * 100 if base > 0 else 0.0
+
+        if change > threshold:
+
+            status = "regression"
+
+        elif change < -threshold:
+
+            status = "improvement"
+
+        else:
+
+            status = "ok"
+
+        report.append((name, base, current, change, status))
+
+    return report
+
+
+def print_results(results, out=sys.stdout):
+
+    """ Print the measurements
+
+    :param results: The measurements as returned by run_benchmarks
+    :param out: The file to print to
+    """
+
+    out.write("%-24s %10s %12s %12s\n" % (
+        "benchmark", "calls", "best us", "median us"
+    ))
+
+    for name, bench in BENCHMARKS:
+
+        if name in results:
+
+            out.write("%-24s %10d %12.2f %12.2f\n" % (
+                name,
+                results[name]["number"],
+                results[name]["best"] * 1000000,
+                results[name]["median"] * 1000000
+            ))
+
+
+def print_comparison(report, out=sys.stdout):
+
+    """ Print a comparison report
+
+    :param report: The report as returned by compare
+    :param out: The file to print to
+    """
+
+    out.write("%-24s %12s %12s %9s  %s\n" % (
+        "benchmark", "baseline us", "current us", "change", "status"
+    ))
+
+    for name, base, current, change, status in report:
+
+        out.write("%-24s %12s %12.2f %9s  %s\n" % (
+            name,
+            "-" if base is None else "%.2f" % (base * 1000000),
+            current * 1000000,
+            "-" if change is None else "%+.1f%%" % change,
+            status
+        ))
+
+
+def main(argv=None):
+
+    """ Run the microbenchmarks
+
+    :param argv: The command line arguments
+    :return: The exit code
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Time the single processing steps of the milter and "
+                    "compare them against a baseline"
+    )
+
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="Benchmarks to run [all]: %s" % ", ".join(
+            name for name, bench in BENCHMARKS
+        )
+    )
+
+    parser.add_argument(
+        "--save",
+        dest="save",
+        default=None,
+        help="Store the results as a baseline in this file"
+    )
+
+    parser.add_argument(
+        "--compare",
+        dest="compare",
+        default=None,
+        help="Compare the results against the baseline in this file"
+    )
+
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        dest="threshold",
+        type=float,
+        default=10.0,
+        help="Slowdown in percent reported as a regression [10]"
+    )
+
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        dest="repeat",
+        type=int,
+        default=5,
+        help="Number of runs of every benchmark [5]"
+    )
+
+    parser.add_argument(
+        "--min-time",
+        dest="min_time",
+        type=float,
+        default=0.2,
+        help="Minimum duration of a run in seconds [0.2]"
+    )
+
+    parser.add_argument(
+        "--rules",
+        dest="rules",
+        type=int,
+        default=50,
+        help="Number of generated rules [50]"
+    )
+
+    parser.add_argument(
+        "--requirements",
+        dest="requirements",
+        type=int,
+        default=20,
+        help="Number of requirements per rule [20]"
+    )
+
+    options = parser.parse_args(argv)
+
+    for name in options.names:
+
+        if name not in dict(BENCHMARKS):
+
+            parser.error("Unknown benchmark: %s" % name)
+
+    baseline = None
+
+    if options.compare is not None:
+
+        with open(options.compare) as baseline_file:
+
+            baseline = json.load(baseline_file)["benchmarks"]
+
+    # Use a test database, so the configured rules aren't touched
+
+    old_name = connection.settings_dict["NAME"]
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    try:
+
+        results = run_benchmarks(
+            make_context(options.rules, options.requirements),
+            options.names,
+            options.repeat,
+            options.min_time
+        )
+
+    finally:
+
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if options.save is not None:
+
+        with open(options.save, "w") as baseline_file:
+
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "rules": options.rules,
+                    "requirements": options.requirements,
+                    "benchmarks": results
+                },
+                baseline_file,
+                indent=2,
+                sort_keys=True
+            )
+
+    if baseline is None:
+
+        print_results(results)
+
+        return 0
+
+    report = compare(baseline, results, options.threshold)
+
+    print_comparison(report)
+
+    for name, base, current, change, status in report:
+
+        if status == "regression":
+
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
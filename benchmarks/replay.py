@@ -0,0 +1,357 @@
+""" Replay a corpus of mails through MilterHelper and measure every stage
+
+The mails are fed to MilterHelper stage by stage like DisclaimrMilter does,
+each one in its own connection. The rules are loaded from Django fixtures
+into a test database, so neither the configured database, nor an MTA or
+network is needed.
+
+Usage:
+
+    python -m benchmarks.replay [options] <corpus>...
+
+A corpus is a .eml file, an mbox file or a directory containing them.
+"""
+import argparse
+import email.utils
+import json
+import os
+import resource
+import sys
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "disclaimrweb.settings")
+import django
+django.setup()
+
+from django.core.management import call_command
+from django.db import connection, reset_queries
+
+from benchmarks.corpus import CHUNK_SIZE, read_corpus, split_mail
+from benchmarks.stats import print_stages, summarize
+from disclaimr.configuration_helper import build_configuration
+from disclaimr.milter_helper import MilterHelper
+
+STAGES = ("connect", "mail_from", "rcpt", "header", "eoh", "body", "eob")
+
+""" The measured stages in the order of the milter protocol """
+
+DEFAULT_FIXTURE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "rules.json"
+)
+
+
+def replay_mail(configuration, text, envelope, timings, chunk_size=CHUNK_SIZE):
+
+    """ Feed a mail through MilterHelper and record the time of every stage
+
+    Like DisclaimrMilter, the following stages are skipped, if the helper
+    is disabled by a stage.
+
+    :param configuration: The milter configuration
+    :param text: The mail text
+    :param envelope: A dictionary with the "ip", "sender" and "recipient" of
+        the mail. An empty sender or recipient is taken from the headers.
+    :param timings: A dictionary of stage names and lists, the durations in
+        seconds are appended to
+    :param chunk_size: The size of the body chunks
+    :return: True, if the mail was modified
+    """
+
+    headers, body = split_mail(text)
+
+    sender = envelope["sender"]
+    recipient = envelope["recipient"]
+
+    for key, value in headers:
+
+        if sender == "" and key.lower() == "from":
+
+            sender = email.utils.parseaddr(value)[1]
+
+        if recipient == "" and key.lower() == "to":
+
+            recipient = email.utils.parseaddr(value)[1]
+
+    helper = MilterHelper(configuration)
+
+    def run(stage, function, *args):
+
+        start = time.time()
+
+        result = function(*args)
+
+        timings[stage].append(time.time() - start)
+
+        return result
+
+    run("connect", helper.connect, "localhost", "", envelope["ip"], "", {})
+
+    if not helper.enabled:
+
+        return False
+
+    run("mail_from", helper.mail_from, sender, {})
+
+    run("rcpt", helper.rcpt, recipient, {})
+
+    if not helper.enabled:
+
+        return False
+
+    start = time.time()
+
+    for key, value in headers:
+
+        helper.header(key, value, {})
+
+    timings["header"].append(time.time() - start)
+
+    run("eoh", helper.eoh, {})
+
+    if not helper.enabled:
+
+        return False
+
+    start = time.time()
+
+    for offset in range(0, len(body), chunk_size):
+
+        helper.body(body[offset:offset + chunk_size], {})
+
+    timings["body"].append(time.time() - start)
+
+    # Like DisclaimrMilter, consume the new body chunk by chunk
+
+    start = time.time()
+
+    tasks = helper.eob({})
+
+    if tasks is not None and "repl_body" in tasks:
+
+        for chunk in tasks["repl_body"]:
+
+            pass
+
+    timings["eob"].append(time.time() - start)
+
+    return tasks is not None
+
+
+def print_report(result, out=sys.stdout):
+
+    """ Print a benchmark result
+
+    :param result: The result as returned by run_benchmark
+    :param out: The file to print to
+    """
+
+    out.write(
+        "%d mails (%d modified), %.1f KiB, %.3f s\n" % (
+            result["mails"], result["modified"], result["bytes"] / 1024.0,
+            result["seconds"]
+        )
+    )
+
+    out.write(
+        "Throughput: %.1f mails/s, %.2f MiB/s\n" % (
+            result["mails_per_second"],
+            result["bytes_per_second"] / 1024.0 / 1024.0
+        )
+    )
+
+    out.write("Peak memory: %d KiB\n\n" % result["max_rss"])
+
+    print_stages(result["stages"], STAGES + ("total",), out)
+
+
+def run_benchmark(configuration, mails, envelope, repeat=1,
+                  chunk_size=CHUNK_SIZE):
+
+    """ Replay mails and measure them
+
+    :param configuration: The milter configuration
+    :param mails: A list of (name, mail text) tuples
+    :param envelope: The envelope as used by replay_mail
+    :param repeat: How often to replay the mails
+    :param chunk_size: The size of the body chunks
+    :return: A dictionary with the number of mails, modified mails, bytes,
+        seconds, throughput, peak memory in KiB and the stage summary
+    """
+
+    timings = dict((stage, []) for stage in STAGES + ("total",))
+
+    modified = 0
+
+    size = 0
+
+    for iteration in range(repeat):
+
+        for name, text in mails:
+
+            start = time.time()
+
+            if replay_mail(configuration, text, envelope, timings, chunk_size):
+
+                modified += 1
+
+            timings["total"].append(time.time() - start)
+
+            size += len(text)
+
+            # Don't let debug query logging distort the memory usage
+
+            reset_queries()
+
+    seconds = sum(timings["total"])
+
+    return {
+        "mails": len(timings["total"]),
+        "modified": modified,
+        "bytes": size,
+        "seconds": seconds,
+        "mails_per_second": len(timings["total"]) / seconds if seconds else 0,
+        "bytes_per_second": size / seconds if seconds else 0,
+        # ru_maxrss is measured in KiB on Linux
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": summarize(timings)
+    }
+
+
+def main(argv=None):
+
+    """ Run the replay benchmark
+
+    :param argv: The command line arguments
+    :return: The exit code
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Replay a corpus of mails through the milter helper "
+                    "and report the time taken by every stage"
+    )
+
+    parser.add_argument(
+        "corpus",
+        nargs="+",
+        help=".eml files, mbox files or directories containing them"
+    )
+
+    parser.add_argument(
+        "-f",
+        "--fixture",
+        dest="fixtures",
+        action="append",
+        help="Django fixture with the rules to use. Can be given multiple "
+             "times [benchmarks/fixtures/rules.json]"
+    )
+
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        dest="repeat",
+        type=int,
+        default=1,
+        help="How often to replay the corpus [1]"
+    )
+
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Size of the body chunks [%d]" % CHUNK_SIZE
+    )
+
+    parser.add_argument(
+        "--ip",
+        dest="ip",
+        default="127.0.0.1",
+        help="IP address of the connecting client [127.0.0.1]"
+    )
+
+    parser.add_argument(
+        "--sender",
+        dest="sender",
+        default="",
+        help="Envelope sender [the From header]"
+    )
+
+    parser.add_argument(
+        "--recipient",
+        dest="recipient",
+        default="",
+        help="Envelope recipient [the To header]"
+    )
+
+    parser.add_argument(
+        "-e",
+        "--encrypted-policy",
+        dest="encrypted_policy",
+        choices=["process", "accept"],
+        default="process",
+        help="What to do with signed or encrypted mails [process]"
+    )
+
+    parser.add_argument(
+        "-j",
+        "--json",
+        dest="json",
+        default=None,
+        help="Also write the result as JSON to this file"
+    )
+
+    options = parser.parse_args(argv)
+
+    mails = list(read_corpus(options.corpus))
+
+    if len(mails) == 0:
+
+        sys.stderr.write("No mails found\n")
+
+        return 1
+
+    # Use a test database, so the configured rules aren't touched
+
+    old_name = connection.settings_dict["NAME"]
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    try:
+
+        call_command(
+            "loaddata", *(options.fixtures or [DEFAULT_FIXTURE]), verbosity=0
+        )
+
+        configuration = build_configuration(options.encrypted_policy)
+
+        result = run_benchmark(
+            configuration,
+            mails,
+            {
+                "ip": options.ip,
+                "sender": options.sender,
+                "recipient": options.recipient
+            },
+            options.repeat,
+            options.chunk_size
+        )
+
+    finally:
+
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print_report(result)
+
+    if options.json is not None:
+
+        with open(options.json, "w") as json_file:
+
+            json.dump(result, json_file, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,360 @@
+""" Generate synthetic rule sets for the benchmarks
+
+Writes a Django fixture with many rules, requirements, actions and
+disclaimers. The requirements use a variety of networks and regular
+expressions, so the connect IP matching and the regular expression checks
+can be scaled on purpose:
+
+    python -m benchmarks.rules -o rules.json --rules 100 --requirements 20
+    python -m benchmarks.replay -f rules.json <corpus>
+"""
+import argparse
+import json
+import random
+import sys
+
+from disclaimrwebadmin import constants
+
+SENDERS = (
+    ".*",
+    r".*@example\.com",
+    r"^(alice|bob|carol)@.*",
+    r"^sales-[a-z]+\d*@dept\d+\.example\.(net|org)$",
+    r".*@(.*\.)?example\.(com|org)",
+    r"^[a-z]+\.[a-z]+@partner%d\.example\.com$"
+)
+
+""" Regular expressions for the sender and recipient requirements """
+
+HEADERS = (
+    ".*",
+    "Subject: .*Invoice",
+    r"X-Mailer: .*Outlook.*",
+    "(?i)content-type: multipart/(mixed|alternative)",
+    r"Subject: (Re|Fwd): .*\d{3,}"
+)
+
+""" Regular expressions for the header requirements """
+
+BODIES = (
+    ".*",
+    "(?i)confidential",
+    r"(?s)BEGIN PGP (SIGNED )?MESSAGE",
+    r"\d{4}-\d{4}-\d{4}-\d{4}"
+)
+
+""" Regular expressions for the body requirements """
+
+MIME_TYPES = ("", "", "text/plain", "text/html", "text/*",
+              "text/plain,text/html")
+
+""" Mime type filters of the actions """
+
+
+def make_network(rng, match_ratio, match_network):
+
+    """ Build the network of a requirement
+
+    :param rng: The random generator
+    :param match_ratio: The probability of returning match_network
+    :param match_network: A tuple of the IP address and netmask matching
+        the benchmark clients
+    :return: A tuple of the IP address and the netmask
+    """
+
+    if rng.random() < match_ratio:
+
+        return match_network
+
+    if rng.random() < 0.1:
+
+        # An IPv6 network
+
+        return (
+            "2001:db8:%x:%x::" % (
+                rng.randint(0, 0xffff), rng.randint(0, 0xffff)
+            ),
+            str(rng.choice((32, 48, 64)))
+        )
+
+    cidr = rng.choice((8, 16, 24, 28, 32))
+
+    address = [rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255),
+               rng.randint(0, 255)]
+
+    # Zero the host part, like an administrator would enter it
+
+    for index in range(cidr // 8 + (1 if cidr % 8 else 0), 4):
+
+        address[index] = 0
+
+    return ".".join(str(part) for part in address), str(cidr)
+
+
+def make_disclaimer(rng, pk):
+
+    """ Build a disclaimer
+
+    :param rng: The random generator
+    :param pk: The primary key
+    :return: The fixture object
+    """
+
+    text = "--\n%s\nCompany %d, Example Street %d\n" % (
+        rng.choice((
+            "This mail is confidential.",
+            "Sent from the benchmark department.",
+            "Please consider the environment before printing this mail."
+        )),
+        pk,
+        rng.randint(1, 500)
+    )
+
+    if rng.random() < 0.5:
+
+        text += 'Subject: {header["subject"]}\n'
+
+    html_use_text = rng.random() < 0.5
+
+    return {
+        "model": "disclaimrwebadmin.disclaimer",
+        "pk": pk,
+        "fields": {
+            "name": "Disclaimer %d" % pk,
+            "description": "",
+            "text": text,
+            "text_charset": rng.choice(("utf-8", "iso-8859-1")),
+            "text_use_template": True,
+            "html_use_text": html_use_text,
+            "html": "" if html_use_text else
+                    "<p>%s</p>" % text.replace("\n", "<br>"),
+            "html_charset": "utf-8",
+            "html_use_template": True,
+            "template_fail": False,
+            "use_html_fallback": rng.random() < 0.2
+        }
+    }
+
+
+def generate(rules=100, requirements=20, actions=2, disclaimers=50,
+             match_ratio=0.05, match_network=("127.0.0.0", "8"),
+             deny_ratio=0.1, seed=0):
+
+    """ Generate a rule set
+
+    :param rules: The number of rules
+    :param requirements: The number of requirements per rule
+    :param actions: The maximum number of actions per rule
+    :param disclaimers: The number of disclaimers, that are shared by the
+        actions
+    :param match_ratio: The share of requirements, whose network matches the
+        benchmark clients
+    :param match_network: A tuple of the IP address and netmask matching the
+        benchmark clients
+    :param deny_ratio: The share of requirements, that deny their rule
+    :param seed: The seed of the random generator
+    :return: The fixture as a list of objects
+    """
+
+    rng = random.Random(seed)
+
+    fixture = [
+        make_disclaimer(rng, pk) for pk in range(1, disclaimers + 1)
+    ]
+
+    requirement_pk = 0
+
+    action_pk = 0
+
+    for rule_pk in range(1, rules + 1):
+
+        fixture.append({
+            "model": "disclaimrwebadmin.rule",
+            "pk": rule_pk,
+            "fields": {
+                "name": "Rule %d" % rule_pk,
+                "description": "",
+                "position": rule_pk,
+                "continue_rules": rng.random() < 0.3
+            }
+        })
+
+        for index in range(requirements):
+
+            requirement_pk += 1
+
+            (sender_ip, sender_ip_cidr) = make_network(
+                rng, match_ratio, match_network
+            )
+
+            fixture.append({
+                "model": "disclaimrwebadmin.requirement",
+                "pk": requirement_pk,
+                "fields": {
+                    "rule": rule_pk,
+                    "name": "Requirement %d" % requirement_pk,
+                    "description": "",
+                    "enabled": rng.random() < 0.95,
+                    "sender_ip": sender_ip,
+                    "sender_ip_cidr": sender_ip_cidr,
+                    "sender": rng.choice(SENDERS).replace(
+                        "%d", str(rng.randint(1, 99))
+                    ),
+                    "recipient": rng.choice(SENDERS).replace(
+                        "%d", str(rng.randint(1, 99))
+                    ),
+                    "header": rng.choice(HEADERS),
+                    "body": rng.choice(BODIES),
+                    "action":
+                        constants.REQ_ACTION_DENY
+                        if rng.random() < deny_ratio
+                        else constants.REQ_ACTION_ACCEPT
+                }
+            })
+
+        for position in range(rng.randint(1, actions)):
+
+            action_pk += 1
+
+            action = rng.choice((
+                constants.ACTION_ACTION_ADD,
+                constants.ACTION_ACTION_ADD,
+                constants.ACTION_ACTION_REPLACETAG,
+                constants.ACTION_ACTION_ADDPART
+            ))
+
+            fixture.append({
+                "model": "disclaimrwebadmin.action",
+                "pk": action_pk,
+                "fields": {
+                    "rule": rule_pk,
+                    "position": position,
+                    "name": "Action %d" % action_pk,
+                    "enabled": rng.random() < 0.95,
+                    "description": "",
+                    "action": action,
+                    "only_mime": rng.choice(MIME_TYPES),
+                    "action_parameters":
+                        "#DISCLAIMER#"
+                        if action == constants.ACTION_ACTION_REPLACETAG
+                        else "",
+                    "resolve_sender": False,
+                    "resolve_sender_fail": False,
+                    "disclaimer": rng.randint(1, disclaimers),
+                    "directory_servers": []
+                }
+            })
+
+    return fixture
+
+
+def main(argv=None):
+
+    """ Write a generated rule set
+
+    :param argv: The command line arguments
+    :return: The exit code
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic rule set as a Django fixture"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        required=True,
+        help="The fixture file to write"
+    )
+
+    parser.add_argument(
+        "--rules",
+        dest="rules",
+        type=int,
+        default=100,
+        help="Number of rules [100]"
+    )
+
+    parser.add_argument(
+        "--requirements",
+        dest="requirements",
+        type=int,
+        default=20,
+        help="Number of requirements per rule [20]"
+    )
+
+    parser.add_argument(
+        "--actions",
+        dest="actions",
+        type=int,
+        default=2,
+        help="Maximum number of actions per rule [2]"
+    )
+
+    parser.add_argument(
+        "--disclaimers",
+        dest="disclaimers",
+        type=int,
+        default=50,
+        help="Number of disclaimers [50]"
+    )
+
+    parser.add_argument(
+        "--match-ratio",
+        dest="match_ratio",
+        type=float,
+        default=0.05,
+        help="Share of requirements matching the benchmark clients [0.05]"
+    )
+
+    parser.add_argument(
+        "--match-network",
+        dest="match_network",
+        default="127.0.0.0/8",
+        help="Network of the benchmark clients [127.0.0.0/8]"
+    )
+
+    parser.add_argument(
+        "--deny-ratio",
+        dest="deny_ratio",
+        type=float,
+        default=0.1,
+        help="Share of requirements denying their rule [0.1]"
+    )
+
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=0,
+        help="Seed of the random generator [0]"
+    )
+
+    options = parser.parse_args(argv)
+
+    if "/" not in options.match_network:
+
+        parser.error("The network has to be in the form <ip>/<netmask>")
+
+    fixture = generate(
+        options.rules,
+        options.requirements,
+        options.actions,
+        options.disclaimers,
+        options.match_ratio,
+        tuple(options.match_network.split("/", 1)),
+        options.deny_ratio,
+        options.seed
+    )
+
+    with open(options.output, "w") as fixture_file:
+
+        json.dump(fixture, fixture_file, indent=1)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
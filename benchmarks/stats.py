@@ -0,0 +1,73 @@
+""" Statistics of benchmark measurements """
+import math
+
+
+def percentile(values, percent):
+
+    """ Return a percentile using the nearest rank
+
+    :param values: A sorted list of values
+    :param percent: The percentile
+    :return: The value or 0, if there are no values
+    """
+
+    if len(values) == 0:
+
+        return 0
+
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+
+    return values[max(rank, 1) - 1]
+
+
+def summarize(timings):
+
+    """ Summarize the durations of the stages
+
+    :param timings: A dictionary of stage names and lists of durations
+    :return: A dictionary of stage names and dictionaries with the count,
+        sum, mean, p50, p90, p99 and max in seconds
+    """
+
+    summary = {}
+
+    for stage, values in timings.items():
+
+        values = sorted(values)
+
+        total = sum(values)
+
+        summary[stage] = {
+            "count": len(values),
+            "sum": total,
+            "mean": total / len(values) if len(values) > 0 else 0,
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1] if len(values) > 0 else 0
+        }
+
+    return summary
+
+
+def print_stages(summary, stages, out):
+
+    """ Print a table of the stage summaries
+
+    :param summary: The summary as returned by summarize
+    :param stages: The stages to print in this order
+    :param out: The file to print to
+    """
+
+    out.write("%-10s %7s %10s %10s %10s %10s %10s\n" % (
+        "stage", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms"
+    ))
+
+    for stage in stages:
+
+        stats = summary[stage]
+
+        out.write("%-10s %7d %10.3f %10.3f %10.3f %10.3f %10.3f\n" % (
+            stage, stats["count"], stats["mean"] * 1000, stats["p50"] * 1000,
+            stats["p90"] * 1000, stats["p99"] * 1000, stats["max"] * 1000
+        ))
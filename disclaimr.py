@@ -2,30 +2,41 @@
 __version__ = 'v1.0-rc5'
 
 import argparse
+import cPickle
+import cProfile
+import multiprocessing
 import socket
-import ldap
 import os
 
 import libmilter as lm
 import signal
+import threading
+import time
 import traceback
 import sys
 import logging
 
-# Setup Django
-from disclaimr.query_cache import QueryCache
+# Setup Django. The milter settings leave out the web frontend.
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "disclaimrweb.settings")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "disclaimrweb.milter_settings")
 import django
 from django.db import connection
 django.setup()
 
-from disclaimr.configuration_helper import build_configuration
+from disclaimr.configuration_helper import build_configuration, preload
 from disclaimr.milter_helper import MilterHelper
-from disclaimr.logging_helper import queueFilter
+from disclaimr.mime_skeleton import LimitExceeded
+from disclaimr.logging_helper import set_queueid
+from disclaimr import metrics, milter_factory, profiling, snapshot
+from disclaimr.supervisor import Supervisor
 
 syslog = logging.getLogger('disclaimr')
 
+# libmilter only has a method sending the skip reply. Return it like the
+# other replies instead.
+
+SKIP = lm.pack_uint32(1) + lm.SMFIR_SKIP
+
 try:
     import systemd.daemon
     HAS_SYSTEMD_PYTHON = True
@@ -35,17 +46,59 @@ except ImportError:
                    "Consider installing systemd-python")
     HAS_SYSTEMD_PYTHON = False
 
-class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
+def get_protocol_options(stages):
+
+    """ Translate the needed milter stages of the configuration into
+    SMFIP-options, so the MTA doesn't send unneeded stages at all
+
+    :param stages: The stages dictionary of the configuration
+    :return: SMFIP-options for the milter
+    """
+
+    protos = 0
+
+    if not stages["helo"]:
+
+        protos |= lm.SMFIP_NOHELO
+
+    if not stages["envelope"]:
+
+        protos |= lm.SMFIP_NOMAIL | lm.SMFIP_NORCPT
+
+    if not stages["headers"]:
+
+        protos |= lm.SMFIP_NOHDRS
+
+    if not stages["eoh"]:
+
+        protos |= lm.SMFIP_NOEOH
+
+    if not stages["body"]:
+
+        protos |= lm.SMFIP_NOBODY
 
-    """ Disclaimr Milter
+    else:
+
+        # Let the MTA skip the rest of the body, once the mail won't be
+        # modified
+
+        protos |= lm.SMFIP_SKIP
+
+    return protos
 
-    This is the main milter thread for disclaimr based on
+
+class DisclaimrProtocol(lm.MilterProtocol):
+
+    """ Disclaimr Milter protocol
+
+    This is the main milter protocol for disclaimr based on
     libmilter.MiterProtocol. It will be given the options and a basic
     configuration set. During its workflow, it will narrow down the available
     requirements and disable itself, once no requirements are left, so
     that no unneccesary steps are taken.
 
-    Uses the MilterHelper to do the real work
+    Uses the MilterHelper to do the real work. The subclasses define, how
+    connections are run (see MILTER_MODES).
 
     """
 
@@ -58,12 +111,36 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
         :return: The milter
         """
 
+        # Skip the stages, that aren't needed by the configuration. The
+        # no-reply options are set by the callback decorators.
+
+        protos |= get_protocol_options(configuration["stages"])
+
         lm.MilterProtocol.__init__(self, opts, protos)
-        lm.ForkMixin.__init__(self)
-            
+
         self.helper = MilterHelper(configuration)
 
-        logging.debug("Initialising Milter Fork")
+        # The queue id of the current mail for logging
+
+        self.queue_id = ""
+
+        # The profile of the current mail, if it is profiled, and the number
+        # of mails of this connection
+
+        self.profile = None
+
+        self.mails = 0
+
+        # The profiles of the current mail collected by other processes (the
+        # pool of the async mode)
+
+        self.remote_profiles = []
+
+        # Wether a mail was started, whose summary wasn't logged yet
+
+        self.mail_active = False
+
+        logging.debug("Initialising Milter")
 
         # Test wherever the django database connection is still
         # usable and if not, close it too spawn a new connection
@@ -73,7 +150,63 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
                               "closing it now...")
                 connection.close()
             
-    @lm.noReply
+    def dataReceived(self, buf):
+
+        """ Called with data sent by the MTA. Sets the log context to the
+        current mail before the callbacks are called.
+
+        :param buf: The received data
+        """
+
+        set_queueid(self.queue_id)
+
+        if self.profile is not None:
+
+            self.profile.enable()
+
+        try:
+
+            lm.MilterProtocol.dataReceived(self, buf)
+
+        finally:
+
+            if self.profile is not None:
+
+                self.profile.disable()
+
+    def log_summary(self, decision):
+
+        """ Log the summary line of the current mail, if it wasn't logged yet
+
+        :param decision: The final decision about the mail
+        """
+
+        if self.mail_active:
+
+            syslog.info("%s", self.helper.summary(decision))
+
+            self.mail_active = False
+
+    def finish_profile(self):
+
+        """ Stop profiling the current mail, if it is profiled. If the
+        connection didn't send a mail, the request is left to the next one.
+        """
+
+        if self.profile is not None:
+
+            if self.mails == 0:
+
+                profiling.cancel(self.profile)
+
+            else:
+
+                profiling.finish(self.profile, self.remote_profiles)
+
+            self.profile = None
+
+        self.remote_profiles = []
+
     def connect(self, hostname, family, ip, port, cmd_dict):
 
         """ Called when a client connects to the milter
@@ -86,10 +219,22 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
         :return:
         """
 
-        logging.debug("CONNECT: %s, %s, %s, %s" % (hostname, family, ip, port))
+        logging.debug("CONNECT: %s, %s, %s, %s", hostname, family, ip, port)
+
+        # The first mail of the connection includes the connect
+
+        self.profile = profiling.start()
 
         self.helper.connect(hostname, family, ip, port, cmd_dict)
 
+        if not self.helper.enabled:
+
+            # No requirement matches this connection. Accept all of its mails
+            # without sending them to us.
+
+            logging.debug("Accepting connection since CONNECT didn't match...")
+            return lm.ACCEPT
+
         return lm.CONTINUE
 
     @lm.noReply
@@ -104,7 +249,7 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
             logging.debug("Ignoring HELO since CONNECT didn't match...")
             return lm.CONTINUE
         
-        logging.debug('HELO: %s' % heloname)
+        logging.debug('HELO: %s', heloname)
 
         return lm.CONTINUE
 
@@ -118,11 +263,33 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
         :return: A libmilter action
         """
 
+        # A new mail starts. Forget about the previous one.
+
+        self.log_summary("aborted")
+
+        if self.mails > 0:
+
+            self.finish_profile()
+
+            self.profile = profiling.start()
+
+        self.mails += 1
+
+        self.helper.reset()
+
+        # Sendmail and Postfix may already send the queue id
+
+        self.queue_id = cmd_dict.get("i", "")
+
+        set_queueid(self.queue_id)
+
+        self.mail_active = True
+
         if not self.helper.enabled:
             logging.debug("Ignoring MAIL-FROM since a previous rule didn't match...")
             return lm.CONTINUE
 
-        logging.debug("MAILFROM: %s" % addr)
+        logging.debug("MAILFROM: %s", addr)
 
         self.helper.mail_from(addr, cmd_dict)
 
@@ -143,7 +310,7 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
                           "so we skip all further RCPT checks.")
             return lm.CONTINUE
 
-        logging.debug("RCPT: %s" % recip)
+        logging.debug("RCPT: %s", recip)
 
         self.helper.rcpt(recip, cmd_dict)
 
@@ -164,32 +331,46 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
             logging.debug("Ignoring HEADER since a previous rule didn't match...")
             return lm.CONTINUE
 
-        logging.debug("HEADER: %s: %s" % (key, val))
+        logging.debug("HEADER: %s: %s", key, val)
+
+        if self.queue_id != cmd_dict.get("i", self.queue_id):
 
-        syslog.addFilter(queueFilter(cmd_dict["i"]))
+            # The queue id is known now
+
+            self.queue_id = cmd_dict["i"]
+
+            set_queueid(self.queue_id)
 
         self.helper.header(key, val, cmd_dict)
 
         return lm.CONTINUE
 
-    @lm.noReply
     def eoh(self, cmd_dict):
 
         """ Called, when all headers were sent
 
+        This is the last stage, where the requirements can stop matching
+        before the body is sent. Mails, that won't be modified, are accepted
+        here, so the MTA doesn't send their body to us.
+
         :param cmd_dict: A libmilter command dictionary
         :return: A libmilter action
         """
 
         if not self.helper.enabled:
-            logging.debug("Ignoring END-OF-HEADER since a previous rule didn't match...")
-            return lm.CONTINUE
+            logging.debug("Accepting mail since a previous rule didn't match...")
+            self.log_summary("accepted")
+            return lm.ACCEPT
 
         self.helper.eoh(cmd_dict)
 
+        if not self.helper.enabled:
+            logging.debug("Accepting mail since END-OF-HEADER didn't match...")
+            self.log_summary("accepted")
+            return lm.ACCEPT
+
         return lm.CONTINUE
 
-    @lm.noReply
     def body(self, chunk, cmd_dict):
 
         """ Called when a body chunk has been received
@@ -201,12 +382,35 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
 
         if not self.helper.enabled:
             logging.debug("Ignoring BODY since a previous rule didn't match...")
-            return lm.CONTINUE
+            return self.skip_body()
+
+        # Body chunks may be large, only log them if asked to
 
-        logging.debug("BODY: (chunk) %s" % chunk)
+        if options.log_body:
+            logging.debug("BODY: (chunk) %s", chunk)
 
         self.helper.body(chunk, cmd_dict)
 
+        if not self.helper.enabled:
+
+            # The mail is passed unmodified (e.g. inline PGP or a body
+            # larger than the limit)
+
+            return self.skip_body()
+
+        return lm.CONTINUE
+
+    def skip_body(self):
+
+        """ Tell the MTA not to send the rest of the body
+
+        :return: SKIP, if the MTA supports it, CONTINUE otherwise
+        """
+
+        if self.protos & lm.SMFIP_SKIP:
+
+            return SKIP
+
         return lm.CONTINUE
 
     def eob(self, cmd_dict):
@@ -219,19 +423,76 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
 
         if not self.helper.enabled:
             logging.debug("Ignoring END-OF-BODY since a previous rule didn't match...")
+            self.log_summary("unmodified")
             return lm.CONTINUE
 
         logging.debug("ENDOFBODY: Processing actions...")
 
-        tasks = self.helper.eob(cmd_dict)
+        return self.modify(self.helper.eob(cmd_dict))
+
+    def modify(self, tasks):
+
+        """ Send the modifications of the mail to the MTA. Used by eob.
+
+        :param tasks: The modification tasks returned by the helper or None,
+            if the mail isn't modified
+        :return: A libmilter action
+        """
+
+        if tasks is None:
+
+            # The helper decided not to modify the mail
+
+            self.log_summary("unmodified")
+
+            return lm.CONTINUE
+
+        # The new body is only built while it is sent
+
+        start = time.time()
 
         for task_item in tasks.keys():
 
             if task_item == "repl_body":
 
-                # Change body
+                # Change body. The new body is generated chunk by chunk
+                # while it is sent to the MTA.
+
+                sent = False
+
+                try:
+
+                    for chunk in tasks[task_item]:
+
+                        self.replBody(chunk)
+
+                        sent = True
+
+                except LimitExceeded, e:
+
+                    if sent:
+
+                        # The MTA already has a part of the new body. Let
+                        # it retry the mail instead of passing a broken one.
+
+                        syslog.error("%s. Deferring the partly replaced "
+                                     "mail.", e)
+
+                        self.helper.stats["reason"] = "limit"
 
-                self.replBody(tasks[task_item])
+                        self.log_summary("deferred")
+
+                        return lm.TEMPFAIL
+
+                    # Fail open
+
+                    syslog.warning("%s. Passing mail unmodified.", e)
+
+                    self.helper.disable("limit")
+
+                    self.log_summary("unmodified")
+
+                    return lm.CONTINUE
 
             elif task_item == "add_header":
 
@@ -257,144 +518,947 @@ class DisclaimrMilter(lm.ForkMixin, lm.MilterProtocol):
 
                     self.chgHeader(header, "")
 
+        self.helper.add_time("eob", time.time() - start)
+
+        self.log_summary("modified" if len(tasks) > 0 else "unmodified")
+
         return lm.CONTINUE
 
+    def abort(self):
+
+        """ Called, when the MTA aborts the current mail
+        """
+
+        self.log_summary("aborted")
+
+        # Release the buffers of the mail
+
+        self.helper.reset()
+
+        self.queue_id = ""
+
+        set_queueid()
+
+        self.finish_profile()
+
     def close(self):
 
         """ Called, when a connection with a client is closed
         """
 
-        logging.debug("Close called. QID: %s" % self._qid)
+        logging.debug("Close called. QID: %s", self._qid)
 
-        # If we still have a queue id on disconnect
-        # something went fu will processing the mail
-        if self._qid:
-            syslog.error("Message could not be processed! Traceback follows..."
-                         " If you found a bug make sure too report it at https://github.com/dploeger/disclaimr")
-            
-            traceback.print_tb(sys.exc_traceback)
+        try:
 
-def run_disclaimr_milter():
-    
-    """ Start the multiforking milter daemon
+            # If we still have a queue id on disconnect
+            # something went fu will processing the mail
+            if self._qid:
+                syslog.error("Message could not be processed! Traceback follows..."
+                             " If you found a bug make sure too report it at https://github.com/dploeger/disclaimr")
+
+                traceback.print_tb(sys.exc_traceback)
+
+        finally:
+
+            self.log_summary("aborted")
+
+            # Don't log the queue id of this connection anymore
+
+            set_queueid()
+
+            self.finish_profile()
+
+            metrics.flush()
+
+
+class DisclaimrMilter(lm.ForkMixin, DisclaimrProtocol):
+
+    """ Disclaimr Milter, that forks a process for every connection
     """
-    
-    # Set milter options
-    opts = \
-        lm.SMFIF_CHGBODY | \
-        lm.SMFIF_ADDHDRS | \
-        lm.SMFIF_CHGHDRS
- 
-    # Initialize Factory
-    f = lm.ForkFactory(options.socket, DisclaimrMilter, opts)
 
-    # Register signal handler for killing
+    def run(self):
 
-    def signal_handler(num, frame):
-        
-        logging.debug("Recieved signal %s" % num)
-        
-        syslog.info("Stopping disclaimr %s listening on %s" % (__version__, options.socket))
-        
-        f.close()
-        sys.exit(0)
+        """ Handle the connection in the forked process
+        """
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+        # A signal would interrupt receiving from the MTA and drop the
+        # connection. Profiling is requested at the listening process.
 
-    syslog.info("Starting disclaimr %s listening on %s" % (__version__, options.socket))
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
-    # Run
-    
-    try:
-        # Check for systemd support and, if available,
-        # report that we are ready to accpet connections
-        logging.debug("HAS_SYSTEMD_PYTHON: %s" % HAS_SYSTEMD_PYTHON)
-        if HAS_SYSTEMD_PYTHON and systemd.daemon.booted():
-            logging.debug("Reporting too systemd that we are ready...")
-            systemd.daemon.notify('READY=1')
+        metrics.after_fork()
 
-        f.run()
+        profiling.after_fork()
 
-    except Exception , e:
-        
-        # Exception occured. Stop everything and show it.
-        
-        f.close()
-        
-        print >> sys.stderr , 'EXCEPTION OCCURED: %s' % e
-        
-        traceback.print_tb(sys.exc_traceback)
-        
-        sys.exit(3)
+        lm.ForkMixin.run(self)
 
-if __name__ == '__main__':
 
-    # Argument handling
+class ThreadDisclaimrMilter(lm.ThreadMixin, DisclaimrProtocol):
 
-    parser = argparse.ArgumentParser(
-        description="Disclaimr - Mail disclaimer server. Starts a "
-                    "milter daemon, that adds dynamic disclaimers to messages"
-    )
+    """ Disclaimr Milter, that handles every connection in a thread
 
-    parser.add_argument(
-        "-s",
-        "--socket",
-        dest="socket",
-        default="inet:127.0.0.1:5000",
-        help="Socket to open. IP-Sockets need to be in the form "
-             "inet:<ip>:<port> [inet:127.0.0.1:5000]"
-    )
+    The number of threads is limited by connection_slots. The factory takes
+    a slot, before it accepts a connection, and the thread releases it, when
+    the connection is closed.
+    """
 
-    parser.add_argument(
-        "-q",
-        "--quiet",
-        dest="quiet",
-        action="store_true",
-        help="Be quiet doing things"
-    )
+    def __init__(self, opts=0, protos=0):
 
-    parser.add_argument(
-        "-d",
-        "--debug",
-        dest="debug",
-        action="store_true",
-        help="Enable debug logging"
-    )
+        """ Initialize the milter
 
-    parser.add_argument(
-        "-i",
-        "--ignore-cert",
-        dest="ignore_cert",
-        action="store_true",
-        help="Ignore certificates when connecting to "
-             "tls-enabled directory servers"
-    )
+        :param opts: SMFIF-options for this milter
+        :param protos: SMFIP-options for this milter
+        :return: The milter
+        """
 
-    options = parser.parse_args()
+        lm.ThreadMixin.__init__(self)
 
-    if options.quiet and options.debug:
-        parser.error("Cannot specify debug and quiet at the same time.")
+        DisclaimrProtocol.__init__(self, opts, protos)
 
-    # Setup logging
+    def run(self):
 
-    if options.quiet:
-        logging.basicConfig(level=logging.ERROR)
-    elif options.debug:
-        # debug logging should have a timestamp
-        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
-    else:
-        logging.basicConfig(level=logging.INFO)
+        """ Handle the connection
+        """
 
-    if options.ignore_cert:
+        try:
 
-        ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+            lm.ThreadMixin.run(self)
 
-    # Fetch basic configuration data for efficiency
+        finally:
 
-    logging.debug("Generating basic configuration")
+            # Every thread has its own database connection
 
-    configuration = build_configuration()
+            connection.close()
 
-    # Run Disclaimr
-    run_disclaimr_milter()
\ No newline at end of file
+            connection_slots.release()
+
+
+class AsyncDisclaimrMilter(DisclaimrProtocol):
+
+    """ Disclaimr Milter for the asynchronous mode
+
+    All connections are handled by one event loop. Only the end of the body,
+    which carries out the actions and may query directory servers, is run
+    in the process pool, so the event loop isn't blocked by it and the mails
+    are rewritten on all cores. The replies are sent by the event loop.
+    """
+
+    def __init__(self, opts=0, protos=0):
+
+        """ Initialize the milter
+
+        :param opts: SMFIF-options for this milter
+        :param protos: SMFIP-options for this milter
+        :return: The milter
+        """
+
+        DisclaimrProtocol.__init__(self, opts, protos)
+
+        # The factory running the event loop. It's set, when the connection
+        # is accepted.
+
+        self.factory = None
+
+        # The end of the body processed in the pool. The result is dropped,
+        # if the mail is aborted or the connection closed meanwhile.
+
+        self.pending_eob = None
+
+    def eob(self, cmd_dict):
+
+        """ Called when all body chunks have been received. Runs the actions
+        in the process pool. The reply is sent by finish_eob.
+
+        :param cmd_dict: A libmilter command dictionary
+        :return: A libmilter Deferred
+        """
+
+        if not self.helper.enabled:
+
+            return DisclaimrProtocol.eob(self, cmd_dict)
+
+        logging.debug("ENDOFBODY: Processing actions in the pool...")
+
+        pending_eob = object()
+
+        self.pending_eob = pending_eob
+
+        # Pickle the helper now. The event loop may change it, before the
+        # pool sends it to a process.
+
+        worker_pool.apply_async(
+            process_eob,
+            (
+                cPickle.dumps(self.helper, cPickle.HIGHEST_PROTOCOL),
+                cmd_dict,
+                self.queue_id,
+                self.profile is not None
+            ),
+            callback=lambda result: self.factory.call_in_loop(
+                self.finish_eob, pending_eob, result
+            )
+        )
+
+        return lm.Deferred()
+
+    def finish_eob(self, pending_eob, result):
+
+        """ Send the modifications and the reply to the MTA in the event loop
+
+        :param pending_eob: The end of the body, the result belongs to
+        :param result: The pickled result of process_eob
+        """
+
+        if pending_eob is not self.pending_eob:
+
+            logging.debug("Dropping the result of an aborted mail")
+
+            return
+
+        self.pending_eob = None
+
+        try:
+
+            (helper, tasks, failed, profile_stats) = cPickle.loads(result)
+
+        except Exception, e:
+
+            syslog.error("Cannot read the processed mail: %s", e)
+
+            (helper, tasks, failed, profile_stats) = (None, None, True, None)
+
+        if helper is not None:
+
+            # The helper comes back with the statistics of the mail
+
+            helper.configuration = self.helper.configuration
+
+            self.helper = helper
+
+        if profile_stats is not None:
+
+            self.remote_profiles.append(profiling.RemoteProfile(profile_stats))
+
+        set_queueid(self.queue_id)
+
+        if failed:
+
+            self.log_summary("error")
+
+            reply = lm.CONTINUE
+
+        else:
+
+            try:
+
+                reply = self.modify(tasks)
+
+            except Exception, e:
+
+                syslog.error("Error sending the modifications: %s", e)
+
+                self.log_summary("error")
+
+                reply = lm.CONTINUE
+
+        self.send(reply)
+
+    def abort(self):
+
+        """ Called, when the MTA aborts the current mail
+        """
+
+        self.pending_eob = None
+
+        DisclaimrProtocol.abort(self)
+
+    def close(self):
+
+        """ Called, when a connection with a client is closed
+        """
+
+        self.pending_eob = None
+
+        DisclaimrProtocol.close(self)
+
+
+def start_pool_process():
+
+    """ Prepare a process of the worker pool. The event loop handles the
+    signals.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    metrics.after_fork()
+
+
+def start_worker_pool():
+
+    """ Start the process pool of the async mode. The processes are forked
+    with the current configuration.
+
+    :return: The pool
+    """
+
+    return multiprocessing.Pool(options.threads, start_pool_process)
+
+
+def process_eob(state, cmd_dict, queue_id, profiled):
+
+    """ Process the end of the body in a process of the worker pool
+
+    The pool only calls back with a result, so this always returns one,
+    even if processing the mail or pickling the result fails. Otherwise,
+    the MTA would wait for the reply forever.
+
+    :param state: The pickled helper of the connection
+    :param cmd_dict: A libmilter command dictionary
+    :param queue_id: The queue id of the mail for logging
+    :param profiled: Wether the mail is profiled
+    :return: The pickled result of run_eob. If it failed, a result without
+        helper and tasks, that says so.
+    """
+
+    set_queueid(queue_id)
+
+    try:
+
+        return cPickle.dumps(
+            run_eob(state, cmd_dict, profiled), cPickle.HIGHEST_PROTOCOL
+        )
+
+    except Exception, e:
+
+        syslog.error("Error processing the mail: %s. "
+                     "Passing it unmodified.", e)
+
+        return cPickle.dumps((None, None, True, None))
+
+    finally:
+
+        set_queueid()
+
+        metrics.flush()
+
+
+def run_eob(state, cmd_dict, profiled):
+
+    """ Carry out the actions on a mail. Used by process_eob.
+
+    :param state: The pickled helper of the connection
+    :param cmd_dict: A libmilter command dictionary
+    :param profiled: Wether the mail is profiled
+    :return: A tuple of the helper with the statistics of the mail, the
+        modification tasks with the new body as a list of chunks (or None,
+        if the mail isn't modified), wether processing failed and the stats
+        of the profile (or None, if the mail isn't profiled)
+    """
+
+    profile = None
+
+    if profiled:
+
+        profile = cProfile.Profile()
+
+        profile.enable()
+
+    helper = cPickle.loads(state)
+
+    helper.configuration = configuration
+
+    failed = False
+
+    try:
+
+        tasks = helper.eob(cmd_dict)
+
+        if tasks is not None and "repl_body" in tasks:
+
+            # Build the new body here instead of while it is sent
+
+            start = time.time()
+
+            tasks["repl_body"] = list(tasks["repl_body"])
+
+            helper.add_time("eob", time.time() - start)
+
+    except LimitExceeded, e:
+
+        # Fail open
+
+        syslog.warning("%s. Passing mail unmodified.", e)
+
+        helper.disable("limit")
+
+        tasks = None
+
+    except Exception, e:
+
+        syslog.error("Error processing the mail: %s. "
+                     "Passing it unmodified.", e)
+
+        tasks = None
+
+        failed = True
+
+    profile_stats = None
+
+    if profile is not None:
+
+        profile.disable()
+
+        profile.create_stats()
+
+        profile_stats = profile.stats
+
+    return (helper, tasks, failed, profile_stats)
+
+
+# The supported milter modes with their libmilter factory and milter class
+
+MILTER_MODES = {
+    "fork": (milter_factory.ForkFactory, DisclaimrMilter),
+    "threads": (milter_factory.ThreadFactory, ThreadDisclaimrMilter),
+    "async": (milter_factory.AsyncFactory, AsyncDisclaimrMilter)
+}
+
+# Worker processes used by the async mode
+
+worker_pool = None
+
+# Limits the connection threads of the threads mode
+
+connection_slots = None
+
+
+def load_configuration():
+
+    """ Build the configuration from the snapshot file or the database
+
+    The database connection is closed afterwards. The milter doesn't need it
+    to process the mails. If processes are forked, the configuration is
+    preloaded for them.
+
+    :return: The configuration dictionary
+    """
+
+    rule_snapshot = None
+
+    if options.snapshot is not None:
+
+        rule_snapshot = snapshot.read(options.snapshot)
+
+    try:
+
+        new_configuration = build_configuration(
+            options.encrypted_policy,
+            {
+                "body_size": options.max_body_size,
+                "parts": options.max_parts,
+                "depth": options.max_depth,
+                "time": options.max_time
+            },
+            rule_snapshot
+        )
+
+    finally:
+
+        connection.close()
+
+    # Share the configuration with the forked processes
+
+    if options.mode in ("fork", "async") or options.workers > 0:
+
+        preload(new_configuration)
+
+    return new_configuration
+
+
+def reload_configuration(num, frame):
+
+    """ Reload the configuration on SIGHUP. Connections, that are already
+    open, keep the old one. If the configuration can't be loaded, the old one
+    is kept as well.
+    """
+
+    global configuration, worker_pool
+
+    try:
+
+        configuration = load_configuration()
+
+    except Exception, e:
+
+        syslog.error("Cannot reload the configuration, keeping the old "
+                     "one: %s", e)
+
+        return
+
+    if worker_pool is not None:
+
+        # The processes of the pool keep the configuration, they were forked
+        # with. The old ones finish their mails and exit.
+
+        old_pool = worker_pool
+
+        worker_pool = start_worker_pool()
+
+        old_pool.close()
+
+    syslog.info("Reloaded the configuration")
+
+
+def reload_workers(supervisor):
+
+    """ Reload the configuration of the supervisor and its workers on
+    SIGHUP. Workers, that are restarted later, are forked with the new
+    configuration.
+
+    :param supervisor: The supervisor of the workers
+    """
+
+    reload_configuration(signal.SIGHUP, None)
+
+    supervisor.send_signal(signal.SIGHUP)
+
+
+def run_disclaimr_milter(listener=None, worker=None):
+    
+    """ Start the milter daemon in the configured mode
+
+    :param listener: A listening socket to use instead of creating one
+    :param worker: The index of the worker, if run by the supervisor
+    """
+
+    global worker_pool, connection_slots
+
+    # Set milter options
+    opts = \
+        lm.SMFIF_CHGBODY | \
+        lm.SMFIF_ADDHDRS | \
+        lm.SMFIF_CHGHDRS
+
+    (factory, milter) = MILTER_MODES[options.mode]
+
+    if worker is not None:
+
+        metrics.after_fork()
+
+    elif options.metrics is not None:
+
+        metrics.start(options.metrics)
+
+    if options.mode == "async":
+
+        worker_pool = start_worker_pool()
+
+    elif options.mode == "threads":
+
+        connection_slots = threading.BoundedSemaphore(options.threads)
+
+    else:
+
+        # The connection processes take the mails to profile from the
+        # listening process
+
+        profiling.share()
+
+    # Initialize Factory
+    f = factory(options.socket, milter, opts)
+
+    f.listener = listener
+    f.reuse_port = worker is not None and listener is None
+
+    if options.mode == "threads":
+
+        f.slots = connection_slots
+
+    # Register signal handler for killing
+
+    def signal_handler(num, frame):
+        
+        logging.debug("Recieved signal %s", num)
+        
+        syslog.info("Stopping disclaimr %s listening on %s", __version__, options.socket)
+
+        if worker_pool is not None:
+            worker_pool.terminate()
+        
+        f.close()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # Profile the next mails or dump the stacks on request
+
+    signal.signal(signal.SIGUSR1, lambda num, frame: profiling.request())
+    signal.signal(signal.SIGUSR2, lambda num, frame: profiling.write_dump())
+
+    signal.signal(signal.SIGHUP, reload_configuration)
+
+    if options.profile:
+
+        profiling.request()
+
+    if worker is None:
+
+        syslog.info(
+            "Starting disclaimr %s listening on %s (%s mode)",
+            __version__, options.socket, options.mode
+        )
+
+    else:
+
+        syslog.info("Starting worker %d", worker)
+
+    # Run
+    
+    try:
+        # Check for systemd support and, if available,
+        # report that we are ready to accpet connections
+        logging.debug("HAS_SYSTEMD_PYTHON: %s", HAS_SYSTEMD_PYTHON)
+        if worker is None and HAS_SYSTEMD_PYTHON and systemd.daemon.booted():
+            logging.debug("Reporting too systemd that we are ready...")
+            systemd.daemon.notify('READY=1')
+
+        f.run()
+
+    except Exception , e:
+        
+        # Exception occured. Stop everything and show it.
+        
+        f.close()
+        
+        print >> sys.stderr , 'EXCEPTION OCCURED: %s' % e
+        
+        traceback.print_tb(sys.exc_traceback)
+        
+        sys.exit(3)
+
+
+def run_disclaimr_supervisor():
+
+    """ Start the configured number of milter workers on the same socket and
+    restart them, if they die
+    """
+
+    listener = None
+
+    if options.socket.lower().startswith("inet:") \
+            and milter_factory.SO_REUSEPORT is not None:
+
+        # Every worker binds its own socket and the kernel spreads the
+        # connections evenly
+
+        logging.debug("Using SO_REUSEPORT for the workers")
+
+    else:
+
+        # Share one socket between the workers
+
+        listener = milter_factory.create_listener(options.socket)
+
+    # Don't share the database connection with the workers
+
+    connection.close()
+
+    # The workers send their metrics to the supervisor
+
+    if options.metrics is not None:
+
+        metrics.start(options.metrics)
+
+    supervisor = Supervisor(
+        options.workers,
+        lambda worker: run_disclaimr_milter(listener, worker)
+    )
+
+    def signal_handler(num, frame):
+
+        logging.debug("Recieved signal %s", num)
+
+        syslog.info("Stopping disclaimr %s listening on %s", __version__, options.socket)
+
+        supervisor.stop(num)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # Let the workers profile, dump their stacks or reload the configuration
+
+    signal.signal(
+        signal.SIGUSR1, lambda num, frame: supervisor.send_signal(num)
+    )
+    signal.signal(
+        signal.SIGUSR2, lambda num, frame: supervisor.send_signal(num)
+    )
+    signal.signal(
+        signal.SIGHUP, lambda num, frame: reload_workers(supervisor)
+    )
+
+    syslog.info(
+        "Starting disclaimr %s listening on %s (%s mode, %d workers)",
+        __version__, options.socket, options.mode, options.workers
+    )
+
+    if HAS_SYSTEMD_PYTHON and systemd.daemon.booted():
+        logging.debug("Reporting too systemd that we are ready...")
+        systemd.daemon.notify('READY=1')
+
+    supervisor.run()
+
+
+def worker_count(value):
+
+    """ Parse the number of workers
+
+    :param value: A number or "auto" to use one worker per core
+    :return: The number of workers
+    """
+
+    if value == "auto":
+
+        return multiprocessing.cpu_count()
+
+    return int(value)
+
+if __name__ == '__main__':
+
+    # Argument handling
+
+    parser = argparse.ArgumentParser(
+        description="Disclaimr - Mail disclaimer server. Starts a "
+                    "milter daemon, that adds dynamic disclaimers to messages"
+    )
+
+    parser.add_argument(
+        "-s",
+        "--socket",
+        dest="socket",
+        default="inet:127.0.0.1:5000",
+        help="Socket to open. IP-Sockets need to be in the form "
+             "inet:<ip>:<port> [inet:127.0.0.1:5000]"
+    )
+
+    parser.add_argument(
+        "-m",
+        "--mode",
+        dest="mode",
+        choices=sorted(MILTER_MODES.keys()),
+        default="fork",
+        help="How to handle connections. \"fork\" forks a process for "
+             "every connection, \"threads\" handles every connection in a "
+             "thread, \"async\" handles all connections in one "
+             "event loop and processes the mails in worker processes [fork]"
+    )
+
+    parser.add_argument(
+        "-t",
+        "--threads",
+        dest="threads",
+        type=int,
+        help="In threads mode, the number of connections handled at the "
+             "same time [32]. In async mode, the number of worker processes "
+             "[number of cores]"
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=worker_count,
+        default=0,
+        help="Number of worker processes sharing the socket. \"auto\" "
+             "starts one worker per core. With 0, the milter runs without "
+             "a supervisor [0]"
+    )
+
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        default=None,
+        help="Serve metrics in the Prometheus text format on "
+             "http://<ip>:<port>/metrics, e.g. 127.0.0.1:9150. The metrics "
+             "of all workers are summed up [disabled]"
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Profile the first mails after the start. SIGUSR1 profiles the "
+             "next mails at any time, SIGUSR2 dumps the stacks and memory "
+             "usage"
+    )
+
+    parser.add_argument(
+        "--profile-mails",
+        dest="profile_mails",
+        type=int,
+        default=100,
+        help="Number of mails profiled per request. Their summed up stats "
+             "are written to the profile directory [100]"
+    )
+
+    parser.add_argument(
+        "--profile-dir",
+        dest="profile_dir",
+        default=profiling.directory,
+        help="Directory to write the profiles and stack dumps to [%s]"
+             % profiling.directory
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        dest="snapshot",
+        default=None,
+        help="Load the rules from a snapshot file written by "
+             "\"manage.py export_snapshot\" instead of the database. "
+             "SIGHUP reloads it [disabled]"
+    )
+
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        dest="quiet",
+        action="store_true",
+        help="Be quiet doing things"
+    )
+
+    parser.add_argument(
+        "-d",
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Enable debug logging"
+    )
+
+    parser.add_argument(
+        "--log-body",
+        dest="log_body",
+        action="store_true",
+        help="Log the body chunks of the mails. Needs --debug"
+    )
+
+    parser.add_argument(
+        "-i",
+        "--ignore-cert",
+        dest="ignore_cert",
+        action="store_true",
+        help="Ignore certificates when connecting to "
+             "tls-enabled directory servers"
+    )
+
+    parser.add_argument(
+        "-e",
+        "--encrypted-policy",
+        dest="encrypted_policy",
+        choices=["process", "accept"],
+        default="process",
+        help="What to do with signed or encrypted mails (S/MIME, PGP). "
+             "\"accept\" passes them unmodified without "
+             "buffering their body [process]"
+    )
+
+    parser.add_argument(
+        "--max-body-size",
+        dest="max_body_size",
+        type=int,
+        default=0,
+        help="Pass mails with a larger body (in bytes) unmodified. "
+             "0 means no limit [0]"
+    )
+
+    parser.add_argument(
+        "--max-parts",
+        dest="max_parts",
+        type=int,
+        default=0,
+        help="Pass mails with more mime parts unmodified. "
+             "0 means no limit [0]"
+    )
+
+    parser.add_argument(
+        "--max-depth",
+        dest="max_depth",
+        type=int,
+        default=0,
+        help="Pass mails with deeper nested mime parts unmodified. "
+             "0 means no limit [0]"
+    )
+
+    parser.add_argument(
+        "--max-time",
+        dest="max_time",
+        type=float,
+        default=0,
+        help="Pass mails unmodified, if processing them takes longer "
+             "(in seconds). 0 means no limit [0]"
+    )
+
+    options = parser.parse_args()
+
+    if options.quiet and options.debug:
+        parser.error("Cannot specify debug and quiet at the same time.")
+
+    if options.log_body and not options.debug:
+        parser.error("--log-body needs --debug.")
+
+    # Setup logging
+
+    if options.quiet:
+        logging.basicConfig(level=logging.ERROR)
+    elif options.debug:
+        # debug logging should have a timestamp
+        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if options.threads is None:
+
+        # The async mode rewrites the mails in a process per core
+
+        if options.mode == "async":
+
+            options.threads = multiprocessing.cpu_count()
+
+        else:
+
+            options.threads = 32
+
+    profiling.directory = options.profile_dir
+    profiling.count = options.profile_mails
+
+    if options.ignore_cert:
+
+        import ldap
+
+        ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+
+    # Load the rules once. SIGHUP reloads them.
+
+    logging.debug("Generating basic configuration")
+
+    try:
+
+        configuration = load_configuration()
+
+    except snapshot.SnapshotError, e:
+
+        print >> sys.stderr, e
+
+        sys.exit(1)
+
+    # Run Disclaimr
+    if options.workers > 0:
+        run_disclaimr_supervisor()
+    else:
+        run_disclaimr_milter()
\ No newline at end of file
@@ -1,43 +1,178 @@
 """ Functions to help with building the milter configuration """
 
-from disclaimrwebadmin import models
+import fnmatch
+import gc
+import re
+from disclaimr import snapshot
 
 
-def build_configuration():
+def compile_mime_filter(only_mime):
+
+    """ Compile the mime type filter of an action
+
+    The filter may hold multiple mime types separated by commas. Wildcards
+    like text/* are allowed.
+
+    :param only_mime: The only_mime value of an action
+    :return: A compiled regular expression or None, if the action isn't
+        restricted to any mime type
+    """
+
+    mime_types = [
+        mime_type.strip().lower()
+        for mime_type in only_mime.split(",")
+        if mime_type.strip() != ""
+    ]
+
+    if len(mime_types) == 0:
+
+        return None
+
+    return re.compile(
+        "|".join(fnmatch.translate(mime_type) for mime_type in mime_types)
+    )
+
+
+def build_configuration(encrypted_policy="process", limits=None,
+                        rule_snapshot=None):
+
+    """ Build the milter configuration from the database or a snapshot
+
+    :param encrypted_policy: What to do with signed or encrypted mails.
+        "process" handles them like all other mails, "accept" passes them
+        unmodified.
+    :param limits: A dictionary overriding the processing limits of a mail:
+        "body_size" (bytes), "parts", "depth" and "time" (seconds). 0 means
+        no limit.
+    :param rule_snapshot: A snapshot dictionary (see disclaimr.snapshot) to
+        use instead of the database
+    :return: The configuration dictionary
+    """
+
+    if rule_snapshot is None:
+
+        rule_snapshot = snapshot.export()
+
+    records = snapshot.build_records(rule_snapshot)
 
     configuration = {
-        "sender_ip": []
+        "sender_ip": [],
+        "requirements": records["requirements"],
+        "rules": records["rules"],
+        "mime_filter": {},
+        "encrypted_policy": encrypted_policy,
+        "limits": {
+            "body_size": 0,
+            "parts": 0,
+            "depth": 0,
+            "time": 0
+        },
+        "stages": {
+            "helo": False,
+            "envelope": False,
+            "headers": False,
+            "eoh": False,
+            "body": False
+        }
     }
 
+    if limits is not None:
+
+        configuration["limits"].update(limits)
+
     # Fetch the sender_ip networks of all enabled requirements, that have at
     # least one enabled action in their associated rule
 
-    for requirement in models.Requirement.objects.all():
+    import netaddr
 
-        if requirement.enabled:
+    for requirement_id in sorted(records["requirements"]):
 
-            # Check, if all associated actions are enabled
+        requirement = records["requirements"][requirement_id]
 
-            enabled_actions = requirement.rule.action_set.count()
+        if requirement.enabled and len(requirement.rule.actions) > 0:
 
-            for test_action in requirement.rule.action_set.all():
+            # There are some enabled actions. Store the network as a range of
+            # integers, that is cheaper to check and to share than a netaddr
+            # object.
 
-                if not test_action.enabled:
+            network = netaddr.IPNetwork("%s/%s" % (
+                requirement.sender_ip, requirement.sender_ip_cidr
+            ))
 
-                    enabled_actions -= 1
+            configuration["sender_ip"].append((
+                network.version, network.first, network.last, requirement.id
+            ))
 
-            if enabled_actions > 0:
+            # The end of the headers is only needed, if a requirement
+            # can stop matching after the connect. It is used to check
+            # the header requirements and to accept non-matching mails
+            # before their body is sent.
 
-                # There are some enabled actions.
+            if requirement.sender.pattern != ".*" \
+                    or requirement.recipient.pattern != ".*" \
+                    or requirement.header.pattern != ".*":
 
-                configuration["sender_ip"].append({
+                configuration["stages"]["eoh"] = True
 
-                    "ip": requirement.get_sender_ip_network(),
-                    "id": requirement.id
+    # The milter stages needed by the requirements and actions. The HELO is
+    # never used. Envelope, headers and body are needed to run the actions,
+    # if any requirement can match at all.
 
-                })
+    if len(configuration["sender_ip"]) > 0:
+
+        configuration["stages"]["envelope"] = True
+        configuration["stages"]["headers"] = True
+        configuration["stages"]["body"] = True
+
+        # Signed or encrypted mails are detected at the end of the headers
+
+        if encrypted_policy == "accept":
+
+            configuration["stages"]["eoh"] = True
+
+    # Precompile the mime type filters of all enabled actions
+
+    for rule in records["rules"].values():
+
+        for action in rule.actions:
+
+            configuration["mime_filter"][action.id] = compile_mime_filter(
+                action.only_mime
+            )
 
     return configuration
 
 
+def preload(configuration):
+
+    """ Prepare the configuration for the processes forked from the current
+    process
+
+    The modules needed by the actions are imported once instead of in every
+    forked process. Then, a garbage collection moves the configuration to
+    the oldest generation. Python 2 has no gc.freeze, but the collections of
+    the younger generations in the forked processes won't visit (and copy)
+    its objects then, and a full collection only runs after a quarter of
+    the collected objects was added.
+
+    :param configuration: The configuration dictionary
+    """
+
+    # HTML disclaimers are inserted with lxml
+
+    if any(
+        mime_filter is None or mime_filter.match("text/html")
+        for mime_filter in configuration["mime_filter"].values()
+    ):
+
+        import lxml.etree
+
+    if any(
+        action.resolve_sender
+        for rule in configuration["rules"].values()
+        for action in rule.actions
+    ):
+
+        import ldap
 
+    gc.collect()
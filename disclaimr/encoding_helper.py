@@ -0,0 +1,142 @@
+""" Functions to help with appending text to transfer-encoded mail payloads
+
+Appending a disclaimer to a base64 or quoted-printable payload doesn't
+require decoding and re-encoding the whole payload. Only the last encoded
+line has to be decoded, extended and encoded again. Everything before that
+line is reused as it is.
+"""
+
+import base64
+import quopri
+
+
+def _find_tail(payload):
+
+    """ Find the last encoded line of a payload
+
+    :param payload: The encoded payload
+    :return: A tuple of the start and the end of the last line. The end
+        excludes trailing line breaks.
+    """
+
+    end = len(payload)
+
+    while end > 0 and payload[end - 1] in "\r\n":
+
+        end -= 1
+
+    start = payload.rfind("\n", 0, end) + 1
+
+    return start, end
+
+
+def _line_ending(payload, start):
+
+    """ Return the line ending used before the given position of a payload
+
+    :param payload: The encoded payload
+    :param start: The start of the last line of the payload
+    :return: The line ending used in the payload
+    """
+
+    if payload[max(start - 2, 0):start] == "\r\n":
+
+        return "\r\n"
+
+    return "\n"
+
+
+def append_base64(payload, text):
+
+    """ Append text to a base64-encoded payload
+
+    The last line of the payload holds the last (possibly incomplete)
+    quantum. It is decoded, the text is added and the result is encoded
+    again using the same line length as email.encoders.encode_base64.
+
+    :param payload: The base64-encoded payload
+    :param text: The (not encoded) text to append
+    :return: The new base64-encoded payload or None, if the payload's
+        layout doesn't allow appending (the caller has to re-encode the
+        complete payload then)
+    """
+
+    start, end = _find_tail(payload)
+
+    last_line = payload[start:end].strip()
+
+    if len(last_line) % 4 != 0:
+
+        # Not aligned to base64 quanta.
+
+        return None
+
+    if start > 0:
+
+        # The line before has to hold complete quanta without padding,
+        # otherwise the payload can't be extended at the end
+
+        prev_start, prev_end = _find_tail(payload[:start])
+
+        prev_line = payload[prev_start:prev_end].strip()
+
+        if len(prev_line) % 4 != 0 or "=" in prev_line:
+
+            return None
+
+    try:
+
+        tail = base64.b64decode(last_line)
+
+    except TypeError:
+
+        return None
+
+    new_tail = base64.encodestring(tail + text)
+
+    line_ending = _line_ending(payload, start)
+
+    if line_ending != "\n":
+
+        new_tail = new_tail.replace("\n", line_ending)
+
+    # Keep the payload ending the way it was
+
+    if end == len(payload):
+
+        new_tail = new_tail[:-len(line_ending)]
+
+    return "%s%s" % (payload[:start], new_tail)
+
+
+def append_quoted_printable(payload, text):
+
+    """ Append text to a quoted-printable-encoded payload
+
+    The last line of the payload is decoded, the text is added and the result
+    is encoded again the same way as email.encoders.encode_quopri does it.
+
+    :param payload: The quoted-printable-encoded payload
+    :param text: The (not encoded) text to append
+    :return: The new quoted-printable-encoded payload
+    """
+
+    # Trailing line breaks are part of the content in quoted-printable.
+    # Only look at the text after the last line break.
+
+    start = payload.rfind("\n") + 1
+
+    tail = quopri.decodestring(payload[start:])
+
+    new_tail = quopri.encodestring(
+        tail + text,
+        quotetabs=True
+    ).replace(" ", "=20")
+
+    line_ending = _line_ending(payload, start)
+
+    if line_ending != "\n":
+
+        new_tail = new_tail.replace("\n", line_ending)
+
+    return "%s%s" % (payload[:start], new_tail)
@@ -1,15 +1,20 @@
 import logging
+import threading
 from logging.handlers import SysLogHandler
 
+# the queueid of the mail processed by the current thread
+log_context = threading.local()
+
+def set_queueid(id = ''):
+    if len(id) > 0:
+        id += ': '
+    log_context.queueid = id
+
 # the filter will take care of appending the
 # queueid to log messages as soon as we have one
 class queueFilter(logging.Filter):
-    def __init__(self, id = ''):
-        if len(id) > 0:
-            id += ': '
-        self.queue = id
     def filter(self, record):
-        record.queueid = self.queue
+        record.queueid = getattr(log_context, 'queueid', '')
         return True
 
 # lets be nice and log our usual stuff like info and
@@ -0,0 +1,482 @@
+""" Counters and latency histograms of the milter
+
+The metrics are recorded in the process handling a connection. Processes
+forked from the collecting process (the connection processes of the fork mode
+and the workers of the supervisor) send their metrics to it through a
+datagram socket, when a connection is closed. The collecting process serves
+the sum of all metrics in the Prometheus text format.
+
+Recording is a no-op, until the metrics are started.
+"""
+import BaseHTTPServer
+import errno
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+syslog = logging.getLogger('disclaimr')
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10)
+
+""" The upper bounds of the latency histogram buckets in seconds """
+
+MAX_DATAGRAM = 65535
+
+""" The maximum size of the metrics sent by a process """
+
+
+def label_key(labels):
+
+    """ Build a hashable key from labels
+
+    :param labels: A dictionary of labels
+    :return: A sorted tuple of label name and value pairs as utf-8 strings
+    """
+
+    key = []
+
+    for name, value in labels.items():
+
+        if isinstance(name, unicode):
+
+            name = name.encode("utf-8")
+
+        if isinstance(value, unicode):
+
+            value = value.encode("utf-8")
+
+        key.append((name, str(value)))
+
+    return tuple(sorted(key))
+
+
+def format_labels(key, extra=None):
+
+    """ Format labels in the Prometheus text format
+
+    :param key: A label key as returned by label_key
+    :param extra: An additional label name and value pair
+    :return: The formatted labels
+    """
+
+    if extra is not None:
+
+        key = key + (extra,)
+
+    if len(key) == 0:
+
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (
+            name,
+            value.replace("\\", "\\\\").replace("\n", "\\n").replace(
+                '"', '\\"'
+            )
+        )
+        for name, value in key
+    )
+
+
+class Registry(object):
+
+    """ The metrics of a process
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+
+        """ Serializes the access of concurrent threads """
+
+        self.counters = {}
+
+        """ The counter values by name and label key """
+
+        self.histograms = {}
+
+        """ The histograms by name and label key as a list of the bucket
+        counts, the count and the sum of all observations """
+
+    def inc(self, name, key, value=1):
+
+        """ Increase a counter
+
+        :param name: The name of the counter
+        :param key: The label key
+        :param value: The value to add
+        """
+
+        with self.lock:
+
+            self.counters[(name, key)] = \
+                self.counters.get((name, key), 0) + value
+
+    def observe(self, name, key, value):
+
+        """ Add an observation to a histogram
+
+        :param name: The name of the histogram
+        :param key: The label key
+        :param value: The observed value
+        """
+
+        with self.lock:
+
+            self._observe(name, key, value)
+
+    def _observe(self, name, key, value, count=1, buckets=None):
+
+        """ Add observations to a histogram. The lock has to be held.
+
+        :param name: The name of the histogram
+        :param key: The label key
+        :param value: The sum of the observed values
+        :param count: The number of observations
+        :param buckets: The bucket counts of the observations. If they're
+            None, value is a single observation.
+        """
+
+        if (name, key) not in self.histograms:
+
+            self.histograms[(name, key)] = [[0] * len(BUCKETS), 0, 0.0]
+
+        histogram = self.histograms[(name, key)]
+
+        if buckets is None:
+
+            for index, bound in enumerate(BUCKETS):
+
+                if value <= bound:
+
+                    histogram[0][index] += 1
+
+                    break
+
+        else:
+
+            for index, bucket_count in enumerate(buckets):
+
+                histogram[0][index] += bucket_count
+
+        histogram[1] += count
+        histogram[2] += value
+
+    def drain(self):
+
+        """ Return all metrics and reset them
+
+        :return: The metrics as a dictionary, that can be serialized to JSON
+        """
+
+        with self.lock:
+
+            data = {
+                "counters": [
+                    [name, key, value]
+                    for (name, key), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, key] + histogram
+                    for (name, key), histogram in self.histograms.items()
+                ]
+            }
+
+            self.counters = {}
+
+            self.histograms = {}
+
+        return data
+
+    def merge(self, data):
+
+        """ Add metrics returned by drain
+
+        :param data: The metrics
+        """
+
+        with self.lock:
+
+            for name, key, value in data["counters"]:
+
+                key = label_key(dict(key))
+
+                self.counters[(name, key)] = \
+                    self.counters.get((name, key), 0) + value
+
+            for name, key, buckets, count, value in data["histograms"]:
+
+                self._observe(
+                    name, label_key(dict(key)), value, count, buckets
+                )
+
+    def render(self):
+
+        """ Render the metrics in the Prometheus text format
+
+        :return: The metrics text
+        """
+
+        with self.lock:
+
+            counters = sorted(self.counters.items())
+
+            histograms = sorted(
+                (key, (list(histogram[0]), histogram[1], histogram[2]))
+                for key, histogram in self.histograms.items()
+            )
+
+        lines = []
+
+        last_name = None
+
+        for (name, key), value in counters:
+
+            if name != last_name:
+
+                lines.append("# TYPE %s counter" % name)
+
+                last_name = name
+
+            lines.append("%s%s %s" % (name, format_labels(key), value))
+
+        for (name, key), (buckets, count, value) in histograms:
+
+            if name != last_name:
+
+                lines.append("# TYPE %s histogram" % name)
+
+                last_name = name
+
+            cumulated = 0
+
+            for bound, bucket_count in zip(BUCKETS, buckets):
+
+                cumulated += bucket_count
+
+                lines.append("%s_bucket%s %d" % (
+                    name, format_labels(key, ("le", repr(float(bound)))),
+                    cumulated
+                ))
+
+            lines.append("%s_bucket%s %d" % (
+                name, format_labels(key, ("le", "+Inf")), count
+            ))
+
+            lines.append("%s_sum%s %r" % (name, format_labels(key), value))
+            lines.append("%s_count%s %d" % (name, format_labels(key), count))
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+""" The metrics of this process """
+
+enabled = False
+
+""" Record metrics """
+
+collector_pid = None
+
+""" The id of the process serving the metrics """
+
+sender = None
+
+""" The socket to send metrics to the collecting process """
+
+
+def inc(name, value=1, **labels):
+
+    """ Increase a counter
+
+    :param name: The name of the counter
+    :param value: The value to add
+    :param labels: The labels of the counter
+    """
+
+    if enabled:
+
+        registry.inc(name, label_key(labels), value)
+
+
+def observe(name, value, **labels):
+
+    """ Add an observation to a histogram
+
+    :param name: The name of the histogram
+    :param value: The observed value
+    :param labels: The labels of the histogram
+    """
+
+    if enabled:
+
+        registry.observe(name, label_key(labels), value)
+
+
+def timed(name, **labels):
+
+    """ A decorator observing the run time of a function in a histogram
+
+    :param name: The name of the histogram
+    :param labels: The labels of the histogram
+    :return: The decorator
+    """
+
+    key = label_key(labels)
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+
+            if not enabled:
+
+                return function(*args, **kwargs)
+
+            start = time.time()
+
+            try:
+
+                return function(*args, **kwargs)
+
+            finally:
+
+                registry.observe(name, key, time.time() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def after_fork():
+
+    """ Reset the metrics in a forked process. Its parent still holds the
+    metrics recorded before the fork.
+    """
+
+    global registry
+
+    registry = Registry()
+
+
+def flush():
+
+    """ Send the metrics of a forked process to the collecting process
+    """
+
+    if not enabled or os.getpid() == collector_pid:
+
+        return
+
+    data = json.dumps(registry.drain())
+
+    if len(data) > MAX_DATAGRAM:
+
+        syslog.warning("Dropping %d bytes of metrics", len(data))
+
+        return
+
+    try:
+
+        sender.send(data, socket.MSG_DONTWAIT)
+
+    except socket.error, e:
+
+        # The collecting process is busy or gone. Metrics are best effort.
+
+        logging.debug("Cannot send metrics: %s", e)
+
+
+def collect(receiver):
+
+    """ Receive the metrics of forked processes
+
+    :param receiver: The receiving datagram socket
+    """
+
+    while True:
+
+        try:
+
+            data = receiver.recv(MAX_DATAGRAM)
+
+        except socket.error, e:
+
+            if e.errno == errno.EINTR:
+
+                continue
+
+            raise
+
+        try:
+
+            registry.merge(json.loads(data))
+
+        except (ValueError, KeyError, TypeError), e:
+
+            syslog.warning("Received invalid metrics: %s", e)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """ Serve the metrics on /metrics
+    """
+
+    def do_GET(self):
+
+        if self.path.split("?")[0] != "/metrics":
+
+            self.send_error(404)
+
+            return
+
+        body = registry.render()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        logging.debug("Metrics request: " + format, *args)
+
+
+def start(address):
+
+    """ Start recording metrics in this process and serve them
+
+    Call this in the collecting process before forking other processes.
+
+    :param address: The address of the HTTP server in the form <ip>:<port>
+    """
+
+    global enabled, collector_pid, sender
+
+    ip = address[:address.rfind(":")]
+    port = int(address[address.rfind(":") + 1:])
+
+    server = BaseHTTPServer.HTTPServer((ip, port), MetricsHandler)
+
+    receiver, sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    collector_pid = os.getpid()
+
+    enabled = True
+
+    for target, args in (
+        (collect, (receiver,)),
+        (server.serve_forever, ())
+    ):
+
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
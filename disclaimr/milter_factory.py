@@ -0,0 +1,559 @@
+""" libmilter factories, that can serve an existing listening socket
+
+The factories of libmilter create and bind their socket themselves. To run
+several worker processes on the same socket, the socket is either created
+once and inherited by all workers or created by every worker using
+SO_REUSEPORT, so the kernel spreads the connections between them.
+"""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+
+import libmilter as lm
+
+syslog = logging.getLogger('disclaimr')
+
+# SO_REUSEPORT isn't available on all platforms
+
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+
+
+def create_listener(sockstr, reuse_port=False, listenq=50, sock_chmod=0666):
+
+    """ Create a listening socket
+
+    :param sockstr: The socket in the form inet:<ip>:<port> or a path to a
+        unix socket
+    :param reuse_port: Set SO_REUSEPORT, so other processes can bind
+        to the same inet socket
+    :param listenq: The length of the listen queue
+    :param sock_chmod: The permissions of a unix socket
+    :return: The listening socket
+    """
+
+    if sockstr.lower().startswith("inet:"):
+
+        ip = sockstr[5:sockstr.rfind(":")]
+        port = int(sockstr[sockstr.rfind(":") + 1:])
+
+        family = socket.getaddrinfo(ip, None)[0][0]
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # The milter replies in several small packets. Don't let them wait
+        # for the acknowledgement of the previous one. Accepted sockets
+        # inherit this option.
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if reuse_port:
+
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        sock.bind((ip, port))
+
+    else:
+
+        if os.path.exists(sockstr):
+
+            os.unlink(sockstr)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(sockstr)
+
+        os.chmod(sockstr, sock_chmod)
+
+    sock.listen(listenq)
+
+    return sock
+
+
+class ListenerMixin(object):
+
+    """ Let a libmilter factory serve a given listening socket instead of
+    creating one
+    """
+
+    listener = None
+
+    """ The listening socket. If it's None, a new one is created. """
+
+    reuse_port = False
+
+    """ Create the socket with SO_REUSEPORT """
+
+    def _setupSock(self):
+
+        """ Set up the listening socket
+        """
+
+        if self.listener is None:
+
+            self.listener = create_listener(
+                self.sockStr,
+                self.reuse_port,
+                self.listenq,
+                self.sockChmod
+            )
+
+        self.sock = self.listener
+
+        self.sock.settimeout(3)
+
+
+class ForkFactory(ListenerMixin, lm.ForkFactory):
+
+    """ libmilter's ForkFactory using the ListenerMixin
+    """
+
+    pass
+
+
+class ThreadFactory(ListenerMixin, lm.ThreadFactory):
+
+    """ libmilter's ThreadFactory using the ListenerMixin
+
+    If slots is set, a connection is only accepted, when a slot is free.
+    The thread of the connection has to release the slot, when it ends. If
+    the thread can't be started, the factory releases it.
+    """
+
+    slots = None
+
+    """ A semaphore limiting the connections handled at the same time """
+
+    def take_slot(self):
+
+        """ Wait for a free slot
+
+        :return: False, if the factory was closed meanwhile
+        """
+
+        if self.slots is None:
+
+            return True
+
+        while not self.slots.acquire(False):
+
+            # Check for closing now and then
+
+            self._close.wait(0.05)
+
+            if self._close.isSet():
+
+                return False
+
+        return True
+
+    def release_slot(self):
+
+        """ Release a slot taken by take_slot
+        """
+
+        if self.slots is not None:
+
+            self.slots.release()
+
+    def run(self):
+
+        """ Accept connections and start a thread for every one
+        """
+
+        self._setupSock()
+
+        while not self._close.isSet():
+
+            if not self.take_slot():
+
+                break
+
+            try:
+
+                sock, addr = self.sock.accept()
+
+            except socket.error, e:
+
+                self.release_slot()
+
+                if not isinstance(e, socket.timeout) \
+                        and not self._close.isSet():
+
+                    syslog.error("Cannot accept a connection: %s", e)
+
+                continue
+
+            sock.settimeout(self.cSockTimeout)
+
+            try:
+
+                protocol = self.protocol(self.opts)
+                protocol.transport = sock
+                protocol.daemon = True
+
+                protocol.start()
+
+            except Exception, e:
+
+                syslog.error(
+                    "Cannot start the thread for the connection from %r: %s",
+                    addr, e
+                )
+
+                self.release_slot()
+
+                sock.close()
+
+
+class BufferedConnection(object):
+
+    """ A non-blocking connection of the event loop
+
+    Data, that can't be sent right away, is buffered and sent by the event
+    loop, when the socket is writable again. So a slow MTA doesn't block
+    the other connections.
+    """
+
+    def __init__(self, sock, factory):
+
+        """ Wrap an accepted socket
+
+        :param sock: The socket
+        :param factory: The AsyncFactory running the event loop
+        :return: The connection
+        """
+
+        sock.setblocking(0)
+
+        self.sock = sock
+
+        self.factory = factory
+
+        # The data waiting to be sent
+
+        self.pending = collections.deque()
+
+    def fileno(self):
+
+        """ The file number of the socket
+
+        :return: The file number
+        """
+
+        return self.sock.fileno()
+
+    def recv(self, size):
+
+        """ Receive data
+
+        :param size: The maximum number of bytes
+        :return: The data
+        """
+
+        return self.sock.recv(size)
+
+    def send_some(self, data):
+
+        """ Send as much of the data as the socket takes without blocking
+
+        :param data: The data
+        :return: The number of bytes sent
+        """
+
+        try:
+
+            return self.sock.send(data)
+
+        except socket.error, e:
+
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+
+                raise
+
+            return 0
+
+    def sendall(self, data):
+
+        """ Send data. What can't be sent now, is sent by the event loop later.
+
+        :param data: The data
+        """
+
+        if len(self.pending) == 0:
+
+            sent = self.send_some(data)
+
+            if sent == len(data):
+
+                return
+
+            data = data[sent:]
+
+            self.factory.watch_writable(self, True)
+
+        self.pending.append(data)
+
+    def flush(self):
+
+        """ Send the buffered data. Called by the event loop, when the socket
+        is writable.
+        """
+
+        while len(self.pending) > 0:
+
+            sent = self.send_some(self.pending[0])
+
+            if sent < len(self.pending[0]):
+
+                self.pending[0] = self.pending[0][sent:]
+
+                return
+
+            self.pending.popleft()
+
+        self.factory.watch_writable(self, False)
+
+    def close(self):
+
+        """ Close the connection and drop the buffered data
+        """
+
+        self.pending.clear()
+
+        self.sock.close()
+
+
+class AsyncFactory(ListenerMixin, lm.AsyncFactory):
+
+    """ An event loop serving all connections
+
+    Unlike libmilter's AsyncFactory, the listening socket is polled in the
+    event loop, too. It is non-blocking, as other workers may accept a
+    connection first. libmilter Deferreds aren't supported. Replies, that
+    are ready in other threads, are handed to the event loop with
+    call_in_loop, so only the event loop talks to the MTA. The connections
+    are non-blocking (see BufferedConnection).
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        """ Set up the factory
+
+        :return: The factory
+        """
+
+        lm.AsyncFactory.__init__(self, *args, **kwargs)
+
+        # The functions to run in the event loop and a pipe waking it up
+
+        self.calls = collections.deque()
+
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+
+        for fd in (self.wakeup_read, self.wakeup_write):
+
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def call_in_loop(self, function, *args):
+
+        """ Run a function in the event loop. Can be called from any thread.
+
+        :param function: The function
+        :param args: The arguments of the function
+        """
+
+        self.calls.append((function, args))
+
+        try:
+
+            os.write(self.wakeup_write, "x")
+
+        except OSError, e:
+
+            # The pipe is full, so the event loop will wake up anyway
+
+            if e.errno != errno.EAGAIN:
+
+                raise
+
+    def run_calls(self):
+
+        """ Run the functions handed to the event loop
+        """
+
+        try:
+
+            while os.read(self.wakeup_read, 4096):
+
+                pass
+
+        except OSError, e:
+
+            if e.errno != errno.EAGAIN:
+
+                raise
+
+        while len(self.calls) > 0:
+
+            (function, args) = self.calls.popleft()
+
+            try:
+
+                function(*args)
+
+            except Exception, e:
+
+                syslog.error("Error in the event loop: %s", e)
+
+    def watch_writable(self, connection, watch):
+
+        """ Start or stop waiting for a connection to become writable
+
+        :param connection: The BufferedConnection
+        :param watch: Wether to wait for it
+        """
+
+        if watch:
+
+            self.poll.modify(connection.fileno(), self.emask | select.POLLOUT)
+
+        else:
+
+            self.poll.modify(connection.fileno(), self.emask)
+
+    def drop(self, fileno):
+
+        """ Close a connection and remove it from the event loop
+
+        :param fileno: The file number of the connection
+        """
+
+        self.sockMap[fileno].close()
+        self.protoMap[fileno].connectionLost()
+        self.unregister(fileno)
+
+    def run(self):
+
+        """ Run the event loop
+        """
+
+        self._setupSock()
+
+        self.sock.setblocking(0)
+
+        self.poll.register(self.sock.fileno(), self.emask)
+
+        self.poll.register(self.wakeup_read, self.emask)
+
+        while not self._close.isSet():
+
+            try:
+
+                events = self.poll.poll(1000)
+
+            except select.error:
+
+                # Interrupted by a signal
+
+                continue
+
+            for fileno, event in events:
+
+                if fileno == self.sock.fileno():
+
+                    self.accept()
+
+                    continue
+
+                if fileno == self.wakeup_read:
+
+                    self.run_calls()
+
+                    continue
+
+                if fileno not in self.sockMap:
+
+                    continue
+
+                connection = self.sockMap[fileno]
+
+                protocol = self.protoMap[fileno]
+
+                if event & select.POLLOUT:
+
+                    try:
+
+                        connection.flush()
+
+                    except socket.error:
+
+                        self.drop(fileno)
+
+                        continue
+
+                    if event == select.POLLOUT:
+
+                        continue
+
+                buf = ""
+
+                try:
+
+                    buf = connection.recv(lm.MILTER_CHUNK_SIZE)
+
+                except socket.error, e:
+
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+
+                        # Nothing to read yet
+
+                        continue
+
+                    # Otherwise, close the connection
+
+                if not buf:
+
+                    self.drop(fileno)
+
+                    continue
+
+                try:
+
+                    protocol.dataReceived(buf)
+
+                except Exception, e:
+
+                    protocol.log(
+                        "AN EXCEPTION OCCURED IN %s: %s" % (protocol.id, e)
+                    )
+
+                    self.drop(fileno)
+
+    def accept(self):
+
+        """ Accept a new connection and register it in the event loop
+        """
+
+        try:
+
+            sock, addr = self.sock.accept()
+
+        except socket.error:
+
+            # Another worker was faster
+
+            return
+
+        connection = BufferedConnection(sock, self)
+
+        protocol = self.protocol(self.opts)
+        protocol.transport = connection
+        protocol.factory = self
+
+        self.register(connection, protocol)
@@ -1,17 +1,80 @@
 """ Python Module for class MilterHelper """
 import base64
-import copy
 import email
+import functools
 import logging
+import os
 import quopri
-import ldap
-from lxml import etree
 import re
+import time
+from disclaimr import encoding_helper, metrics, mime_skeleton
+from disclaimr.configuration_helper import compile_mime_filter
 from disclaimr.query_cache import QueryCache
-from disclaimrwebadmin import models, constants
+from disclaimrwebadmin import constants
 
 syslog = logging.getLogger('disclaimr')
 
+# Content types of signed or encrypted mails
+
+ENCRYPTED_CONTENT_TYPES = (
+    "multipart/signed",
+    "multipart/encrypted",
+    "application/pkcs7-mime",
+    "application/x-pkcs7-mime"
+)
+
+# Markers of inline PGP
+
+ENCRYPTED_BODY_MARKERS = (
+    "-----BEGIN PGP MESSAGE-----",
+    "-----BEGIN PGP SIGNED MESSAGE-----"
+)
+
+# The milter stages in the order of the summary
+
+STAGES = ("connect", "mail_from", "rcpt", "header", "eoh", "body", "eob")
+
+def monotonic():
+
+    """ Return the elapsed time of a clock, that isn't affected by changes of
+    the system time. Python 2 has no time.monotonic, so use the elapsed real
+    time of os.times.
+
+    :return: The elapsed time in seconds since a fixed point in the past
+    """
+
+    return os.times()[4]
+
+
+def stage(name):
+
+    """ Decorator adding the duration of a MilterHelper method to the time
+    spent in a milter stage by the current mail
+
+    :param name: The name of the stage
+    :return: The decorator
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+
+            start = time.time()
+
+            try:
+
+                return function(self, *args, **kwargs)
+
+            finally:
+
+                self.add_time(name, time.time() - start)
+
+        return wrapper
+
+    return decorator
+
+
 class MilterHelper(object):
 
     """ A helper class, that is used by the milter daemon to do the actual work.
@@ -23,8 +86,20 @@ class MilterHelper(object):
 
         The configuration dictionary currently has to hold the following keys:
 
-        sender_ip: A list of dictionaries with the ip-sender requirements and
+        sender_ip: A list of tuples with the IP version, the first and the
+                last address (as integers) of the ip-sender requirements and
                 the requirement id
+        requirements: A dictionary of the requirement records (see
+                disclaimr.snapshot) by their id
+        rules: A dictionary of the rule records by their id
+        mime_filter: A dictionary of action ids and their compiled mime
+                type filters
+        stages: A dictionary of the milter stages needed by the
+                requirements and actions
+        encrypted_policy: What to do with signed or encrypted mails
+                ("process" or "accept")
+        limits: A dictionary with the maximum body size, number of mime
+                parts, nesting depth and processing time of a mail
 
         :param configuration: A configuration dictionary
         :return:
@@ -46,6 +121,196 @@ class MilterHelper(object):
 
         self.actions = []
 
+        self.disclaimer_cache = {}
+
+        self.body_chunks = []
+
+        self.body_size = 0
+
+        self.deadline = None
+
+        self.connect_requirements = []
+
+        self.reset_stats()
+
+    def __getstate__(self):
+
+        """ The state of the helper to process a mail in another process. The
+        configuration is left out, the other process sets its own.
+
+        :return: The attributes without the configuration
+        """
+
+        state = dict(self.__dict__)
+
+        del(state["configuration"])
+
+        return state
+
+    def reset_stats(self):
+
+        """ Reset the statistics of the current mail used by summary
+        """
+
+        # The time spent in the milter stages
+
+        self.timings = {}
+
+        self.stats = {
+            "reason": "",
+            "body_size": 0,
+            "parts": 0,
+            "touched": 0,
+            "rules": [],
+            "ldap_queries": 0,
+            "ldap_errors": 0,
+            "ldap_seconds": 0.0,
+            "cache_hits": 0,
+            "cache_misses": 0
+        }
+
+    def add_time(self, name, seconds):
+
+        """ Add to the time spent in a milter stage by the current mail
+
+        :param name: The name of the stage
+        :param seconds: The duration in seconds
+        """
+
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count_ldap(self, start, error=False):
+
+        """ Add a directory server query to the statistics of the current mail
+
+        :param start: The start time of the query
+        :param error: Wether the query failed
+        """
+
+        self.stats["ldap_queries"] += 1
+
+        self.stats["ldap_seconds"] += time.time() - start
+
+        if error:
+
+            self.stats["ldap_errors"] += 1
+
+    def summary(self, decision):
+
+        """ Build a summary of the current mail for the log and reset the
+        statistics
+
+        The summary is a line of key=value pairs with the decision, the reason
+        for not modifying the mail, the envelope sender, the body size, the
+        number of parts and the modified parts, the rules carried out, the
+        directory server queries, the query cache usage and the time spent
+        in every milter stage.
+
+        :param decision: The final decision about the mail
+        :return: The summary
+        """
+
+        fields = [
+            ("decision", decision),
+            ("reason", self.stats["reason"] or "-"),
+            ("sender", self.mail_data.get("envelope_from") or "-"),
+            ("size", self.stats["body_size"]),
+            ("parts", self.stats["parts"]),
+            ("touched", self.stats["touched"]),
+            ("rules", '"%s"' % ",".join(
+                rule.replace('"', "'") for rule in self.stats["rules"]
+            )),
+            ("ldap_queries", self.stats["ldap_queries"]),
+            ("ldap_errors", self.stats["ldap_errors"]),
+            ("ldap_ms", "%.3f" % (self.stats["ldap_seconds"] * 1000)),
+            ("cache_hits", self.stats["cache_hits"]),
+            ("cache_misses", self.stats["cache_misses"])
+        ]
+
+        for name in STAGES:
+
+            if name in self.timings:
+
+                fields.append(
+                    ("%s_ms" % name, "%.3f" % (self.timings[name] * 1000))
+                )
+
+        fields.append(
+            ("total_ms", "%.3f" % (sum(self.timings.values()) * 1000))
+        )
+
+        self.reset_stats()
+
+        return "Summary: %s" % " ".join(
+            "%s=%s" % (name, value) for (name, value) in fields
+        )
+
+    def disable(self, reason=""):
+
+        """ Disable the helper for the current mail. The buffered headers and
+        body won't be needed anymore, so release them.
+
+        :param reason: Why the mail won't be modified (for the summary)
+        """
+
+        self.enabled = False
+
+        self.stats["reason"] = reason
+
+        self.mail_data["headers"] = []
+
+        self.mail_data["headers_dict"] = {}
+
+        self.mail_data["body"] = ""
+
+        self.body_chunks = []
+
+        self.body_size = 0
+
+    def reset(self):
+
+        """ Reset the state of the current mail, so that another mail can be
+        processed over the same connection. The requirements matching the
+        connection are kept.
+        """
+
+        self.mail_data = {
+            "sender_ip": self.mail_data.get("sender_ip"),
+            "headers": [],
+            "headers_dict": {},
+            "body": ""
+        }
+
+        self.body_chunks = []
+
+        self.body_size = 0
+
+        self.requirements = list(self.connect_requirements)
+
+        self.enabled = len(self.requirements) > 0
+
+        self.rcptmatch = False
+
+        self.deadline = None
+
+        # Disclaimers may depend on the sender
+
+        self.disclaimer_cache = {}
+
+    def get_requirements(self):
+
+        """ Return the requirements, that still match the current mail
+
+        :return: A list of requirement records
+        """
+
+        return [
+            self.configuration["requirements"][requirement_id]
+            for requirement_id in self.requirements
+        ]
+
+    @metrics.timed("disclaimr_callback_seconds", callback="connect")
+    @stage("connect")
     def connect(self, hostname, family, ip, port, cmd_dict):
 
         """ Called when a client connects to the milter
@@ -59,24 +324,38 @@ class MilterHelper(object):
 
         self.mail_data["sender_ip"] = ip
 
-        # Check for IP-requirements
+        # Check for IP-requirements. netaddr is only loaded, when the first
+        # client connects.
+
+        import netaddr
 
-        for sender_ip in self.configuration["sender_ip"]:
+        address = netaddr.IPAddress(ip)
 
-            if ip in sender_ip["ip"]:
+        version = address.version
+
+        value = int(address)
+
+        for (network_version, first, last, requirement_id) \
+                in self.configuration["sender_ip"]:
+
+            if network_version == version and first <= value <= last:
 
                 logging.debug("Found IP in a requirement.")
 
-                if not sender_ip["id"] in self.requirements:
+                if not requirement_id in self.requirements:
+
+                    self.requirements.append(requirement_id)
 
-                    self.requirements.append(sender_ip["id"])
+        self.connect_requirements = list(self.requirements)
 
         if len(self.requirements) == 0:
 
             logging.debug("Couldn't find the IP in any requirement. Skipping.")
 
-            self.enabled = False
+            self.disable("ip")
 
+    @metrics.timed("disclaimr_callback_seconds", callback="mail_from")
+    @stage("mail_from")
     def mail_from(self, addr, cmd_dict):
 
         """ Called when the MAIL FROM-envelope has been sent
@@ -87,9 +366,9 @@ class MilterHelper(object):
 
         # Check requirements
 
-        for req in models.Requirement.objects.filter(id__in=self.requirements):
+        for req in self.get_requirements():
 
-            if not re.search(req.sender, addr):
+            if not req.sender.search(addr):
 
                 self.requirements = filter(
                     lambda x: x != req.id, self.requirements
@@ -100,10 +379,12 @@ class MilterHelper(object):
             logging.debug("Couldn't match the sender address in any "
                           "requirement. Skipping.")
 
-            self.enabled = False
+            self.disable("sender")
 
         self.mail_data["envelope_from"] = addr
 
+    @metrics.timed("disclaimr_callback_seconds", callback="rcpt")
+    @stage("rcpt")
     def rcpt(self, recip, cmd_dict):
 
         """ Called when the RCPT TO-envelope has been set
@@ -114,9 +395,9 @@ class MilterHelper(object):
 
         # Check requirements
 
-        for req in models.Requirement.objects.filter(id__in=self.requirements):
+        for req in self.get_requirements():
 
-            if not re.search(req.recipient, recip):
+            if not req.recipient.search(recip):
 
                 self.filter = filter(
                     lambda x: x != req.id, self.requirements
@@ -127,7 +408,7 @@ class MilterHelper(object):
                     logging.debug("Couldn't match the recipient address in any "
                                   "requirement. Skipping.")
         
-                    self.enabled = False
+                    self.disable("recipient")
                     
             else:
                 logging.debug("Recipient address matches regex.")
@@ -137,6 +418,7 @@ class MilterHelper(object):
 
         self.mail_data["envelope_rcpt"] = recip
 
+    @stage("header")
     def header(self, key, val, cmd_dict):
 
         """ Called when a header is received
@@ -149,6 +431,8 @@ class MilterHelper(object):
         self.mail_data["headers_dict"][key.lower()] = val
         self.mail_data["headers"].append("%s: %s" % (key, val))
 
+    @metrics.timed("disclaimr_callback_seconds", callback="eoh")
+    @stage("eoh")
     def eoh(self, cmd_dict):
 
         """ Called, when all headers were sent
@@ -158,9 +442,9 @@ class MilterHelper(object):
 
         # Check requirements
 
-        for req in models.Requirement.objects.filter(id__in=self.requirements):
+        for req in self.get_requirements():
 
-            if not re.search(req.header, "\n".join(self.mail_data["headers"])):
+            if not req.header.search("\n".join(self.mail_data["headers"])):
 
                 self.requirements = filter(
                     lambda x: x != req.id, self.requirements
@@ -171,8 +455,21 @@ class MilterHelper(object):
             logging.debug("Couldn't match the header in any "
                           "requirement. Skipping.")
 
-            self.enabled = False
+            self.disable("header")
+
+            return
+
+        content_type = self.mail_data["headers_dict"].get("content-type", "")
+
+        if self.configuration["encrypted_policy"] == "accept" \
+                and content_type.split(";")[0].strip().lower() \
+                in ENCRYPTED_CONTENT_TYPES:
 
+            syslog.info("Passing signed or encrypted mail unmodified")
+
+            self.disable("encrypted")
+
+    @stage("body")
     def body(self, chunk, cmd_dict):
 
         """ Called when a body chunk has been received
@@ -181,10 +478,45 @@ class MilterHelper(object):
         :param cmd_dict: A libmilter command dictionary
         """
 
-        # Requirement will be checked in eob
+        if len(self.body_chunks) == 0 \
+                and self.configuration["encrypted_policy"] == "accept":
+
+            # Look for inline PGP in the first chunk
+
+            for marker in ENCRYPTED_BODY_MARKERS:
+
+                if marker in chunk:
+
+                    syslog.info("Passing signed or encrypted mail unmodified")
+
+                    self.disable("encrypted")
+
+                    return
+
+        self.body_size += len(chunk)
+
+        self.stats["body_size"] += len(chunk)
+
+        max_body_size = self.configuration["limits"]["body_size"]
+
+        if 0 < max_body_size < self.body_size:
+
+            syslog.warning(
+                "Body is larger than %d bytes. Passing mail unmodified.",
+                max_body_size
+            )
+
+            self.disable("body_size")
+
+            return
+
+        # Requirement will be checked in eob. Collect the chunks and join
+        # them only once.
 
-        self.mail_data["body"] += chunk
+        self.body_chunks.append(chunk)
 
+    @metrics.timed("disclaimr_callback_seconds", callback="eob")
+    @stage("eob")
     def eob(self, cmd_dict):
 
         """ Called when all body chunks have been received
@@ -192,17 +524,62 @@ class MilterHelper(object):
         Returns a list of dictionaries with modification tasks.
         Currently supported keys:
 
-        "repl_body": Replace the body with the value
+        "repl_body": Replace the body with the value (an iterator over chunks
+            of the new body, that can be passed to replBody one after
+            another)
 
         :param cmd_dict: A libmilter command dictionary
         :returns: The modification list
         """
 
+        if not self.enabled:
+
+            # Disabled while receiving the body
+
+            return
+
+        limits = self.configuration["limits"]
+
+        # The deadline is kept until the next mail, because the new body is
+        # only serialized while it is sent
+
+        self.deadline = None
+
+        if limits["time"] > 0:
+
+            self.deadline = monotonic() + limits["time"]
+
+        try:
+
+            return self.process_mail()
+
+        except mime_skeleton.LimitExceeded, e:
+
+            # Fail open
+
+            syslog.warning("%s. Passing mail unmodified.", e)
+
+            self.disable("limit")
+
+            return
+
+    def process_mail(self):
+
+        """ Check the body requirements and carry out the actions on the
+        mail. Used by eob.
+
+        :returns: The modification list
+        """
+
+        self.mail_data["body"] = "".join(self.body_chunks)
+
+        self.body_chunks = []
+
         # Check requirements
 
-        for req in models.Requirement.objects.filter(id__in=self.requirements):
+        for req in self.get_requirements():
 
-            if not re.search(req.body, self.mail_data["body"]):
+            if not req.body.search(self.mail_data["body"]):
 
                 self.requirements = filter(
                     lambda x: x != req.id, self.requirements
@@ -213,7 +590,7 @@ class MilterHelper(object):
             logging.debug("Couldn't match the body in any "
                           "requirement. Skipping.")
 
-            self.enabled = False
+            self.disable("body")
 
             return
 
@@ -223,7 +600,7 @@ class MilterHelper(object):
 
         rules = []
 
-        for req in models.Requirement.objects.filter(id__in=self.requirements):
+        for req in self.get_requirements():
 
             if req.action == constants.REQ_ACTION_DENY:
 
@@ -251,89 +628,130 @@ class MilterHelper(object):
             # After checking the left over requirements, no rules were left
             # to run.
 
-            self.enabled = False
+            self.disable("denied")
             return
 
-        # Transform body into a mime mail to work on it
+        # Transform body into a mime mail to work on it. The MTA sends the
+        # body without the empty line separating it from the headers.
+
+        mail_text = "%s\n%s" % (
+            "".join("%s\n" % header for header in self.mail_data["headers"]),
+            self.mail_data["body"]
+        )
+
+        # Only parse the mime structure of the mail. The parts are parsed
+        # completely only if an action modifies them
 
-        mail = email.message_from_string(
-            "%s\n%s" % (
-                "\n".join(self.mail_data["headers"]),
-                self.mail_data["body"]
+        skeleton = mime_skeleton.parse_mail(
+            mail_text,
+            mime_skeleton.ParseLimits(
+                self.configuration["limits"]["parts"],
+                self.configuration["limits"]["depth"]
             )
         )
 
-        orig_mail = copy.deepcopy(mail)
+        # The body is part of the skeleton's buffer now. Release it.
+
+        self.mail_data["body"] = ""
+
+        del(mail_text)
+
+        # Collect the actions of the matching rules, that can touch at least
+        # one part of the mail
 
-        # Carry out the actions
+        paths = skeleton.get_paths()
 
-        for rule in models.Rule.objects.filter(id__in=rules):
+        self.stats["parts"] = len(paths)
 
-            for action in rule.action_set.all():
+        actions = []
+
+        for rule in sorted(
+            (self.configuration["rules"][rule_id] for rule_id in rules),
+            key=lambda rule: (rule.position, rule.id)
+        ):
+
+            for action in rule.actions:
 
                 if not action.enabled:
 
                     continue
 
-                syslog.info("Adding Disclaimer (Action: %s | Rule: %s | Disclaimer: %s)" % (
+                if not self.action_touches(action, paths):
+
+                    logging.debug(
+                        "Action %s doesn't match any part of the mail. "
+                        "Skipping.", action.name
+                    )
+
+                    continue
+
+                syslog.info(
+                    "Adding Disclaimer (Action: %s | Rule: %s | Disclaimer: %s)",
                     action.name,
                     rule.name,
-                    action.disclaimer.name,
-                ))
+                    action.disclaimer.name
+                )
 
-                returned_mail = self.do_action(mail, action)
+                actions.append(action)
 
-                if returned_mail is not None:
+                metrics.inc("disclaimr_actions_total", rule=rule.name)
 
-                    mail = returned_mail
+                # Rules without a name are logged with their id
 
-            if not rule.continue_rules:
+                rule_name = rule.name or "#%d" % rule.id
 
-                break
+                if rule_name not in self.stats["rules"]:
 
-        # Build workflow
+                    self.stats["rules"].append(rule_name)
 
-        workflow = {}
+            if not rule.continue_rules:
 
-        # Change headers?
+                break
 
-        for header in mail.keys():
+        if len(actions) == 0:
 
-            if header not in orig_mail.keys():
+            logging.debug("No action can modify the mail. Skipping.")
 
-                # Add header
+            self.disable("no_action")
 
-                if "add_header" not in workflow:
+            return
 
-                    workflow["add_header"] = {}
+        # Carry out all actions in one pass through the mail
 
-                workflow["add_header"][header] = orig_mail[header]
+        self.do_skeleton_actions(skeleton, actions)
 
-            elif mail[header] != orig_mail[header]:
+        # Build workflow
 
-                # Change header
+        workflow = {}
 
-                if "change_header" not in workflow:
+        if skeleton.message is None:
 
-                    workflow["change_header"] = {}
+            # The headers of the mail weren't touched. Copy the unmodified
+            # parts of the body and only serialize the modified ones.
 
-                workflow["change_header"][header] = mail[header]
+            if skeleton.is_modified():
 
-        # Remove headers?
+                workflow["repl_body"] = mime_skeleton.make_chunks(
+                    self.check_pieces(skeleton.serialize(body_only=True))
+                )
 
-        for header in orig_mail.keys():
+            return workflow
 
-            if header not in mail.keys():
+        # The mail has been modified as a whole
 
-                if "delete_header" not in workflow:
+        mail = skeleton.message
 
-                    workflow["delete_header"] = []
+        orig_mail = skeleton.headers
 
-                workflow["delete_header"].append(header)
+        # Change headers?
+
+        workflow.update(self.diff_headers(orig_mail, mail))
 
         # Remove all headers from mail, so we can safely replace the body. Do
         # this by removing everything before the first empty line (as per RFC)
 
+        self.check_deadline()
+
         new_body = mail.as_string()
 
         # Work around mails with mixed line endings. Simply use the first of
@@ -369,7 +787,58 @@ class MilterHelper(object):
             new_body = new_body.rstrip()
 
         # Replace the body with the modified one
-        workflow["repl_body"] = new_body
+        workflow["repl_body"] = mime_skeleton.make_chunks([new_body])
+
+        return workflow
+
+    @staticmethod
+    def diff_headers(orig_mail, mail):
+
+        """ Compare the headers of the original and the modified mail
+
+        :param orig_mail: The headers of the original mail
+        :param mail: The modified mail
+        :return: A dictionary with the workflow keys "add_header" and
+            "change_header" (dictionaries of headers and values) and
+            "delete_header" (a list of headers). Keys without headers are left
+            out.
+        """
+
+        workflow = {}
+
+        for header in mail.keys():
+
+            if header not in orig_mail.keys():
+
+                # Add header
+
+                if "add_header" not in workflow:
+
+                    workflow["add_header"] = {}
+
+                workflow["add_header"][header] = mail[header]
+
+            elif mail[header] != orig_mail[header]:
+
+                # Change header
+
+                if "change_header" not in workflow:
+
+                    workflow["change_header"] = {}
+
+                workflow["change_header"][header] = mail[header]
+
+        # Remove headers?
+
+        for header in orig_mail.keys():
+
+            if header not in mail.keys():
+
+                if "delete_header" not in workflow:
+
+                    workflow["delete_header"] = []
+
+                workflow["delete_header"].append(header)
 
         return workflow
 
@@ -421,7 +890,7 @@ class MilterHelper(object):
 
             encoding = mail["Content-Transfer-Encoding"].lower()
 
-            logging.debug("Pre Content-Transfer-Encoding: %s" % encoding)
+            logging.debug("Pre Content-Transfer-Encoding: %s", encoding)
 
             if encoding == "quoted-printable":
 
@@ -441,61 +910,290 @@ class MilterHelper(object):
 
         return encoding, mail_text
 
-    def do_action(self, mail_parameter, action):
+    @staticmethod
+    def append_encoded(mail, text, charset):
 
-        """ Apply an action on a mail (optionally recursing through the
-            different mail payloads)
+        """ Append a text to the payload of a base64 or quoted-printable
+        encoded mail part without decoding and re-encoding the whole payload
 
-        :param mail_parameter: A mail object
-        :param action: The action to carry out
-        :return: The modified mail
+        :param mail: The message (part)
+        :param text: The text to append
+        :param charset: The charset of the message part
+        :return: The modified message part or None, if the part's encoding
+            doesn't support appending
         """
 
-        # We work on a copy here. Remove the reference
+        if "Content-Transfer-Encoding" not in mail:
 
-        mail = copy.deepcopy(mail_parameter)
-
-        if mail.is_multipart():
+            return None
 
-            # This is a multipart, recurse through the subparts
+        encoding = mail["Content-Transfer-Encoding"].lower()
 
-            new_payloads = []
+        if isinstance(text, unicode):
 
-            for payload in mail.get_payload():
+            text = text.encode(charset.lower(), "replace")
 
-                returned_mail = self.do_action(payload, action)
+        text = "\n%s" % text
 
-                if returned_mail is not None:
+        if encoding == "base64":
 
-                    new_payloads.append(returned_mail)
+            new_payload = encoding_helper.append_base64(
+                mail.get_payload(),
+                text
+            )
 
-            mail.set_payload(new_payloads)
+        elif encoding == "quoted-printable":
 
-            return mail
+            new_payload = encoding_helper.append_quoted_printable(
+                mail.get_payload(),
+                text
+            )
 
         else:
 
-            logging.debug(
-                "Got part of content-type %s" % mail.get_content_type()
-            )
+            return None
+
+        if new_payload is None:
+
+            return None
+
+        logging.debug("Appended to %s encoded payload", encoding)
+
+        mail.set_payload(new_payload)
+
+        return mail
+
+    def get_mime_filter(self, action):
+
+        """ Return the compiled mime type filter of an action
+
+        :param action: The action
+        :return: A compiled regular expression or None, if the action isn't
+            restricted to any mime type
+        """
+
+        mime_filters = self.configuration.setdefault("mime_filter", {})
+
+        if action.id not in mime_filters:
+
+            mime_filters[action.id] = compile_mime_filter(action.only_mime)
+
+        return mime_filters[action.id]
+
+    def action_applies(self, action, path):
+
+        """ Check, if an action may be carried out on a mail part
+
+        :param action: The action
+        :param path: A tuple of the content types of the part and all the
+            multiparts it is enclosed in
+        :return: Wether the action's mime type filter matches the part or
+            one of its enclosing multiparts
+        """
+
+        mime_filter = self.get_mime_filter(action)
+
+        if mime_filter is None:
+
+            return True
+
+        for content_type in path:
+
+            if mime_filter.match(content_type):
+
+                return True
+
+        return False
+
+    def action_touches(self, action, paths):
+
+        """ Check, if an action can modify a mail at all
+
+        :param action: The action
+        :param paths: The content type paths of the mail's parts (see
+            mime_skeleton.MimePart.get_paths)
+        :return: Wether at least one part of the mail can be modified by the
+            action
+        """
+
+        for path in paths:
+
+            if not action.action == constants.ACTION_ACTION_ADDPART \
+                    and path[-1] not in ("text/plain", "text/html"):
+
+                continue
+
+            if self.action_applies(action, path):
+
+                return True
+
+        return False
+
+    def do_skeleton_actions(self, part, actions, path=()):
+
+        """ Apply a list of actions on the mime skeleton of a mail
+
+        Only non-multipart parts, that at least one action can modify, are
+        parsed and replaced with the modified message. All other parts are
+        left untouched.
+
+        :param part: A mime_skeleton.MimePart
+        :param actions: The actions to carry out (in that order)
+        :param path: The content types of the enclosing multiparts
+        """
+
+        if len(part.children) > 0:
 
-            if mail.get_content_type().lower() not in ("text/plain",
-                                                       "text/html")\
-               and not action.action == constants.ACTION_ACTION_ADDPART:
+            for child in part.children:
 
-                syslog.warning(
-                    "Content-type %s is currently not supported for actions "
-                    "other than addpart." % 
-                        mail.get_content_type()
+                self.do_skeleton_actions(
+                    child,
+                    actions,
+                    path + (part.content_type,)
                 )
 
-                return mail
+            return
+
+        part_actions = [
+            action for action in actions
+            if self.action_touches(action, [path + (part.content_type,)])
+        ]
+
+        if len(part_actions) == 0:
+
+            return
+
+        self.check_deadline()
+
+        self.stats["touched"] += 1
+
+        part.set_message(
+            self.do_part_actions(part.get_message(), part_actions, path)
+        )
+
+    def check_deadline(self):
+
+        """ Check, if the processing time of the current mail is up
+
+        Raises mime_skeleton.LimitExceeded, if it is.
+        """
+
+        if self.deadline is not None and monotonic() > self.deadline:
+
+            raise mime_skeleton.LimitExceeded(
+                "Processing took longer than %s seconds"
+                % self.configuration["limits"]["time"]
+            )
+
+    def check_pieces(self, pieces):
+
+        """ Check the deadline of the current mail while the pieces of the
+        new body are generated
+
+        :param pieces: An iterator over the pieces of the new body
+        :return: An iterator over the same pieces. Raises
+            mime_skeleton.LimitExceeded, if the processing time is up.
+        """
+
+        for piece in pieces:
+
+            self.check_deadline()
+
+            yield piece
+
+    def do_action(self, mail, action):
+
+        """ Apply an action on a mail (optionally recursing through the
+            different mail payloads)
+
+        :param mail: A mail object
+        :param action: The action to carry out
+        :return: The modified mail
+        """
+
+        return self.do_actions(mail, [action])
+
+    def do_actions(self, mail, actions, path=()):
+
+        """ Apply a list of actions on a mail (optionally recursing through
+            the different mail payloads)
+
+        The mail is walked only once. Every part is decoded at most once,
+        all actions are carried out on the decoded text and the part is
+        encoded again afterwards.
+
+        :param mail: A mail object
+        :param actions: The actions to carry out (in that order)
+        :param path: The content types of the enclosing multiparts
+        :return: The modified mail
+        """
+
+        if mail.is_multipart():
+
+            # This is a multipart, recurse through the subparts
+
+            path = path + (mail.get_content_type().lower(),)
+
+            new_payloads = []
+
+            for payload in mail.get_payload():
+
+                new_payloads.append(self.do_actions(payload, actions, path))
+
+            mail.set_payload(new_payloads)
+
+            return mail
+
+        return self.do_part_actions(mail, actions, path)
+
+    def do_part_actions(self, mail, actions, path=()):
 
-            # Fetch the content type of the mail
+        """ Apply a list of actions on a single (non-multipart) mail part
 
-            if mail.get_content_type().lower() not in ("text/plain",
-                                                       "text/html") \
-               and action.action == constants.ACTION_ACTION_ADDPART:
+        :param mail: The mail part
+        :param actions: The actions to carry out (in that order)
+        :param path: The content types of the enclosing multiparts
+        :return: The modified mail part
+        """
+
+        logging.debug(
+            "Got part of content-type %s", mail.get_content_type()
+        )
+
+        part_type = mail.get_content_type().lower()
+
+        # Only carry out actions, that may work on this mime type
+
+        actions = [
+            action for action in actions
+            if self.action_applies(action, path + (part_type,))
+        ]
+
+        if len(actions) == 0:
+
+            return mail
+
+        part_charset = mail.get_content_charset()
+
+        # The decoded payload as a list of the transfer encoding, the charset
+        # and the text. The payload is only decoded, if an action needs it
+
+        decoded = None
+
+        for index, action in enumerate(actions):
+
+            self.check_deadline()
+
+            if part_type not in ("text/plain", "text/html"):
+
+                if not action.action == constants.ACTION_ACTION_ADDPART:
+
+                    syslog.warning(
+                        "Content-type %s is currently not supported for "
+                        "actions other than addpart.", part_type
+                    )
+
+                    continue
 
                 # Cannot detect the right content type. Set the disclaimer
                 # content type to the fallback type
@@ -510,597 +1208,804 @@ class MilterHelper(object):
 
             else:
 
-                content_type = mail.get_content_type().lower()
+                content_type = part_type
+
+            disclaimer = self.get_disclaimer(
+                action,
+                content_type,
+                part_charset
+            )
+
+            if disclaimer is None:
 
-            # Set disclaimer text
+                # The disclaimer can't be used. Skip this action.
 
-            logging.debug("Setting disclaimer text")
+                continue
 
-            if content_type == "text/plain":
+            (disclaimer_text, disclaimer_charset, charset) = disclaimer
 
-                disclaimer_text = action.disclaimer.text
+            # Resolving the disclaimer may have taken a while
 
-                disclaimer_charset = action.disclaimer.text_charset
+            self.check_deadline()
 
-                do_replace = action.disclaimer.text_use_template
+            # Carry out the action
 
-            elif action.disclaimer.html_use_text:
+            logging.debug(
+                "Adding Disclaimer %s to body (%s)",
+                action.disclaimer.name,
+                content_type
+            )
 
-                # Rework text disclaimer to valid html
+            if action.action == constants.ACTION_ACTION_ADDPART:
 
-                disclaimer_text = action.disclaimer.text
+                if decoded is not None:
 
-                disclaimer_charset = action.disclaimer.text_charset
+                    self.encode_part(mail, *decoded)
 
-                do_replace = action.disclaimer.text_use_template
+                new_mail = self.add_part(
+                    mail,
+                    content_type,
+                    disclaimer_text,
+                    disclaimer_charset
+                )
 
-            else:
+                # Carry out the remaining actions on the new multipart
 
-                disclaimer_text = action.disclaimer.html
+                return self.do_actions(new_mail, actions[index + 1:], path)
 
-                disclaimer_charset = action.disclaimer.html_charset
+            if decoded is None \
+                    and action.action == constants.ACTION_ACTION_ADD \
+                    and content_type == "text/plain":
 
-                do_replace = action.disclaimer.html_use_template
+                # Plain text is simply appended. Try to only encode the
+                # tail of the payload instead of the whole part
 
-            # Optionally recode text to match mail part encoding
+                if self.append_encoded(mail, disclaimer_text, charset) \
+                        is not None:
 
-            charset = mail.get_content_charset()
+                    continue
 
-            logging.debug("Message charset is: %s" % charset)
-            logging.debug("Disclaimer charset is: %s" % disclaimer_charset)
+            if decoded is None:
 
-            if charset is None or charset == "":
+                (encoding, new_text) = self.decode_mail(mail)
 
-                charset = disclaimer_charset
+                # Convert to unicode string, if the mail's in utf-8
 
-            if not charset.lower() == disclaimer_charset.lower():
+                if charset.lower() == "utf-8":
 
-                logging.debug("Message and Disclaimer have different charsets...")
-                self.charsetsmatch = False
+                    new_text = unicode(new_text, "utf-8")
 
-                if isinstance(disclaimer_text, unicode):
+                decoded = [encoding, charset, new_text]
 
-                    # unicode strings can directly be encoded
+            new_text = decoded[2]
 
-                    disclaimer_text = disclaimer_text.encode(
-                        charset.lower(),
-                        "replace"
-                    )
+            if action.action == constants.ACTION_ACTION_REPLACETAG:
 
-                else:
+                new_text = re.sub(
+                    action.action_parameters,
+                    disclaimer_text,
+                    new_text
+                )
 
-                    # Convert string to unicode string and encode it afterwards
+            elif action.action == constants.ACTION_ACTION_ADD:
 
-                    disclaimer_text = disclaimer_text.decode("utf-8").encode(
-                        charset.lower()
-                    )
+                if content_type == "text/plain":
+
+                    # text/plain can simply be concatenated
+
+                    new_text = "%s\n%s" % (new_text, disclaimer_text)
+
+                elif content_type == "text/html":
+
+                    # text/html has to been put before the closing body-tag
+
+                    new_text = self.insert_html(new_text, disclaimer_text)
 
             else:
-                self.charsetsmatch = True
 
-            if do_replace:
+                syslog.error("Invalid action value %d", action.action)
 
-                # The disclaimer has replacement tags. Replace them.
+                continue
 
-                logging.debug("Building replacement dictionary")
+            decoded[2] = new_text
 
-                # Basic replacement dictionary
+        if decoded is not None:
 
-                replacements = {
-                    "sender": self.mail_data["envelope_from"],
-                    "recipient": self.mail_data["envelope_rcpt"],
-                    "header": self.mail_data["headers_dict"],
-                    "resolver": {}
-                }
+            self.check_deadline()
 
-                if action.resolve_sender:
+            self.encode_part(mail, *decoded)
 
-                    # We should resolve the sender. Add resolver replacements
-                    # to the replacement dictionary
+        logging.debug("Helper finished, returning mail")
 
-                    resolved_successfully = False
+        return mail
 
-                    for directory_server in action.directory_servers.all():
+    @staticmethod
+    def insert_html(html, disclaimer_html):
 
-                        if not directory_server.enabled:
+        """ Insert a HTML disclaimer at the end of the body of a HTML text
 
-                            # Directory server is disabled. Skip.
+        :param html: The HTML text
+        :param disclaimer_html: The HTML disclaimer
+        :return: The new HTML text
+        """
 
-                            logging.debug(
-                                "Directory server %s is disabled. Skipping." %
-                                directory_server.name
-                            )
+        # lxml takes long to load and is only needed for HTML disclaimers
 
-                            continue
+        from lxml import etree
 
-                        logging.debug(
-                            "Connecting to directory server %s" %
-                            directory_server.name
-                        )
+        # Parse both texts
 
-                        # The query we need to run against the directory server
+        html_part = etree.HTML(html)
 
-                        query = directory_server.search_query % (
-                            self.mail_data["envelope_from"],
-                        )
+        disclaimer_part = etree.HTML(disclaimer_html)
 
-                        result = None
+        body = disclaimer_part.xpath("body")[0]
 
-                        # Do we have that query cached?
+        if len(html_part.xpath("body")) > 0:
 
-                        if directory_server.enable_cache:
+            # Add the new part inside the existing body-tag
 
-                            # Yes. Fetch it from the cache
+            for element in body:
+                html_part.xpath("body")[0].append(element)
 
-                            result = QueryCache.get(directory_server, query)
-                            resolved_successfully = True
+        else:
 
-                        if result is None:
+            # No body found. Just add the new part
+
+            for element in body:
+                html_part.append(element)
+
+        return etree.tostring(
+            html_part,
+            pretty_print=True,
+            method="html"
+        )
 
-                            # No. Fetch it from the server
+    @staticmethod
+    def encode_part(mail, encoding, charset, new_text):
 
-                            urls = directory_server.directoryserverurl_set.all()
+        """ Set the payload of a mail part and encode it using the given
+        Content-Transfer-Encoding
 
-                            for url in urls:
+        :param mail: The mail part
+        :param encoding: The Content-Transfer-Encoding to use
+        :param charset: The charset of the mail part
+        :param new_text: The new (decoded) payload
+        """
 
-                                # Try the different URLs of the server
+        # Convert from unicode string, if mail encoding is utf-8
 
-                                logging.debug("Trying url %s" % url.url)
+        if charset.lower() == "utf-8":
 
-                                conn = ldap.initialize(url.url)
+            new_text = new_text.encode("utf-8")
 
-                                ldap_user = ""
-                                ldap_password = ""
+        # Set payload to new text
 
-                                if directory_server.auth == \
-                                        constants.DIR_AUTH_SIMPLE:
+        mail.set_payload(new_text)
 
-                                    # The directory server needs simple auth
+        if "Content-Transfer-Encoding" in mail:
 
-                                    ldap_user = directory_server.userdn
-                                    ldap_password = directory_server.password
+            # Remove original encode-transfer header
 
-                                try:
+            del(mail["Content-Transfer-Encoding"])
 
-                                    conn.simple_bind_s(
-                                        ldap_user,
-                                        ldap_password
-                                    )
+        logging.debug("Encoding %s with Charset %s", encoding, charset)
 
-                                except ldap.SERVER_DOWN:
+        if encoding == "quoted-printable":
 
-                                    # Cannot reach server. Skip.
+            email.encoders.encode_quopri(mail)
 
-                                    syslog.warning(
-                                        "Cannot reach server %s. "
-                                        "Skipping." % url
-                                    )
+        elif encoding == "base64":
 
-                                    continue
+            email.encoders.encode_base64(mail)
 
-                                except (
-                                    ldap.INVALID_CREDENTIALS,
-                                    ldap.INVALID_DN_SYNTAX
-                                ):
+        else:
 
-                                    # Cannot authenticate. Skip.
+            mail.add_header("Content-Transfer-Encoding", encoding)
 
-                                    syslog.warning(
-                                        "Cannot authenticate to directory "
-                                        "server %s with dn %s. "
-                                        "Skipping." % (
-                                            url,
-                                            directory_server.userdn
-                                        )
-                                    )
+        logging.debug(
+            "Post Content-Transfer-Encoding: %s",
+            mail["Content-Transfer-Encoding"]
+        )
 
-                                    continue
+    @staticmethod
+    def add_part(mail, content_type, disclaimer_text, disclaimer_charset):
 
-                                try:
+        """ Add another mailpart by converting the current part to a
+        multipart, adding itself and the disclaimer part to it
 
-                                    # Send the query
+        :param mail: The mail part
+        :param content_type: The content type of the disclaimer
+        :param disclaimer_text: The disclaimer text
+        :param disclaimer_charset: The charset of the disclaimer
+        :return: The new multipart
+        """
 
-                                    result = conn.search_s(
-                                        directory_server.base_dn,
-                                        ldap.SCOPE_SUBTREE,
-                                        query
-                                    )
+        mail_disclaimer = None
 
-                                except ldap.SERVER_DOWN:
+        if content_type == "text/plain":
 
-                                    # Cannot reach server. Skip.
+            mail_disclaimer = email.mime.text.MIMEText(
+                disclaimer_text,
+                "plain",
+                disclaimer_charset
+            )
 
-                                    syslog.warning("Cannot reach server %s. "
-                                                   "Skipping." % url)
+        elif content_type == "text/html":
 
-                                    continue
+            mail_disclaimer = email.mime.text.MIMEText(
+                disclaimer_text,
+                "html",
+                disclaimer_charset
+            )
 
-                                except (ldap.INVALID_CREDENTIALS,
-                                        ldap.NO_SUCH_OBJECT):
+        new_mail = email.mime.multipart.MIMEMultipart("mixed")
 
-                                    # Cannot authenticate or cannot query.
-                                    # Perhaps the authentication was wrong (
-                                    # guest login without an enabled guest
-                                    # login)
+        # Transfer the old headers to the new multipart mail
 
-                                    syslog.warning("Cannot authenticate to "
-                                                   "directory server %s as "
-                                                   "guest or cannot query. "
-                                                   "Skipping." % url)
+        bad_headers = (
+            "content-type",
+            "content-transfer-encoding",
+            "mime-version",
+            "content-disposition",
+            "content-description"
+        )
 
-                                    continue
+        for header in mail.keys():
 
-                                if not result:
+            value = mail[header]
 
-                                    if action.resolve_sender_fail:
+            if header.lower() not in bad_headers:
 
-                                        syslog.warning(
-                                            "Cannot resolve email %s. "
-                                            "Skipping" % 
-                                                self.mail_data["envelope_from"]
-                                        )
+                new_mail.add_header(header, value)
 
-                                        return
+        rfc822_part = email.mime.message.MIMEMessage(mail)
 
-                                    syslog.warning( 
-                                        "Cannot resolve email %s" %
-                                            self.mail_data["envelope_from"]
-                                    )
+        new_mail.attach(rfc822_part)
+        new_mail.attach(mail_disclaimer)
 
-                                    continue
+        # Use as_string once to let the boundary be generated
 
-                                elif len(result) > 1:
+        new_mail.as_string()
 
-                                    syslog.warning(
-                                        "Multiple results found for "
-                                        "email %s. " %
-                                            self.mail_data["envelope_from"]
-                                    )
+        return new_mail
 
-                                    if action.resolve_sender_fail:
 
-                                        syslog.warning(
-                                            "Cannot reliable resolve email %s. "
-                                            "Skipping" %
-                                                self.mail_data["envelope_from"]
-                                        )
+    def get_disclaimer(self, action, content_type, part_charset):
 
-                                        return
+        """ Build the disclaimer text of an action for a mail part. Template
+        tags are replaced and the sender is resolved, if the action says so.
 
-                                # Found something.
+        The result is cached per message, so that multiple parts of the same
+        content type don't resolve the same disclaimer twice.
 
-                                logging.debug("Found entry %s" % result[0][0])
+        :param action: The action to carry out
+        :param content_type: The content type of the disclaimer
+        :param part_charset: The charset of the mail part
+        :return: A tuple of the disclaimer text, the disclaimer charset and the
+            charset to use for the mail part or None, if the disclaimer can't
+            be used
+        """
 
-                                # Store cache if we should
+        cache_key = (action.id, content_type, part_charset)
 
-                                if directory_server.enable_cache:
+        if cache_key in self.disclaimer_cache:
 
-                                    QueryCache.set(
-                                        directory_server,
-                                        query,
-                                        result
-                                    )
+            return self.disclaimer_cache[cache_key]
 
-                                resolved_successfully = True
+        self.check_deadline()
 
-                                # Resolved successfully. Break this loop
+        disclaimer = self.build_disclaimer(action, content_type, part_charset)
 
-                                break
+        self.disclaimer_cache[cache_key] = disclaimer
 
-                        if result is not None\
-                           and len(result) == 1:
+        return disclaimer
 
-                            # Flatten result into replacement dict and
-                            # convert to unicode strings while you're at it
+    def build_disclaimer(self, action, content_type, part_charset):
 
-                            for key in result[0][1].keys():
+        """ Build the disclaimer text of an action for a mail part (see
+        get_disclaimer)
 
-                                try:
+        :param action: The action to carry out
+        :param content_type: The content type of the disclaimer
+        :param part_charset: The charset of the mail part
+        :return: A tuple of the disclaimer text, the disclaimer charset and the
+            charset to use for the mail part or None, if the disclaimer can't
+            be used
+        """
 
-                                    replacements["resolver"][
-                                        key.lower()
-                                    ] = unicode(
-                                        ",".join(result[0][1][key]),
-                                        "utf-8"
-                                    )
+        # Set disclaimer text
 
-                                except UnicodeDecodeError:
+        logging.debug("Setting disclaimer text")
 
-                                    # There's probably a binary string there.
-                                    # Encode it in base64
+        if content_type == "text/plain":
 
-                                    replacements["resolver"][
-                                        key.lower()
-                                    ] = unicode(
-                                        base64.b64encode(
-                                            "".join(result[0][1][key])
-                                        )
-                                    )
+            disclaimer_text = action.disclaimer.text
 
-                    if not resolved_successfully and action.resolve_sender_fail:
+            disclaimer_charset = action.disclaimer.text_charset
 
-                        # We didn't reach any directory server (url).
+            do_replace = action.disclaimer.text_use_template
 
-                        syslog.warning(
-                            "Cannot resolve email %s. "
-                            "Skipping" % self.mail_data["envelope_from"]
-                        )
+        elif action.disclaimer.html_use_text:
 
-                        return
+            # Rework text disclaimer to valid html
 
-                # Replace template text
+            disclaimer_text = action.disclaimer.text
 
-                logging.debug("Replacing template text")
+            disclaimer_charset = action.disclaimer.text_charset
 
-                # A template tag like {key}
-                # but not {rt}
+            do_replace = action.disclaimer.text_use_template
 
-                template = re.compile("\{((?!rt|\/rt)[^}]*)\}")
-                
-                # A template tag referring to a dictionary like {key["test"]}
+        else:
 
-                subkey_template = re.compile("^([^\[]*)\[\"([^\"]*)\"\]$")
+            disclaimer_text = action.disclaimer.html
 
-                while True:
+            disclaimer_charset = action.disclaimer.html_charset
 
-                    # Search for template strings
+            do_replace = action.disclaimer.html_use_template
 
-                    match = template.search(disclaimer_text)
+        # Optionally recode text to match mail part encoding
 
-                    if not match:
+        charset = part_charset
 
-                        # No more template strings
+        logging.debug("Message charset is: %s", charset)
+        logging.debug("Disclaimer charset is: %s", disclaimer_charset)
 
-                        break
+        if charset is None or charset == "":
 
-                    key = match.groups()[0].lower()
+            charset = disclaimer_charset
 
-                    logging.debug("Replacing key %s" % key)
+        if not charset.lower() == disclaimer_charset.lower():
 
-                    replace_key = match.groups()[0]
+            logging.debug("Message and Disclaimer have different charsets...")
+            self.charsetsmatch = False
 
-                    # Is this key a dictionary-key?
+            if isinstance(disclaimer_text, unicode):
 
-                    dictmatch = subkey_template.search(key)
+                # unicode strings can directly be encoded
 
-                    if dictmatch:
+                disclaimer_text = disclaimer_text.encode(
+                    charset.lower(),
+                    "replace"
+                )
 
-                        # Yes. Resolve that
+            else:
 
-                        key = dictmatch.groups()[0].lower()
-                        subkey = dictmatch.groups()[1].lower()
+                # Convert string to unicode string and encode it afterwards
 
-                        if key in replacements and subkey in replacements[key]:
+                disclaimer_text = disclaimer_text.decode("utf-8").encode(
+                    charset.lower()
+                )
 
-                            value = replacements[key][subkey]
+        else:
+            self.charsetsmatch = True
 
-                        elif action.disclaimer.template_fail:
+        if do_replace:
 
-                            # We cannot resolve the key. Fail.
+            # The disclaimer has replacement tags. Replace them.
 
-                            syslog.warning("Cannot resolve key %s. "
-                                           "Skipping" % key)
+            logging.debug("Building replacement dictionary")
 
-                            return
+            # Basic replacement dictionary
 
-                        else:
+            replacements = {
+                "sender": self.mail_data["envelope_from"],
+                "recipient": self.mail_data["envelope_rcpt"],
+                "header": self.mail_data["headers_dict"],
+                "resolver": {}
+            }
 
-                            logging.debug("Cannot resolve '%s' for '%s'" % (subkey, self.mail_data["envelope_from"]))
+            if action.resolve_sender:
 
-                            value = ""
+                # We should resolve the sender. Add resolver replacements
+                # to the replacement dictionary. python-ldap is only loaded
+                # for this.
 
-                    else:
+                import ldap
 
-                        if key in replacements:
+                resolved_successfully = False
 
-                            value = replacements[key]
+                for directory_server in action.directory_servers:
 
-                        elif action.disclaimer.template_fail:
+                    self.check_deadline()
 
-                            # We cannot resolve the key. Fail.
+                    if not directory_server.enabled:
 
-                            syslog.warning("Cannot resolve key %s. "
-                                           "Skipping" % key)
+                        # Directory server is disabled. Skip.
 
-                            return
+                        logging.debug(
+                            "Directory server %s is disabled. Skipping.",
+                            directory_server.name
+                        )
+
+                        continue
+
+                    logging.debug(
+                        "Connecting to directory server %s",
+                        directory_server.name
+                    )
+
+                    # The query we need to run against the directory server
+
+                    query = directory_server.search_query % (
+                        self.mail_data["envelope_from"],
+                    )
+
+                    result = None
+
+                    # Do we have that query cached?
+
+                    if directory_server.enable_cache:
+
+                        # Yes. Fetch it from the cache
+
+                        result = QueryCache.get(directory_server, query)
+                        resolved_successfully = True
+
+                        if result is None:
+
+                            self.stats["cache_misses"] += 1
 
                         else:
 
-                            logging.debug("Cannot resolve '%s' for '%s'" % (subkey, self.mail_data["envelope_from"]))
+                            self.stats["cache_hits"] += 1
 
-                            value = ""
+                    if result is None:
 
-                    if len(value) > 0:
-                        
-                        # We have a result so clean up the rtag if present
-                        removetag = re.search("{rt}(.*)({resolver\[\"" + subkey + "\"\]})(.*){\/rt}", disclaimer_text, re.IGNORECASE)
-                        
-                        if removetag:
-                            logging.debug("Cleaning tag up...")
-                            replace_key = "rt}" + removetag.groups()[0] + removetag.groups()[1] + removetag.groups()[2] + "{/rt"
-                            value = removetag.groups()[0] + value + removetag.groups()[2]
+                        # No. Fetch it from the server
 
-                        if not self.charsetsmatch:
-                            logging.debug("Reencoding resolver to match message charset...")
-                            value = value.encode(charset)
+                        urls = directory_server.urls
 
-                        disclaimer_text = disclaimer_text.replace(
-                            "{%s}" % replace_key,
-                            value
-                        )
-                        
-                    else:
-                        
-                        # We have no result so either remove the
-                        # tag or - if not applicable - the resolver
+                        for url in urls:
 
-                        remove = re.search("(\n)?{rt}.*{resolver\[\"" + subkey + "\"\]}.*{\/rt}(\r|<br \/>)?|{resolver\[\"" + subkey + "\"\]}", disclaimer_text, re.IGNORECASE)
-                        
-                        if remove:
-                            logging.debug("Removing tag...")
-                            disclaimer_text = disclaimer_text[:remove.start()] + disclaimer_text[remove.end():]
+                            # Try the different URLs of the server
 
-            # If the HTML disclaimer should be the same as the text
-            # disclaimer, reformat it to make it HTML-usable
+                            self.check_deadline()
 
-            if content_type == "text/html" \
-                    and action.disclaimer.html_use_text:
+                            logging.debug("Trying url %s", url.url)
 
-                disclaimer_text = self.make_html(disclaimer_text)
+                            start = time.time()
 
-            # Carry out the action
+                            conn = ldap.initialize(url.url)
 
-            logging.debug(
-                "Adding Disclaimer %s to body (%s)" % (action.disclaimer.name, content_type)
-            )
+                            ldap_user = ""
+                            ldap_password = ""
 
-            (encoding, new_text) = self.decode_mail(mail)
+                            if directory_server.auth == \
+                                    constants.DIR_AUTH_SIMPLE:
 
-            # Convert to unicode string, if the mail's in utf-8
+                                # The directory server needs simple auth
 
-            if charset.lower() == "utf-8":
+                                ldap_user = directory_server.userdn
+                                ldap_password = directory_server.password
 
-                new_text = unicode(new_text, "utf-8")
+                            try:
 
-            if action.action == constants.ACTION_ACTION_REPLACETAG:
+                                conn.simple_bind_s(
+                                    ldap_user,
+                                    ldap_password
+                                )
 
-                new_text = re.sub(
-                    action.action_parameters,
-                    disclaimer_text,
-                    new_text
-                )
+                            except ldap.SERVER_DOWN:
 
-            elif action.action == constants.ACTION_ACTION_ADD:
+                                # Cannot reach server. Skip.
 
-                if content_type == "text/plain":
+                                syslog.warning(
+                                    "Cannot reach server %s. "
+                                    "Skipping.", url
+                                )
 
-                    # text/plain can simply be concatenated
+                                self.count_ldap(start, error=True)
 
-                    new_text = "%s\n%s" % (new_text, disclaimer_text)
+                                metrics.inc(
+                                    "disclaimr_ldap_errors_total",
+                                    server=directory_server.name,
+                                    url=url.url
+                                )
 
-                elif content_type == "text/html":
+                                continue
 
-                    # text/html has to been put before the closing body-tag,
-                    # so parse the text
+                            except (
+                                ldap.INVALID_CREDENTIALS,
+                                ldap.INVALID_DN_SYNTAX
+                            ):
 
-                    html_part = etree.HTML(new_text)
+                                # Cannot authenticate. Skip.
 
-                    disclaimer_part = etree.HTML(disclaimer_text)
+                                syslog.warning(
+                                    "Cannot authenticate to directory "
+                                    "server %s with dn %s. "
+                                    "Skipping.",
+                                    url,
+                                    directory_server.userdn
+                                )
 
-                    body = disclaimer_part.xpath("body")[0]
+                                self.count_ldap(start, error=True)
 
-                    if len(html_part.xpath("body")) > 0:
+                                metrics.inc(
+                                    "disclaimr_ldap_errors_total",
+                                    server=directory_server.name,
+                                    url=url.url
+                                )
 
-                        # Add the new part inside the existing body-tag
+                                continue
 
-                        for element in body:
-                            html_part.xpath("body")[0].append(element)
+                            try:
 
-                    else:
+                                # Send the query
 
-                        # No body found. Just add the new part
+                                result = conn.search_s(
+                                    directory_server.base_dn,
+                                    ldap.SCOPE_SUBTREE,
+                                    query
+                                )
 
-                        for element in body:
-                            html_part.appand(element)
+                            except ldap.SERVER_DOWN:
 
-                    new_text = etree.tostring(
-                        html_part,
-                        pretty_print=True,
-                        method="html"
-                    )
+                                # Cannot reach server. Skip.
 
-            elif action.action == constants.ACTION_ACTION_ADDPART:
+                                syslog.warning("Cannot reach server %s. "
+                                               "Skipping.", url)
 
-                # Add another mailpart by converting the current part to a
-                # multipart, adding itself and the disclaimer part to it
+                                self.count_ldap(start, error=True)
 
-                mail_disclaimer = None
+                                metrics.inc(
+                                    "disclaimr_ldap_errors_total",
+                                    server=directory_server.name,
+                                    url=url.url
+                                )
 
-                if content_type == "text/plain":
+                                continue
 
-                    mail_disclaimer = email.mime.text.MIMEText(
-                        disclaimer_text,
-                        "plain",
-                        disclaimer_charset
-                    )
+                            except (ldap.INVALID_CREDENTIALS,
+                                    ldap.NO_SUCH_OBJECT):
 
-                elif content_type == "text/html":
+                                # Cannot authenticate or cannot query.
+                                # Perhaps the authentication was wrong (
+                                # guest login without an enabled guest
+                                # login)
+
+                                syslog.warning("Cannot authenticate to "
+                                               "directory server %s as "
+                                               "guest or cannot query. "
+                                               "Skipping.", url)
 
-                    mail_disclaimer = email.mime.text.MIMEText(
-                        disclaimer_text,
-                        "html",
-                        disclaimer_charset
+                                self.count_ldap(start, error=True)
+
+                                metrics.inc(
+                                    "disclaimr_ldap_errors_total",
+                                    server=directory_server.name,
+                                    url=url.url
+                                )
+
+                                continue
+
+                            self.count_ldap(start)
+
+                            metrics.observe(
+                                "disclaimr_ldap_seconds",
+                                time.time() - start,
+                                server=directory_server.name,
+                                url=url.url
+                            )
+
+                            if not result:
+
+                                if action.resolve_sender_fail:
+
+                                    syslog.warning(
+                                        "Cannot resolve email %s. "
+                                        "Skipping",
+                                        self.mail_data["envelope_from"]
+                                    )
+
+                                    return
+
+                                syslog.warning( 
+                                    "Cannot resolve email %s",
+                                    self.mail_data["envelope_from"]
+                                )
+
+                                continue
+
+                            elif len(result) > 1:
+
+                                syslog.warning(
+                                    "Multiple results found for "
+                                    "email %s. ",
+                                    self.mail_data["envelope_from"]
+                                )
+
+                                if action.resolve_sender_fail:
+
+                                    syslog.warning(
+                                        "Cannot reliable resolve email %s. "
+                                        "Skipping",
+                                        self.mail_data["envelope_from"]
+                                    )
+
+                                    return
+
+                            # Found something.
+
+                            logging.debug("Found entry %s", result[0][0])
+
+                            # Store cache if we should
+
+                            if directory_server.enable_cache:
+
+                                QueryCache.set(
+                                    directory_server,
+                                    query,
+                                    result
+                                )
+
+                            resolved_successfully = True
+
+                            # Resolved successfully. Break this loop
+
+                            break
+
+                    if result is not None\
+                       and len(result) == 1:
+
+                        # Flatten result into replacement dict and
+                        # convert to unicode strings while you're at it
+
+                        for key in result[0][1].keys():
+
+                            try:
+
+                                replacements["resolver"][
+                                    key.lower()
+                                ] = unicode(
+                                    ",".join(result[0][1][key]),
+                                    "utf-8"
+                                )
+
+                            except UnicodeDecodeError:
+
+                                # There's probably a binary string there.
+                                # Encode it in base64
+
+                                replacements["resolver"][
+                                    key.lower()
+                                ] = unicode(
+                                    base64.b64encode(
+                                        "".join(result[0][1][key])
+                                    )
+                                )
+
+                if not resolved_successfully and action.resolve_sender_fail:
+
+                    # We didn't reach any directory server (url).
+
+                    syslog.warning(
+                        "Cannot resolve email %s. "
+                        "Skipping",
+                        self.mail_data["envelope_from"]
                     )
 
-                new_mail = email.mime.multipart.MIMEMultipart("mixed")
+                    return
 
-                # Transfer the old headers to the new multipart mail
+            # Replace template text
 
-                bad_headers = (
-                    "content-type",
-                    "content-transfer-encoding",
-                    "mime-version",
-                    "content-disposition",
-                    "content-description"
-                )
+            logging.debug("Replacing template text")
 
-                for header in mail.keys():
+            # A template tag like {key}
+            # but not {rt}
 
-                    value = mail[header]
+            template = re.compile("\{((?!rt|\/rt)[^}]*)\}")
+            
+            # A template tag referring to a dictionary like {key["test"]}
 
-                    if header.lower() not in bad_headers:
+            subkey_template = re.compile("^([^\[]*)\[\"([^\"]*)\"\]$")
 
-                        new_mail.add_header(header, value)
+            while True:
 
-                rfc822_part = email.mime.message.MIMEMessage(mail)
+                # Search for template strings
 
-                new_mail.attach(rfc822_part)
-                new_mail.attach(mail_disclaimer)
+                match = template.search(disclaimer_text)
 
-                # Use as_string once to let the boundary be generated
+                if not match:
 
-                new_mail.as_string()
+                    # No more template strings
 
-                return new_mail
+                    break
 
-            else:
+                key = match.groups()[0].lower()
 
-                syslog.error("Invalid action value %d" % action.action)
+                logging.debug("Replacing key %s", key)
 
-                return
+                replace_key = match.groups()[0]
 
-            # Convert from unicode string, if mail encoding is utf-8
+                # Is this key a dictionary-key?
 
-            if charset.lower() == "utf-8":
+                dictmatch = subkey_template.search(key)
 
-                new_text = new_text.encode("utf-8")
+                if dictmatch:
 
-            # Set payload to new text
+                    # Yes. Resolve that
 
-            mail.set_payload(new_text)
+                    key = dictmatch.groups()[0].lower()
+                    subkey = dictmatch.groups()[1].lower()
 
-            if "Content-Transfer-Encoding" in mail:
+                    if key in replacements and subkey in replacements[key]:
 
-                # Remove original encode-transfer header
+                        value = replacements[key][subkey]
 
-                del(mail["Content-Transfer-Encoding"])
+                    elif action.disclaimer.template_fail:
 
-            logging.debug("Encoding %s with Charset %s" % (encoding, charset))
+                        # We cannot resolve the key. Fail.
 
-            if encoding == "quoted-printable":
+                        syslog.warning("Cannot resolve key %s. "
+                                       "Skipping", key)
 
-                email.encoders.encode_quopri(mail)
+                        return
 
-            elif encoding == "base64":
+                    else:
 
-                email.encoders.encode_base64(mail)
-                
-            else:
-                
-                mail.add_header("Content-Transfer-Encoding", encoding)
-                
-            logging.debug("Post Content-Transfer-Encoding: %s" % mail["Content-Transfer-Encoding"].lower())
+                        logging.debug("Cannot resolve '%s' for '%s'", subkey, self.mail_data["envelope_from"])
 
-            logging.debug("Helper finished, returning mail")
+                        value = ""
 
-            return mail
+                else:
+
+                    if key in replacements:
+
+                        value = replacements[key]
+
+                    elif action.disclaimer.template_fail:
+
+                        # We cannot resolve the key. Fail.
+
+                        syslog.warning("Cannot resolve key %s. "
+                                       "Skipping", key)
+
+                        return
+
+                    else:
+
+                        logging.debug("Cannot resolve '%s' for '%s'", subkey, self.mail_data["envelope_from"])
+
+                        value = ""
+
+                if len(value) > 0:
+                    
+                    # We have a result so clean up the rtag if present
+                    removetag = re.search("{rt}(.*)({resolver\[\"" + subkey + "\"\]})(.*){\/rt}", disclaimer_text, re.IGNORECASE)
+                    
+                    if removetag:
+                        logging.debug("Cleaning tag up...")
+                        replace_key = "rt}" + removetag.groups()[0] + removetag.groups()[1] + removetag.groups()[2] + "{/rt"
+                        value = removetag.groups()[0] + value + removetag.groups()[2]
+
+                    if not self.charsetsmatch:
+                        logging.debug("Reencoding resolver to match message charset...")
+                        value = value.encode(charset)
+
+                    disclaimer_text = disclaimer_text.replace(
+                        "{%s}" % replace_key,
+                        value
+                    )
+                    
+                else:
+                    
+                    # We have no result so either remove the
+                    # tag or - if not applicable - the resolver
+
+                    remove = re.search("(\n)?{rt}.*{resolver\[\"" + subkey + "\"\]}.*{\/rt}(\r|<br \/>)?|{resolver\[\"" + subkey + "\"\]}", disclaimer_text, re.IGNORECASE)
+                    
+                    if remove:
+                        logging.debug("Removing tag...")
+                        disclaimer_text = disclaimer_text[:remove.start()] + disclaimer_text[remove.end():]
+
+        # If the HTML disclaimer should be the same as the text
+        # disclaimer, reformat it to make it HTML-usable
+
+        if content_type == "text/html" \
+                and action.disclaimer.html_use_text:
+
+            disclaimer_text = self.make_html(disclaimer_text)
+
+        return disclaimer_text, disclaimer_charset, charset
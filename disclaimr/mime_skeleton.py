@@ -0,0 +1,439 @@
+""" A lightweight MIME structure parser
+
+Parsing a mail with email.message_from_string creates a string for every
+part of it, including large attachments. The MIME skeleton only parses the
+headers of the parts and keeps their bodies as ranges of the mail buffer.
+Parts, that should be modified, can be converted to email.message.Message
+objects. All other parts are copied verbatim when the mail is serialized
+again.
+"""
+
+import email
+import email.parser
+
+# The maximum size of a body chunk in the milter protocol
+
+CHUNK_SIZE = 65535
+
+
+class LimitExceeded(Exception):
+
+    """ A mail exceeded a processing limit
+    """
+
+    pass
+
+
+class ParseLimits(object):
+
+    """ Limits of the number of parts and the nesting depth of a mail
+    """
+
+    def __init__(self, max_parts=0, max_depth=0):
+
+        """ Set the limits
+
+        :param max_parts: The maximum number of parts (0 for no limit)
+        :param max_depth: The maximum nesting depth (0 for no limit)
+        :return: The limits
+        """
+
+        self.max_parts = max_parts
+
+        self.max_depth = max_depth
+
+        self.parts = 0
+
+    def add_part(self, depth):
+
+        """ Count a part and check the limits
+
+        :param depth: The nesting depth of the part
+        """
+
+        self.parts += 1
+
+        if 0 < self.max_parts < self.parts:
+
+            raise LimitExceeded(
+                "More than %d mime parts" % self.max_parts
+            )
+
+        if 0 < self.max_depth < depth:
+
+            raise LimitExceeded(
+                "Mime parts nested deeper than %d" % self.max_depth
+            )
+
+
+class MimePart(object):
+
+    """ A part of a mail
+
+    The part is described by the range [start, end) of the mail buffer. The
+    headers are parsed, the body is not.
+    """
+
+    def __init__(self, buffer, start, end, depth=0, limits=None):
+
+        """ Parse the part in the given range of the buffer
+
+        :param buffer: The mail buffer
+        :param start: The start of the part (including its headers)
+        :param end: The end of the part
+        :param depth: The nesting depth of the part
+        :param limits: ParseLimits to check while parsing
+        :return: The part
+        """
+
+        if limits is not None:
+
+            limits.add_part(depth)
+
+        self.buffer = buffer
+
+        self.start = start
+
+        self.end = end
+
+        self.body_start = find_body(buffer, start, end)
+
+        self.headers = email.parser.HeaderParser().parsestr(
+            buffer[start:self.body_start]
+        )
+
+        self.content_type = self.headers.get_content_type().lower()
+
+        self.children = []
+
+        self.message = None
+
+        if self.content_type.startswith("multipart/"):
+
+            boundary = self.headers.get_boundary()
+
+            if boundary is not None:
+
+                self.children = [
+                    MimePart(buffer, child_start, child_end, depth + 1, limits)
+                    for (child_start, child_end) in find_parts(
+                        buffer,
+                        boundary,
+                        self.body_start,
+                        end
+                    )
+                ]
+
+        elif self.content_type == "message/rfc822" \
+                and self.body_start < end:
+
+            # An attached mail. Its body is a complete mail again
+
+            self.children = [
+                MimePart(buffer, self.body_start, end, depth + 1, limits)
+            ]
+
+    def get_paths(self, path=()):
+
+        """ Return the content types of all non-multipart parts
+
+        :param path: The content types of the enclosing multiparts
+        :return: A list with a tuple for every non-multipart part holding the
+            content types of the part and all the multiparts it is enclosed
+            in (outermost first)
+        """
+
+        path = path + (self.content_type,)
+
+        if len(self.children) == 0:
+
+            return [path]
+
+        paths = []
+
+        for child in self.children:
+
+            paths.extend(child.get_paths(path))
+
+        return paths
+
+    def get_message(self):
+
+        """ Parse the part into a message object
+
+        :return: The part as an email.message.Message
+        """
+
+        return email.message_from_string(self.buffer[self.start:self.end])
+
+    def set_message(self, message):
+
+        """ Replace the part with a message object. The message will be used
+        when serializing the part.
+
+        :param message: An email.message.Message
+        """
+
+        self.message = message
+
+    def is_modified(self):
+
+        """ Check, if this part or one of its subparts was replaced
+
+        :return: Wether the part was modified
+        """
+
+        if self.message is not None:
+
+            return True
+
+        for child in self.children:
+
+            if child.is_modified():
+
+                return True
+
+        return False
+
+    def serialize(self, body_only=False):
+
+        """ Serialize the part. Parts, that weren't replaced, are copied
+        verbatim from the mail buffer.
+
+        This is a generator, so the serialized mail is never held in memory
+        as a whole. Unmodified ranges of the buffer are copied in pieces of
+        at most CHUNK_SIZE.
+
+        :param body_only: Leave out the headers of this part (only possible,
+            if the part wasn't replaced itself)
+        :return: An iterator over strings, that make up the part
+        """
+
+        if self.message is not None:
+
+            text = self.message.as_string()
+
+            if self.buffer[self.start:self.body_start].endswith("\r\n"):
+
+                # Keep the line endings of the mail
+
+                text = text.replace("\r\n", "\n").replace("\n", "\r\n")
+
+            yield text
+
+            return
+
+        position = self.body_start if body_only else self.start
+
+        for child in self.children:
+
+            for piece in self.copy_range(position, child.start):
+
+                yield piece
+
+            for piece in child.serialize():
+
+                yield piece
+
+            position = child.end
+
+        for piece in self.copy_range(position, self.end):
+
+            yield piece
+
+    def copy_range(self, start, end):
+
+        """ Copy a range of the mail buffer
+
+        :param start: The start of the range
+        :param end: The end of the range
+        :return: An iterator over pieces of the range of at most CHUNK_SIZE
+        """
+
+        for position in xrange(start, end, CHUNK_SIZE):
+
+            yield self.buffer[position:min(position + CHUNK_SIZE, end)]
+
+
+def find_body(buffer, start, end):
+
+    """ Find the start of the body of a part (the position after the first
+    empty line)
+
+    :param buffer: The mail buffer
+    :param start: The start of the part
+    :param end: The end of the part
+    :return: The start of the body or the end of the part, if the part
+        has no body
+    """
+
+    # The part starts with an empty line, so it has no headers
+
+    if buffer.startswith("\r\n", start, end):
+
+        return start + 2
+
+    if buffer.startswith("\n", start, end):
+
+        return start + 1
+
+    body_start = end
+
+    for separator in ("\n\n", "\n\r\n"):
+
+        position = buffer.find(separator, start, end)
+
+        if position != -1:
+
+            body_start = min(body_start, position + len(separator))
+
+    return body_start
+
+
+def find_parts(buffer, boundary, start, end):
+
+    """ Find the subparts of a multipart body
+
+    :param buffer: The mail buffer
+    :param boundary: The boundary of the multipart
+    :param start: The start of the multipart's body
+    :param end: The end of the multipart's body
+    :return: A list of tuples with the start and end of each subpart
+    """
+
+    delimiter = "--%s" % boundary
+
+    parts = []
+
+    part_start = None
+
+    position = start
+
+    while position < end:
+
+        found = buffer.find(delimiter, position, end)
+
+        if found == -1:
+
+            break
+
+        line_end = buffer.find("\n", found, end)
+
+        if line_end == -1:
+
+            line_end = end
+
+        else:
+
+            line_end += 1
+
+        if found > start and buffer[found - 1] != "\n":
+
+            # Not at the start of a line. No delimiter.
+
+            position = line_end
+
+            continue
+
+        rest = buffer[found + len(delimiter):line_end].strip()
+
+        if rest != "" and not rest.startswith("--"):
+
+            # Another boundary starting with this boundary
+
+            position = line_end
+
+            continue
+
+        if part_start is not None:
+
+            # The line break before the delimiter belongs to the delimiter
+
+            part_end = found
+
+            if buffer[max(found - 2, start):found] == "\r\n":
+
+                part_end -= 2
+
+            elif found > start:
+
+                part_end -= 1
+
+            parts.append((part_start, max(part_start, part_end)))
+
+        if rest.startswith("--"):
+
+            # The closing delimiter
+
+            part_start = None
+
+            break
+
+        part_start = line_end
+
+        position = line_end
+
+    if part_start is not None:
+
+        # Missing closing delimiter. The last part ends with the multipart
+
+        parts.append((part_start, end))
+
+    return parts
+
+
+def make_chunks(pieces, chunk_size=CHUNK_SIZE):
+
+    """ Regroup strings into chunks of a maximum size
+
+    :param pieces: An iterable of strings
+    :param chunk_size: The maximum size of a chunk
+    :return: An iterator over the chunks. All chunks but the last have
+        exactly chunk_size characters.
+    """
+
+    pending = []
+
+    pending_size = 0
+
+    for piece in pieces:
+
+        # Walk through the piece with an offset. Slicing off the rest would
+        # copy it for every chunk.
+
+        offset = 0
+
+        while offset < len(piece):
+
+            space = chunk_size - pending_size
+
+            pending.append(piece[offset:offset + space])
+
+            pending_size += min(len(piece) - offset, space)
+
+            offset += space
+
+            if pending_size == chunk_size:
+
+                yield "".join(pending)
+
+                pending = []
+
+                pending_size = 0
+
+    if pending_size > 0:
+
+        yield "".join(pending)
+
+
+def parse_mail(buffer, limits=None):
+
+    """ Parse the MIME skeleton of a mail
+
+    :param buffer: The complete mail (headers and body)
+    :param limits: ParseLimits to check while parsing. LimitExceeded is
+        raised, if the mail exceeds them.
+    :return: The MimePart of the mail
+    """
+
+    return MimePart(buffer, 0, len(buffer), 0, limits)
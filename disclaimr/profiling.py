@@ -0,0 +1,453 @@
+""" Profiling of a running milter
+
+The next mails handled by a process can be profiled on request (SIGUSR1).
+Their stats are summed up and written to the profile directory, when the
+last of them is done. The listening process of the fork mode shares the
+request with the connection processes it forks. They write the stats of
+their mails to part files, that the last one sums up.
+
+A dump of the stacks of all threads and the garbage collector's view of the
+memory can be written at any time (SIGUSR2).
+"""
+import cProfile
+import gc
+import glob
+import logging
+import multiprocessing
+import os
+import pstats
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+syslog = logging.getLogger('disclaimr')
+
+TOP_TYPES = 25
+
+""" The number of object types listed in a dump """
+
+directory = tempfile.gettempdir()
+
+""" The directory the profiles and dumps are written to """
+
+count = 100
+
+""" The number of mails profiled per request """
+
+# Reentrant, as requests come from signal handlers
+
+lock = threading.RLock()
+
+remaining = 0
+
+""" The number of mails still to profile """
+
+active = 0
+
+""" The number of mails being profiled """
+
+stats = None
+
+""" The summed up stats of the profiled mails """
+
+profiled = 0
+
+""" The number of mails in the stats """
+
+REMAINING = 0
+
+ACTIVE = 1
+
+shared = None
+
+""" The numbers of mails still to profile and being profiled (see REMAINING
+and ACTIVE), if they are shared between processes """
+
+shared_lock = None
+
+""" Guards the shared numbers """
+
+owner = None
+
+""" The id of the process sharing the numbers """
+
+
+class RemoteProfile(object):
+
+    """ The stats of a profile collected by another process. They are added
+    to the stats like a cProfile.Profile.
+    """
+
+    def __init__(self, stats):
+
+        """ Wrap the stats
+
+        :param stats: The stats dictionary of a cProfile.Profile after
+            create_stats
+        :return: The profile
+        """
+
+        self.stats = stats
+
+    def create_stats(self):
+
+        """ The stats are already created
+        """
+
+        pass
+
+
+def make_path(extension):
+
+    """ Build the path of a file in the profile directory
+
+    :param extension: The file extension
+    :return: The path containing the process id and the current time
+    """
+
+    return os.path.join(
+        directory,
+        "disclaimr-%d-%s.%s" % (
+            os.getpid(), time.strftime("%Y%m%d%H%M%S"), extension
+        )
+    )
+
+
+def request(mails=None):
+
+    """ Profile the next mails
+
+    :param mails: The number of mails to profile. Defaults to count.
+    """
+
+    global remaining
+
+    if mails is None:
+
+        mails = count
+
+    with lock:
+
+        remaining = mails
+
+        if shared is not None:
+
+            with shared_lock:
+
+                shared[REMAINING] = mails
+
+    syslog.info("Profiling the next %d mails", mails)
+
+
+def share():
+
+    """ Share the requests with the processes forked afterwards. Used by the
+    listening process of the fork mode.
+    """
+
+    global shared, shared_lock, owner
+
+    shared = multiprocessing.RawArray("i", 2)
+
+    shared_lock = multiprocessing.Lock()
+
+    owner = os.getpid()
+
+
+def after_fork():
+
+    """ Reset the stats in a forked connection process. The shared requests
+    are kept.
+    """
+
+    global lock, remaining, active, stats, profiled
+
+    lock = threading.RLock()
+
+    remaining = 0
+
+    active = 0
+
+    stats = None
+
+    profiled = 0
+
+
+def start():
+
+    """ Start profiling a mail, if it was requested
+
+    The profile has to be enabled in every thread working on the mail.
+
+    :return: An enabled cProfile.Profile or None, if the mail shouldn't be
+        profiled
+    """
+
+    global remaining, active
+
+    if shared is not None:
+
+        if shared[REMAINING] <= 0:
+
+            return None
+
+        with shared_lock:
+
+            if shared[REMAINING] <= 0:
+
+                return None
+
+            shared[REMAINING] -= 1
+
+            shared[ACTIVE] += 1
+
+    else:
+
+        if remaining <= 0:
+
+            return None
+
+        with lock:
+
+            if remaining <= 0:
+
+                return None
+
+            remaining -= 1
+
+            active += 1
+
+    profile = cProfile.Profile()
+
+    profile.enable()
+
+    return profile
+
+
+def cancel(profile):
+
+    """ Stop profiling, as no mail was processed (the connection was closed
+    before). The requested mail is left to the next one.
+
+    :param profile: The profile as returned by start
+    """
+
+    global remaining, active
+
+    profile.disable()
+
+    if shared is not None:
+
+        with shared_lock:
+
+            shared[REMAINING] += 1
+
+            shared[ACTIVE] -= 1
+
+        return
+
+    with lock:
+
+        remaining += 1
+
+        active -= 1
+
+
+def finish(profile, remote=()):
+
+    """ Stop profiling a mail. The stats are written, when the last
+    requested mail is done.
+
+    :param profile: The profile as returned by start
+    :param remote: RemoteProfiles of the parts of the mail, that were
+        processed by other processes
+    """
+
+    global active, stats, profiled
+
+    profile.disable()
+
+    if shared is not None:
+
+        finish_shared(profile, remote)
+
+        return
+
+    with lock:
+
+        active -= 1
+
+        if stats is None:
+
+            stats = pstats.Stats(profile)
+
+        else:
+
+            stats.add(profile)
+
+        for remote_profile in remote:
+
+            stats.add(remote_profile)
+
+        profiled += 1
+
+        if remaining > 0 or active > 0:
+
+            return
+
+        write(stats, profiled)
+
+        stats = None
+
+        profiled = 0
+
+
+def finish_shared(profile, remote):
+
+    """ Write the stats of a mail to a part file. The process finishing the
+    last requested mail sums up the parts. Used by finish with shared
+    requests.
+
+    :param profile: The stopped profile
+    :param remote: RemoteProfiles of the mail
+    """
+
+    global profiled
+
+    mail_stats = pstats.Stats(profile)
+
+    for remote_profile in remote:
+
+        mail_stats.add(remote_profile)
+
+    prefix = os.path.join(directory, "disclaimr-%d-" % owner)
+
+    path = "%s%d-%d.part" % (prefix, os.getpid(), profiled)
+
+    profiled += 1
+
+    try:
+
+        mail_stats.dump_stats(path)
+
+    except IOError, e:
+
+        syslog.error("Cannot write the profile to %s: %s", path, e)
+
+    with shared_lock:
+
+        shared[ACTIVE] -= 1
+
+        if shared[REMAINING] > 0 or shared[ACTIVE] > 0:
+
+            return
+
+        parts = glob.glob("%s*.part" % prefix)
+
+    if len(parts) == 0:
+
+        return
+
+    mail_stats = pstats.Stats(*parts)
+
+    for part in parts:
+
+        os.unlink(part)
+
+    write(mail_stats, len(parts))
+
+
+def write(summed_stats, mails):
+
+    """ Write summed up stats to the profile directory
+
+    :param summed_stats: The pstats.Stats
+    :param mails: The number of mails in the stats
+    """
+
+    path = make_path("prof")
+
+    try:
+
+        summed_stats.dump_stats(path)
+
+        syslog.info("Wrote the profile of %d mails to %s", mails, path)
+
+    except IOError, e:
+
+        syslog.error("Cannot write the profile to %s: %s", path, e)
+
+
+def dump(out):
+
+    """ Write the stacks of all threads and the memory usage
+
+    :param out: The file to write to
+    """
+
+    names = dict(
+        (thread.ident, thread.name) for thread in threading.enumerate()
+    )
+
+    for ident, frame in sys._current_frames().items():
+
+        out.write("Thread %s (%s):\n" % (names.get(ident, "unknown"), ident))
+
+        out.write("".join(traceback.format_stack(frame)))
+
+        out.write("\n")
+
+    # Python 2 has no tracemalloc. Count the objects tracked by the garbage
+    # collector by type instead.
+
+    objects = gc.get_objects()
+
+    types = {}
+
+    for obj in objects:
+
+        name = type(obj).__name__
+
+        types[name] = types.get(name, 0) + 1
+
+    out.write(
+        "Max. RSS: %d KiB\n" %
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    )
+
+    out.write("GC counts: %s, thresholds: %s\n" % (
+        gc.get_count(), gc.get_threshold()
+    ))
+
+    out.write("Uncollectable objects: %d\n" % len(gc.garbage))
+
+    out.write("Tracked objects: %d\n\n" % len(objects))
+
+    for name, number in sorted(
+        types.items(), key=lambda item: item[1], reverse=True
+    )[:TOP_TYPES]:
+
+        out.write("%10d %s\n" % (number, name))
+
+
+def write_dump():
+
+    """ Write a dump (see dump) to the profile directory
+    """
+
+    path = make_path("stacks")
+
+    try:
+
+        with open(path, "w") as out:
+
+            dump(out)
+
+        syslog.info("Wrote the stacks to %s", path)
+
+    except IOError, e:
+
+        syslog.error("Cannot write the stacks to %s: %s", path, e)
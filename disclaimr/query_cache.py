@@ -1,6 +1,9 @@
 """ A global cache for milter LDAP queries
 """
 import datetime
+import threading
+
+from disclaimr import metrics
 
 
 class QueryCache(object):
@@ -12,6 +15,10 @@ class QueryCache(object):
 
     """ The cache """
 
+    lock = threading.Lock()
+
+    """ Serializes the access to the cache of concurrent threads """
+
     @staticmethod
     def get(directory_server, query):
 
@@ -22,6 +29,27 @@ class QueryCache(object):
         :return: The query or None if it wasn't cached or has timed out
         """
 
+        with QueryCache.lock:
+
+            result = QueryCache._get(directory_server, query)
+
+        metrics.inc(
+            "disclaimr_query_cache_total",
+            result="miss" if result is None else "hit"
+        )
+
+        return result
+
+    @staticmethod
+    def _get(directory_server, query):
+
+        """ Return a cached query. The lock has to be held.
+
+        :param directory_server: The directory server, that runs the query
+        :param query: The query itself
+        :return: The query or None if it wasn't cached or has timed out
+        """
+
         if directory_server.id not in QueryCache.cache or\
            query not in QueryCache.cache[directory_server.id]:
 
@@ -55,6 +83,20 @@ class QueryCache(object):
         :param data: The data returned from the query
         """
 
+        with QueryCache.lock:
+
+            QueryCache._set(directory_server, query, data)
+
+    @staticmethod
+    def _set(directory_server, query, data):
+
+        """ Add a query to the cache. The lock has to be held.
+
+        :param directory_server: The directory server, that runs the query
+        :param query: The query itself
+        :param data: The data returned from the query
+        """
+
         now = datetime.datetime.now()
 
         if directory_server.id not in QueryCache.cache:
@@ -79,6 +121,17 @@ class QueryCache(object):
         """ Walk through the cache and remove timed out values
         """
 
+        with QueryCache.lock:
+
+            QueryCache._flush()
+
+    @staticmethod
+    def _flush():
+
+        """ Walk through the cache and remove timed out values. The lock has
+        to be held.
+        """
+
         now = datetime.datetime.now()
 
         for directory_server_id in list(QueryCache.cache):
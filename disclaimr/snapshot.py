@@ -0,0 +1,329 @@
+""" Snapshots of the rule set
+
+A snapshot holds the rules, requirements, actions, disclaimers and directory
+servers of the milter in a versioned JSON file. It is written by the
+export_snapshot management command:
+
+    python manage.py export_snapshot -o /var/lib/disclaimr/rules.json
+
+and can be loaded by the milter instead of querying the database
+(disclaimr.py --snapshot). As the directory server passwords are part of
+it, the file is only readable by its owner.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+
+syslog = logging.getLogger('disclaimr')
+
+FORMAT = "disclaimr-snapshot"
+
+""" The format identifier stored in every snapshot """
+
+VERSION = 1
+
+""" The version of the snapshot format """
+
+RULE_FIELDS = ("id", "name", "position", "continue_rules")
+
+REQUIREMENT_FIELDS = (
+    "id", "rule", "name", "enabled", "sender_ip", "sender_ip_cidr", "sender",
+    "recipient", "header", "body", "action"
+)
+
+ACTION_FIELDS = (
+    "id", "rule", "position", "name", "enabled", "action", "only_mime",
+    "action_parameters", "resolve_sender", "resolve_sender_fail",
+    "disclaimer"
+)
+
+DISCLAIMER_FIELDS = (
+    "id", "name", "text", "text_charset", "text_use_template",
+    "html_use_text", "html", "html_charset", "html_use_template",
+    "template_fail", "use_html_fallback"
+)
+
+DIRECTORY_SERVER_FIELDS = (
+    "id", "name", "enabled", "base_dn", "auth", "userdn", "password",
+    "search_query", "enable_cache", "cache_timeout"
+)
+
+PATTERN_FIELDS = ("sender", "recipient", "header", "body")
+
+""" The regular expressions of a requirement """
+
+# The records of the milter. They have the attributes of the model objects,
+# that are used by the milter. As tuples, they have no instance dictionary
+# and are never changed, so forked processes can share them.
+
+Rule = collections.namedtuple("Rule", RULE_FIELDS + ("actions",))
+
+Requirement = collections.namedtuple("Requirement", REQUIREMENT_FIELDS)
+
+Action = collections.namedtuple(
+    "Action",
+    tuple(field for field in ACTION_FIELDS if field != "rule") +
+    ("directory_servers",)
+)
+
+Disclaimer = collections.namedtuple("Disclaimer", DISCLAIMER_FIELDS)
+
+DirectoryServer = collections.namedtuple(
+    "DirectoryServer", DIRECTORY_SERVER_FIELDS + ("urls",)
+)
+
+DirectoryServerURL = collections.namedtuple("DirectoryServerURL", ("url",))
+
+
+class SnapshotError(Exception):
+
+    """ The snapshot can't be read or has an unsupported format
+    """
+
+    pass
+
+
+def export():
+
+    """ Export the active rule set from the database
+
+    Disabled requirements and actions are left out. Disclaimers and directory
+    servers are only exported, if an action uses them.
+
+    :return: The snapshot dictionary
+    """
+
+    from disclaimrwebadmin import models
+
+    snapshot = {
+        "format": FORMAT,
+        "version": VERSION,
+        "created": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+    # The objects are fetched as dictionaries with one query per table, so
+    # the number of queries doesn't grow with the rule set
+
+    snapshot["rules"] = list(
+        models.Rule.objects.values(*RULE_FIELDS)
+    )
+
+    snapshot["requirements"] = list(
+        models.Requirement.objects.filter(enabled=True).values(
+            *REQUIREMENT_FIELDS
+        ).order_by("id")
+    )
+
+    snapshot["actions"] = list(
+        models.Action.objects.filter(enabled=True).values(*ACTION_FIELDS)
+    )
+
+    action_directory_servers = {}
+
+    for (action_id, directory_server_id) in \
+            models.Action.directory_servers.through.objects.filter(
+                action__enabled=True
+            ).values_list("action_id", "directoryserver_id").order_by("id"):
+
+        action_directory_servers.setdefault(action_id, []).append(
+            directory_server_id
+        )
+
+    for action in snapshot["actions"]:
+
+        action["directory_servers"] = action_directory_servers.get(
+            action["id"], []
+        )
+
+    snapshot["disclaimers"] = list(
+        models.Disclaimer.objects.filter(
+            action__enabled=True
+        ).distinct().values(*DISCLAIMER_FIELDS).order_by("id")
+    )
+
+    snapshot["directory_servers"] = list(
+        models.DirectoryServer.objects.filter(
+            action__enabled=True
+        ).distinct().values(*DIRECTORY_SERVER_FIELDS).order_by("id")
+    )
+
+    urls = {}
+
+    for (directory_server_id, url) in models.DirectoryServerURL.objects.filter(
+        directory_server__in=[
+            directory_server["id"]
+            for directory_server in snapshot["directory_servers"]
+        ]
+    ).values_list("directory_server_id", "url"):
+
+        urls.setdefault(directory_server_id, []).append(url)
+
+    for directory_server in snapshot["directory_servers"]:
+
+        directory_server["urls"] = urls.get(directory_server["id"], [])
+
+    return snapshot
+
+
+def write(snapshot, path):
+
+    """ Write a snapshot to a file, that is only readable by its owner
+
+    The file is replaced atomically, so a running milter never reads a
+    partly written snapshot.
+
+    :param snapshot: The snapshot dictionary
+    :param path: The path of the file
+    """
+
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+
+    snapshot_file = os.fdopen(
+        os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "w"
+    )
+
+    try:
+
+        json.dump(snapshot, snapshot_file, separators=(",", ":"))
+
+    finally:
+
+        snapshot_file.close()
+
+    os.rename(temp_path, path)
+
+
+def read(path):
+
+    """ Read a snapshot from a file
+
+    :param path: The path of the file
+    :return: The snapshot dictionary
+    :raises SnapshotError: The file can't be read or has an unsupported
+        format or version
+    """
+
+    try:
+
+        with open(path) as snapshot_file:
+
+            snapshot = json.load(snapshot_file)
+
+    except (IOError, ValueError), e:
+
+        raise SnapshotError("Cannot read the snapshot %s: %s" % (path, e))
+
+    if not isinstance(snapshot, dict) or snapshot.get("format") != FORMAT:
+
+        raise SnapshotError("%s is no disclaimr snapshot" % path)
+
+    if snapshot.get("version") != VERSION:
+
+        raise SnapshotError(
+            "Unsupported snapshot version %s in %s (expected %d)" % (
+                snapshot.get("version"), path, VERSION
+            )
+        )
+
+    return snapshot
+
+
+def build_records(snapshot):
+
+    """ Build the records of a snapshot and link them like the model objects
+
+    Every requirement gets its rule, every rule the tuple of its actions
+    sorted by position, every action its disclaimer and directory servers
+    and every directory server the tuple of its URLs. The regular
+    expressions of the requirements are compiled. Requirements with an
+    invalid regular expression are left out.
+
+    :param snapshot: The snapshot dictionary
+    :return: A dictionary with the rules and requirements by their id
+    """
+
+    disclaimers = dict(
+        (item["id"], Disclaimer(**item)) for item in snapshot["disclaimers"]
+    )
+
+    directory_servers = {}
+
+    for item in snapshot["directory_servers"]:
+
+        fields = dict(item)
+
+        fields["urls"] = tuple(
+            DirectoryServerURL(url) for url in item["urls"]
+        )
+
+        directory_servers[item["id"]] = DirectoryServer(**fields)
+
+    actions = {}
+
+    for item in sorted(
+        snapshot["actions"],
+        key=lambda item: (item["position"], item["id"])
+    ):
+
+        fields = dict(item)
+
+        del(fields["rule"])
+
+        fields["disclaimer"] = disclaimers[item["disclaimer"]]
+
+        fields["directory_servers"] = tuple(
+            directory_servers[directory_server_id]
+            for directory_server_id in item["directory_servers"]
+        )
+
+        actions.setdefault(item["rule"], []).append(Action(**fields))
+
+    rules = {}
+
+    for item in snapshot["rules"]:
+
+        rules[item["id"]] = Rule(
+            actions=tuple(actions.get(item["id"], ())), **item
+        )
+
+    requirements = {}
+
+    # Many requirements use the same regular expressions. Compile them once
+    # and share the compiled patterns.
+
+    patterns = {}
+
+    for item in snapshot["requirements"]:
+
+        fields = dict(item)
+
+        fields["rule"] = rules[item["rule"]]
+
+        try:
+
+            for field in PATTERN_FIELDS:
+
+                if item[field] not in patterns:
+
+                    patterns[item[field]] = re.compile(item[field])
+
+                fields[field] = patterns[item[field]]
+
+        except re.error, e:
+
+            syslog.error(
+                "Skipping requirement %s with the invalid regular "
+                "expression %s: %s", item["id"], item[field], e
+            )
+
+            continue
+
+        requirements[item["id"]] = Requirement(**fields)
+
+    return {
+        "rules": rules,
+        "requirements": requirements
+    }
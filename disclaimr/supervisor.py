@@ -0,0 +1,160 @@
+""" A supervisor running the milter in several worker processes
+"""
+import errno
+import logging
+import os
+import signal
+import time
+import traceback
+
+syslog = logging.getLogger('disclaimr')
+
+
+class Supervisor(object):
+
+    """ Start a number of worker processes and restart them, if they die
+    """
+
+    def __init__(self, workers, target):
+
+        """ Set up the supervisor
+
+        :param workers: The number of worker processes
+        :param target: A function running a worker. It gets the index of the
+            worker and should not return before the worker is stopped.
+        :return: The supervisor
+        """
+
+        self.workers = workers
+
+        self.target = target
+
+        self.pids = {}
+
+        self.started = {}
+
+        self.stopping = False
+
+    def spawn(self, index):
+
+        """ Fork a worker process
+
+        :param index: The index of the worker
+        """
+
+        pid = os.fork()
+
+        if pid == 0:
+
+            # The worker process
+
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            # Ignore forwarded signals, until the worker handles them
+
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+            code = 0
+
+            try:
+
+                self.target(index)
+
+            except SystemExit, e:
+
+                code = e.code or 0
+
+            except Exception, e:
+
+                syslog.error("Worker %d failed: %s", index, e)
+
+                traceback.print_exc()
+
+                code = 1
+
+            os._exit(code)
+
+        self.pids[pid] = index
+
+        self.started[index] = time.time()
+
+    def run(self):
+
+        """ Start the workers and watch them until they are stopped
+        """
+
+        for index in range(self.workers):
+
+            self.spawn(index)
+
+        while len(self.pids) > 0:
+
+            try:
+
+                (pid, status) = os.wait()
+
+            except OSError, e:
+
+                if e.errno == errno.EINTR:
+
+                    # Interrupted by a signal
+
+                    continue
+
+                raise
+
+            if pid not in self.pids:
+
+                continue
+
+            index = self.pids.pop(pid)
+
+            if self.stopping:
+
+                continue
+
+            syslog.warning(
+                "Worker %d (pid %d) died with status %d. Restarting it.",
+                index, pid, status
+            )
+
+            # Don't restart crashing workers too fast
+
+            if time.time() - self.started[index] < 1:
+
+                time.sleep(1)
+
+            self.spawn(index)
+
+    def stop(self, signum=signal.SIGTERM):
+
+        """ Stop all workers
+
+        :param signum: The signal to send to the workers
+        """
+
+        self.stopping = True
+
+        self.send_signal(signum)
+
+    def send_signal(self, signum):
+
+        """ Send a signal to all workers
+
+        :param signum: The signal
+        """
+
+        for pid in self.pids.keys():
+
+            try:
+
+                os.kill(pid, signum)
+
+            except OSError:
+
+                # Already gone
+
+                pass
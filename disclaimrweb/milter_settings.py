@@ -0,0 +1,28 @@
+"""
+Django settings for the disclaimr milter.
+
+The milter only reads the rules from the database. It uses the database and
+local settings of the web administration (see settings.py), but doesn't
+load the admin, session, message and template stack of the web frontend.
+"""
+
+from disclaimrweb.settings import *
+
+INSTALLED_APPS = (
+    'disclaimrwebadmin',
+)
+
+MIDDLEWARE_CLASSES = ()
+
+TEMPLATES = []
+
+# The milter doesn't translate anything
+
+USE_I18N = False
+
+USE_L10N = False
+
+# The milter doesn't serve pages. With DEBUG, Django would keep every
+# query of a connection in memory.
+
+DEBUG = False
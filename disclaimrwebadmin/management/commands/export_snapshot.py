@@ -0,0 +1,36 @@
+""" Export the rule set to a snapshot file for the milter """
+from django.core.management.base import BaseCommand
+from disclaimr import snapshot
+
+
+class Command(BaseCommand):
+
+    help = "Export the active rules, requirements, actions, disclaimers " \
+           "and directory servers to a snapshot file, that the milter " \
+           "can load instead of querying the database " \
+           "(disclaimr.py --snapshot)"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "-o",
+            "--output",
+            dest="output",
+            required=True,
+            help="The snapshot file to write"
+        )
+
+    def handle(self, *args, **options):
+
+        rule_snapshot = snapshot.export()
+
+        snapshot.write(rule_snapshot, options["output"])
+
+        self.stdout.write(
+            "Wrote %d rules, %d requirements and %d actions to %s" % (
+                len(rule_snapshot["rules"]),
+                len(rule_snapshot["requirements"]),
+                len(rule_snapshot["actions"]),
+                options["output"]
+            )
+        )
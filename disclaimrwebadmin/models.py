@@ -1,6 +1,5 @@
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
-import netaddr
 import constants
 
 class Rule(models.Model):
@@ -131,6 +130,10 @@ class Requirement(models.Model):
 
     def get_sender_ip_network(self):
 
+        # Only needed, when the milter configuration is built
+
+        import netaddr
+
         return netaddr.IPNetwork("%s/%s" % (
             self.sender_ip, self.sender_ip_cidr
         ))
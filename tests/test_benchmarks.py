@@ -0,0 +1,407 @@
+""" Benchmark harness testing """
+import email
+import json
+import mailbox
+import os
+import re
+import shutil
+import socket
+import tempfile
+from email.mime.text import MIMEText
+
+import libmilter as lm
+from django.core import serializers
+from django.test import TestCase
+from benchmarks import corpus, loadgen, messages, micro, replay, rules, \
+    stats
+from disclaimr.configuration_helper import build_configuration
+from disclaimrwebadmin import models, constants
+
+
+class ReplayTestCase(TestCase):
+
+    """ Replay mails through the milter helper and check the measurements
+    """
+
+    def setUp(self):
+
+        """ A basic rule adding a disclaimer to all mails and a corpus with
+            an .eml file and an mbox holding two mails
+        """
+
+        disclaimer = models.Disclaimer()
+
+        disclaimer.name = "Test"
+        disclaimer.text = "Test-Disclaimer"
+
+        disclaimer.save()
+
+        rule = models.Rule()
+        rule.save()
+
+        action = models.Action()
+
+        action.action = constants.ACTION_ACTION_ADD
+        action.disclaimer = disclaimer
+        action.rule = rule
+        action.position = 0
+
+        action.save()
+
+        requirement = models.Requirement()
+
+        requirement.rule = rule
+        requirement.action = constants.REQ_ACTION_ACCEPT
+
+        requirement.save()
+
+        self.mail = MIMEText("Testmail", "plain", "UTF-8")
+        self.mail["From"] = "Sender <sender@company.com>"
+        self.mail["To"] = "recipient@company.com"
+
+        self.corpus = tempfile.mkdtemp()
+
+        with open(os.path.join(self.corpus, "test.eml"), "w") as mail_file:
+
+            mail_file.write(self.mail.as_string())
+
+        mbox = mailbox.mbox(os.path.join(self.corpus, "test.mbox"))
+
+        mbox.add(self.mail)
+        mbox.add(self.mail)
+
+        mbox.flush()
+
+        self.envelope = {"ip": "127.0.0.1", "sender": "", "recipient": ""}
+
+    def tearDown(self):
+
+        shutil.rmtree(self.corpus)
+
+    def test_read_corpus(self):
+
+        """ Mails are read from .eml and mbox files
+        """
+
+        mails = list(corpus.read_corpus([self.corpus]))
+
+        self.assertEqual(len(mails), 3)
+
+        for name, text in mails:
+
+            headers, body = corpus.split_mail(text)
+
+            self.assertIn(("To", "recipient@company.com"), headers)
+
+            self.assertIn("Testmail", body.decode("base64"))
+
+    def test_replay(self):
+
+        """ All stages of a modified mail are measured
+        """
+
+        result = replay.run_benchmark(
+            build_configuration(),
+            list(corpus.read_corpus([self.corpus])),
+            self.envelope,
+            repeat=2
+        )
+
+        self.assertEqual(result["mails"], 6)
+        self.assertEqual(result["modified"], 6)
+
+        for stage in replay.STAGES + ("total",):
+
+            self.assertEqual(result["stages"][stage]["count"], 6)
+
+        self.assertGreater(result["max_rss"], 0)
+
+    def test_replay_disabled(self):
+
+        """ Stages after a stage disabling the helper aren't run
+        """
+
+        models.Requirement.objects.update(sender_ip="10.0.0.0", sender_ip_cidr="8")
+
+        timings = dict((stage, []) for stage in replay.STAGES)
+
+        modified = replay.replay_mail(
+            build_configuration(),
+            self.mail.as_string(),
+            self.envelope,
+            timings
+        )
+
+        self.assertFalse(modified)
+
+        self.assertEqual(len(timings["connect"]), 1)
+        self.assertEqual(len(timings["eob"]), 0)
+
+    def test_percentile(self):
+
+        """ Percentiles use the nearest rank
+        """
+
+        values = range(1, 101)
+
+        self.assertEqual(stats.percentile(values, 50), 50)
+        self.assertEqual(stats.percentile(values, 99), 99)
+        self.assertEqual(stats.percentile(values, 100), 100)
+        self.assertEqual(stats.percentile([], 50), 0)
+
+
+class TestMilter(lm.ThreadMixin, lm.MilterProtocol):
+
+    """ A milter replacing the body of all mails. It only wants the connect,
+        the headers without a reply and the body.
+    """
+
+    def __init__(self):
+
+        lm.ThreadMixin.__init__(self)
+        lm.MilterProtocol.__init__(self, lm.SMFIF_CHGBODY, lm.SMFIP_NOEOH)
+
+        self.macros = []
+
+    def connect(self, hostname, family, ip, port, cmd_dict):
+
+        return lm.CONTINUE
+
+    @lm.noReply
+    def header(self, key, val, cmd_dict):
+
+        self.macros.append(cmd_dict.get("i"))
+
+        return lm.CONTINUE
+
+    def body(self, chunk, cmd_dict):
+
+        return lm.CONTINUE
+
+    def eob(self, cmd_dict):
+
+        self.replBody("Replaced")
+
+        return lm.CONTINUE
+
+
+class LoadGeneratorTestCase(TestCase):
+
+    """ Talk to a milter over the milter protocol
+    """
+
+    def setUp(self):
+
+        self.mail = MIMEText("Testmail", "plain", "UTF-8")
+        self.mail["From"] = "Sender <sender@company.com>"
+        self.mail["To"] = "recipient@company.com"
+
+        (client_socket, milter_socket) = socket.socketpair()
+
+        self.milter = TestMilter()
+        self.milter.transport = milter_socket
+        self.milter.daemon = True
+        self.milter.start()
+
+        self.client = loadgen.MilterClient(client_socket)
+
+    def tearDown(self):
+
+        self.client.close()
+
+        self.milter.join(5)
+
+    def test_send_mail(self):
+
+        """ The negotiated steps are sent and measured
+        """
+
+        self.client.negotiate()
+
+        self.assertTrue(self.client.skips(lm.SMFIP_NOEOH))
+        self.assertFalse(self.client.skips(lm.SMFIP_NOBODY))
+
+        self.assertEqual(
+            self.client.connect("localhost", "127.0.0.1"), lm.SMFIR_CONTINUE
+        )
+
+        timings = dict((phase, []) for phase in loadgen.PHASES)
+
+        for queue_id in ("QID1", "QID2"):
+
+            result = loadgen.send_mail(
+                self.client,
+                self.mail.as_string(),
+                {"sender": "", "recipient": ""},
+                timings,
+                queue_id,
+                chunk_size=4
+            )
+
+            self.assertEqual(result, "modified")
+
+        self.assertEqual(self.milter.macros[0], "QID1")
+        self.assertEqual(self.milter.macros[-1], "QID2")
+
+        for phase in ("header", "body", "eob"):
+
+            self.assertEqual(len(timings[phase]), 2)
+
+        # The test milter doesn't want the envelope and the end of the headers
+
+        for phase in ("mail_from", "rcpt", "eoh"):
+
+            self.assertEqual(len(timings[phase]), 0)
+
+
+class GeneratorTestCase(TestCase):
+
+    """ Generate synthetic mails and rule sets
+    """
+
+    def test_messages(self):
+
+        """ Every shape, transfer encoding and charset is generated and can be
+            decoded again
+        """
+
+        mails = list(messages.generate(
+            len(messages.SHAPES) * len(messages.ENCODINGS) *
+            len(messages.CHARSETS),
+            depth=2
+        ))
+
+        self.assertEqual(len(set(name for name, text in mails)), len(mails))
+
+        content_types = set()
+
+        for name, text in mails:
+
+            mail = email.message_from_string(text)
+
+            self.assertNotEqual(mail["Message-ID"], None)
+
+            for part in mail.walk():
+
+                content_types.add(part.get_content_type())
+
+                if part.get_content_maintype() == "text":
+
+                    part.get_payload(decode=True).decode(
+                        part.get_content_charset()
+                    )
+
+        for content_type in ("text/plain", "text/html",
+                             "multipart/alternative", "multipart/mixed",
+                             "message/rfc822", "application/octet-stream"):
+
+            self.assertIn(content_type, content_types)
+
+    def test_message_size(self):
+
+        """ The mails have about the requested size
+        """
+
+        for name, text in messages.generate(
+            len(messages.SHAPES), encodings=("8bit",), charsets=("us-ascii",),
+            sizes=(100 * 1024,)
+        ):
+
+            self.assertGreater(len(text), 50 * 1024)
+            self.assertLess(len(text), 200 * 1024)
+
+        self.assertEqual(messages.parse_size("50M"), 50 * 1024 * 1024)
+        self.assertEqual(messages.parse_size("1.5k"), 1536)
+
+    def test_rules(self):
+
+        """ The rule set can be loaded and contains the requested objects
+        """
+
+        fixture = rules.generate(
+            rules=10, requirements=5, actions=3, disclaimers=4
+        )
+
+        for item in serializers.deserialize("json", json.dumps(fixture)):
+
+            item.save()
+
+        self.assertEqual(models.Rule.objects.count(), 10)
+        self.assertEqual(models.Requirement.objects.count(), 50)
+        self.assertEqual(models.Disclaimer.objects.count(), 4)
+
+        self.assertGreaterEqual(models.Action.objects.count(), 10)
+        self.assertLessEqual(models.Action.objects.count(), 30)
+
+        # The generated networks and regular expressions are valid
+
+        build_configuration()
+
+        for requirement in models.Requirement.objects.all():
+
+            for field in ("sender", "recipient", "header", "body"):
+
+                re.compile(getattr(requirement, field))
+
+    def test_rules_seed(self):
+
+        """ The same seed generates the same rule set
+        """
+
+        self.assertEqual(rules.generate(seed=1), rules.generate(seed=1))
+        self.assertNotEqual(rules.generate(seed=1), rules.generate(seed=2))
+
+
+class MicroTestCase(TestCase):
+
+    """ Run the microbenchmarks and compare them against a baseline
+    """
+
+    def test_run(self):
+
+        """ All benchmarks are run and measured
+        """
+
+        results = micro.run_benchmarks(
+            micro.make_context(2, 5, 1024), repeat=1, min_time=0
+        )
+
+        self.assertEqual(
+            sorted(results.keys()),
+            sorted(name for name, bench in micro.BENCHMARKS)
+        )
+
+        for name in results:
+
+            self.assertEqual(results[name]["number"], 1)
+            self.assertGreater(results[name]["best"], 0)
+
+    def test_compare(self):
+
+        """ Changes beyond the threshold are reported
+        """
+
+        baseline = {
+            "connect": {"best": 1.0},
+            "template": {"best": 1.0},
+            "make_html": {"best": 1.0}
+        }
+
+        results = {
+            "connect": {"best": 1.2},
+            "template": {"best": 0.8},
+            "make_html": {"best": 1.05},
+            "addpart": {"best": 1.0}
+        }
+
+        report = dict(
+            (name, status) for name, base, current, change, status
+            in micro.compare(baseline, results, 10)
+        )
+
+        self.assertEqual(report, {
+            "connect": "regression",
+            "template": "improvement",
+            "make_html": "ok",
+            "addpart": "new"
+        })
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.test import TestCase
 import ldap
 import time
+from benchmarks.corpus import split_mail
 from disclaimr.query_cache import QueryCache
 from disclaimrwebadmin import models, constants
 from disclaimr.configuration_helper import build_configuration
@@ -154,9 +155,27 @@ class DirectoryServerTestCase(TestCase):
         helper.mail_from(address, {})
         helper.rcpt(address, {})
         helper.header("From", "nobody", {})
+
+        # Send the mail like the MTA does
+
+        (mail_headers, body) = split_mail(MIMEText(self.test_text).as_string())
+
+        for (key, value) in mail_headers:
+
+            helper.header(key, value, {})
+
         helper.eoh({})
-        helper.body(MIMEText(self.test_text).as_string(), {})
-        return helper.eob({})
+        helper.body(body, {})
+
+        returned = helper.eob({})
+
+        if returned is not None and "repl_body" in returned:
+
+            # Join the chunks of the new body
+
+            returned["repl_body"] = "".join(returned["repl_body"])
+
+        return returned
 
     def test_disabled_directoryserver(self):
 
@@ -5,6 +5,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from django.test import TestCase
+from benchmarks.corpus import split_mail
 from disclaimr import milter_helper
 from disclaimrwebadmin import models, constants
 from disclaimr.configuration_helper import build_configuration
@@ -51,14 +52,15 @@ class DisclaimerTestCase(TestCase):
 
         requirement.save()
 
-    def tool_get_helper(self):
+    def tool_get_helper(self, limits=None):
 
         """ Return a configured milter helper
 
+        :param limits: Processing limits for the configuration
         :return: A Milter helper
         """
 
-        configuration = build_configuration()
+        configuration = build_configuration(limits=limits)
 
         helper = MilterHelper(configuration)
 
@@ -83,42 +85,71 @@ class DisclaimerTestCase(TestCase):
 
             helper.body(mail.as_string(), {})
 
-    def tool_run_real_test(self, header=None, make_mail=True):
+    def tool_set_clock(self, clock):
+
+        """ Replace the monotonic clock of the milter helper for this test
+
+        :param clock: A function returning the current time in seconds
+        """
+
+        self.addCleanup(
+            setattr, milter_helper, "monotonic", milter_helper.monotonic
+        )
+
+        milter_helper.monotonic = clock
+
+    def tool_run_real_test(self, header=None, make_mail=True, limits=None,
+                           join_body=True):
 
         """ Runs the test using the milter helper and returns the
             action dictionary of eob
 
+        :param join_body: Join the chunks of the new body
         :return: the action dictionary of eob()
         """
 
-        helper = self.tool_get_helper()
+        helper = self.tool_get_helper(limits)
 
         helper.connect("", "", "1.1.1.1", "", {})
         helper.mail_from(self.test_address, {})
         helper.rcpt(self.test_address, {})
 
-        if header is not None:
+        if make_mail:
+
+            self.test_mail = MIMEText(self.test_text, "plain", "UTF-8")
 
-            for key in header.iterkeys():
+        if header is None:
 
-                helper.header(key, header[key], {})
+            # Add at least one header for proper mail processing
 
-            helper.eoh({})
+            header = {"From": "nobody"}
 
-        else:
+        for key in header.iterkeys():
 
-            # Add at least one header for proper mail processing
+            helper.header(key, header[key], {})
 
-            helper.header("From", "nobody", {})
-            helper.eoh({})
+        # Send the mail like the MTA does: the headers one by one and the
+        # body without the empty line separating it from the headers
 
-        if make_mail:
+        (mail_headers, body) = split_mail(self.test_mail.as_string())
 
-            self.test_mail = MIMEText(self.test_text, "plain", "UTF-8")
+        for (key, value) in mail_headers:
+
+            helper.header(key, value, {})
+
+        helper.eoh({})
+
+        helper.body(body, {})
+
+        returned = helper.eob({})
 
-        helper.body(self.test_mail.as_string(), {})
+        if join_body and returned is not None and "repl_body" in returned:
 
-        return helper.eob({})
+            # Join the chunks of the new body
+
+            returned["repl_body"] = "".join(returned["repl_body"])
+
+        return returned
 
     def tool_make_returned_mail(self, returned):
 
@@ -382,6 +413,140 @@ class DisclaimerTestCase(TestCase):
             )
         )
 
+    def test_attachment(self):
+
+        """ Test a mail with an attachment assuming that the attachment is
+            copied verbatim
+        """
+
+        attachment = MIMEApplication("\x00\x01" * 100)
+
+        self.test_mail = MIMEMultipart("mixed")
+        self.test_mail.attach(MIMEText(self.test_text, "plain", "UTF-8"))
+        self.test_mail.attach(attachment)
+
+        returned = self.tool_run_real_test(make_mail=False)
+
+        self.assertIn(
+            attachment.as_string(),
+            returned["repl_body"],
+            "Attachment was unexpectedly modified"
+        )
+
+        returned_mail = self.tool_make_returned_mail(returned)
+
+        self.assertEqual(
+            milter_helper.MilterHelper.decode_mail(
+                returned_mail.get_payload()[0]
+            )[1],
+            "%s\n%s" % (self.test_text, self.disclaimer.text),
+            "Body was unexpectedly modified to %s" % (
+                milter_helper.MilterHelper.decode_mail(
+                    returned_mail.get_payload()[0]
+                )[1],
+            )
+        )
+
+    def test_multipart_body(self):
+
+        """ The MTA sends the body without the headers. The first part of
+            a multipart mail isn't taken for the headers of the mail.
+        """
+
+        for subtype in ("mixed", "alternative"):
+
+            self.test_mail = MIMEMultipart(subtype)
+            self.test_mail.attach(MIMEText(self.test_text, "plain", "UTF-8"))
+            self.test_mail.attach(MIMEApplication("\x00\x01" * 100))
+
+            returned = self.tool_run_real_test(make_mail=False)
+
+            self.assertTrue(
+                returned["repl_body"].startswith(
+                    "--%s\n" % self.test_mail.get_boundary()
+                ),
+                "The body of the %s mail was corrupted" % subtype
+            )
+
+            returned_mail = self.tool_make_returned_mail(returned)
+
+            self.assertEqual(len(returned_mail.get_payload()), 2)
+
+            self.assertIn(
+                self.disclaimer.text,
+                milter_helper.MilterHelper.decode_mail(
+                    returned_mail.get_payload()[0]
+                )[1]
+            )
+
+    def test_only_mime(self):
+
+        """ Restrict the action to a mime type and test a multipart mail
+            assuming that only the matching part is modified
+        """
+
+        self.action.only_mime = "text/html"
+
+        self.action.save()
+
+        test_text = "TestPlain"
+        test_html = "<p>TestHTML</p>"
+
+        text_part = MIMEText(test_text, "plain", "UTF-8")
+        html_part = MIMEText(test_html, "html", "UTF-8")
+
+        self.test_mail = MIMEMultipart("alternative")
+        self.test_mail.attach(text_part)
+        self.test_mail.attach(html_part)
+
+        returned = self.tool_run_real_test(make_mail=False)
+
+        returned_mail = self.tool_make_returned_mail(returned)
+
+        self.assertEqual(
+            milter_helper.MilterHelper.decode_mail(
+                returned_mail.get_payload()[0]
+            )[1],
+            test_text,
+            "Text-Body was unexpectedly modified to %s" % (
+                milter_helper.MilterHelper.decode_mail(
+                    returned_mail.get_payload()[0]
+                )[1],
+            )
+        )
+
+        self.assertEqual(
+            milter_helper.MilterHelper.decode_mail(
+                returned_mail.get_payload()[1]
+            )[1],
+            "<html><body>\n%s\n<p>%s</p>\n</body></html>\n" % (
+                test_html,
+                self.disclaimer.text
+            ),
+            "HTML-Body was unexpectedly modified to %s" % (
+                milter_helper.MilterHelper.decode_mail(
+                    returned_mail.get_payload()[1]
+                )[1],
+            )
+        )
+
+    def test_only_mime_no_match(self):
+
+        """ Restrict the action to a mime type, that isn't part of the mail,
+            assuming that we get an empty action dictionary back
+        """
+
+        self.action.only_mime = "text/html, application/*"
+
+        self.action.save()
+
+        returned = self.tool_run_real_test()
+
+        self.assertIsNone(
+            returned,
+            "We got an action dictionary back! %s" % returned
+        )
+
     def test_html(self):
 
         """ Test a HTML mail with an HTML disclaimer
@@ -630,6 +795,45 @@ class DisclaimerTestCase(TestCase):
             )
         )
 
+    def test_multiple_actions(self):
+
+        """ Add multiple actions to a rule assuming that all actions will be
+        carried out on the same part in the order of their position.
+        """
+
+        self.test_text = "Testmail #DISCLAIMER#"
+
+        disclaimer2 = models.Disclaimer()
+
+        disclaimer2.name = "Test2"
+        disclaimer2.text = "Test-Disclaimer2"
+
+        disclaimer2.save()
+
+        action2 = models.Action()
+
+        action2.action = constants.ACTION_ACTION_REPLACETAG
+        action2.action_parameters = "#DISCLAIMER#"
+        action2.disclaimer = disclaimer2
+        action2.rule = self.rule
+        action2.position = 1
+
+        action2.save()
+
+        returned = self.tool_run_real_test()
+
+        self.assertEqual(
+            milter_helper.MilterHelper.decode_mail(
+                self.tool_make_returned_mail(returned)
+            )[1],
+            "Testmail Test-Disclaimer2\n%s" % self.disclaimer.text,
+            "Body was unexpectedly modified to %s" % (
+                milter_helper.MilterHelper.decode_mail(
+                    self.tool_make_returned_mail(returned)
+                )[1],
+            )
+        )
+
     def test_disclaimer_add_part(self):
 
         """ Test an action, that adds a mime part with the disclaimer
@@ -873,3 +1077,297 @@ class DisclaimerTestCase(TestCase):
                 )[1],
             )
         )
+
+    def test_encrypted_accept(self):
+
+        """ With the accept policy, signed mails should be passed unmodified
+            after the headers
+        """
+
+        helper = MilterHelper(build_configuration("accept"))
+
+        helper.connect("", "", "1.1.1.1", "", {})
+        helper.mail_from(self.test_address, {})
+        helper.rcpt(self.test_address, {})
+        helper.header(
+            "Content-Type",
+            "multipart/signed; protocol=\"application/pkcs7-signature\"",
+            {}
+        )
+        helper.eoh({})
+
+        self.assertFalse(
+            helper.enabled,
+            "Helper was enabled for a signed mail"
+        )
+
+    def test_encrypted_accept_inline(self):
+
+        """ With the accept policy, inline PGP mails should be passed
+            unmodified without buffering the body
+        """
+
+        helper = MilterHelper(build_configuration("accept"))
+
+        helper.connect("", "", "1.1.1.1", "", {})
+        helper.mail_from(self.test_address, {})
+        helper.rcpt(self.test_address, {})
+        helper.header("From", "nobody", {})
+        helper.eoh({})
+        helper.body("-----BEGIN PGP SIGNED MESSAGE-----\nTestmail", {})
+
+        self.assertFalse(
+            helper.enabled,
+            "Helper was enabled for an inline PGP mail"
+        )
+
+        self.assertEqual(
+            helper.body_chunks,
+            [],
+            "The body of an inline PGP mail was buffered"
+        )
+
+    def test_limit_body_size(self):
+
+        """ A mail with a body larger than the limit should be passed
+            unmodified
+        """
+
+        returned = self.tool_run_real_test(limits={"body_size": 10})
+
+        self.assertIsNone(
+            returned,
+            "We got an action dictionary back! %s" % returned
+        )
+
+    def test_limit_parts(self):
+
+        """ A mail with more mime parts than the limit should be passed
+            unmodified
+        """
+
+        self.test_mail = MIMEMultipart("mixed")
+        self.test_mail.attach(MIMEText(self.test_text, "plain", "UTF-8"))
+        self.test_mail.attach(MIMEText(self.test_text, "plain", "UTF-8"))
+
+        returned = self.tool_run_real_test(make_mail=False, limits={"parts": 2})
+
+        self.assertIsNone(
+            returned,
+            "We got an action dictionary back! %s" % returned
+        )
+
+        returned = self.tool_run_real_test(make_mail=False, limits={"parts": 3})
+
+        self.assertIsNotNone(
+            returned,
+            "Mail within the limits wasn't modified"
+        )
+
+    def test_limit_depth(self):
+
+        """ A mail with mime parts nested deeper than the limit should be
+            passed unmodified
+        """
+
+        alternative = MIMEMultipart("alternative")
+        alternative.attach(MIMEText(self.test_text, "plain", "UTF-8"))
+
+        self.test_mail = MIMEMultipart("mixed")
+        self.test_mail.attach(alternative)
+
+        returned = self.tool_run_real_test(make_mail=False, limits={"depth": 1})
+
+        self.assertIsNone(
+            returned,
+            "We got an action dictionary back! %s" % returned
+        )
+
+        returned = self.tool_run_real_test(make_mail=False, limits={"depth": 2})
+
+        self.assertIsNotNone(
+            returned,
+            "Mail within the limits wasn't modified"
+        )
+
+    def test_limit_time(self):
+
+        """ A mail taking longer to process than the limit should be passed
+            unmodified
+        """
+
+        now = [0]
+
+        def clock():
+
+            # Every look at the clock takes two seconds
+
+            now[0] += 2
+
+            return now[0]
+
+        self.tool_set_clock(clock)
+
+        returned = self.tool_run_real_test(limits={"time": 1})
+
+        self.assertIsNone(
+            returned,
+            "We got an action dictionary back! %s" % returned
+        )
+
+        returned = self.tool_run_real_test(limits={"time": 1000})
+
+        self.assertIsNotNone(
+            returned,
+            "Mail within the limits wasn't modified"
+        )
+
+    def test_limit_time_resolver(self):
+
+        """ A mail should be passed unmodified, if resolving the disclaimer
+            takes longer than the limit
+        """
+
+        now = [0]
+
+        self.tool_set_clock(lambda: now[0])
+
+        build_disclaimer = MilterHelper.build_disclaimer
+
+        def slow_build_disclaimer(helper, *args):
+
+            # Resolving the sender takes ten seconds
+
+            now[0] += 10
+
+            return build_disclaimer(helper, *args)
+
+        self.addCleanup(
+            setattr, MilterHelper, "build_disclaimer", build_disclaimer
+        )
+
+        MilterHelper.build_disclaimer = slow_build_disclaimer
+
+        returned = self.tool_run_real_test(limits={"time": 5})
+
+        self.assertIsNone(
+            returned,
+            "We got an action dictionary back! %s" % returned
+        )
+
+    def test_limit_time_serialize(self):
+
+        """ The processing time limit is checked while the new body is
+            serialized
+        """
+
+        now = [0]
+
+        self.tool_set_clock(lambda: now[0])
+
+        self.test_mail = MIMEMultipart("mixed")
+        self.test_mail.attach(MIMEText(self.test_text, "plain", "UTF-8"))
+        self.test_mail.attach(MIMEApplication("Attachment"))
+
+        returned = self.tool_run_real_test(
+            make_mail=False, limits={"time": 5}, join_body=False
+        )
+
+        self.assertIsNotNone(
+            returned,
+            "Mail within the limits wasn't modified"
+        )
+
+        # The time is up before the new body is sent
+
+        now[0] += 10
+
+        self.assertRaises(
+            milter_helper.mime_skeleton.LimitExceeded,
+            "".join,
+            returned["repl_body"]
+        )
+
+    def test_diff_headers(self):
+
+        """ Added, changed and removed headers should be found
+        """
+
+        orig_mail = email.message_from_string(
+            "From: sender@company.com\nSubject: Test\nX-Old: 1\n\nBody"
+        )
+
+        mail = email.message_from_string(
+            "From: sender@company.com\nSubject: Changed\nX-New: 1\n\nBody"
+        )
+
+        self.assertEqual(
+            MilterHelper.diff_headers(orig_mail, mail),
+            {
+                "add_header": {"X-New": "1"},
+                "change_header": {"Subject": "Changed"},
+                "delete_header": ["X-Old"]
+            }
+        )
+
+        self.assertEqual(MilterHelper.diff_headers(orig_mail, orig_mail), {})
+
+    def test_summary(self):
+
+        """ The summary should hold the timings and statistics of the mail
+        """
+
+        helper = self.tool_get_helper()
+
+        helper.connect("", "", "1.1.1.1", "", {})
+        helper.mail_from(self.test_address, {})
+        helper.rcpt(self.test_address, {})
+        helper.header("From", "nobody", {})
+        helper.eoh({})
+
+        body = MIMEText(self.test_text, "plain", "UTF-8").as_string()
+
+        helper.body(body, {})
+
+        self.assertIsNotNone(helper.eob({}))
+
+        summary = helper.summary("modified")
+
+        fields = dict(
+            field.split("=", 1) for field in summary.split(" ")[1:]
+        )
+
+        self.assertEqual(fields["decision"], "modified")
+        self.assertEqual(fields["reason"], "-")
+        self.assertEqual(fields["sender"], self.test_address)
+        self.assertEqual(fields["size"], str(len(body)))
+        self.assertEqual(fields["parts"], "1")
+        self.assertEqual(fields["touched"], "1")
+        self.assertEqual(fields["rules"], '"#%d"' % self.rule.id)
+
+        for stage in milter_helper.STAGES:
+
+            self.assertIn("%s_ms" % stage, fields)
+
+        # The statistics are reset for the next mail
+
+        self.assertNotIn("connect_ms", helper.summary("accepted"))
+
+    def test_summary_reason(self):
+
+        """ The summary should tell, why a mail wasn't modified
+        """
+
+        models.Requirement.objects.update(sender="^sender@")
+
+        helper = self.tool_get_helper()
+
+        helper.connect("", "", "1.1.1.1", "", {})
+        helper.mail_from("nobody@example.com", {})
+
+        self.assertFalse(helper.enabled)
+
+        self.assertIn(
+            "decision=accepted reason=sender",
+            helper.summary("accepted")
+        )
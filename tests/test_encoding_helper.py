@@ -0,0 +1,104 @@
+""" Encoding helper testing """
+import base64
+import quopri
+from email.encoders import _bencode, _qencode
+
+from django.test import TestCase
+from disclaimr import encoding_helper
+
+
+class EncodingHelperTestCase(TestCase):
+
+    """ Append texts to encoded payloads and check if they decode right.
+    """
+
+    def setUp(self):
+
+        """ A long text, that spans multiple encoded lines
+        """
+
+        self.test_text = "Testmail with some umlauts: \xe4\xf6\xfc\n" * 20
+        self.test_disclaimer = "\nTest-Disclaimer"
+
+    def test_base64(self):
+
+        """ Appending to a base64 payload should keep all but the last line
+            and decode to the concatenated text
+        """
+
+        payload = _bencode(self.test_text)
+
+        returned = encoding_helper.append_base64(
+            payload,
+            self.test_disclaimer
+        )
+
+        self.assertEqual(
+            base64.b64decode(returned),
+            self.test_text + self.test_disclaimer,
+            "Payload was unexpectedly decoded to %s" % returned
+        )
+
+        self.assertTrue(
+            returned.startswith(payload[:payload.rstrip().rfind("\n")]),
+            "The unmodified lines of the payload weren't kept"
+        )
+
+    def test_base64_crlf(self):
+
+        """ Appending to a base64 payload with CRLF line endings should use
+            CRLF line endings for the new lines, too
+        """
+
+        payload = _bencode(self.test_text).replace("\n", "\r\n")
+
+        returned = encoding_helper.append_base64(
+            payload,
+            self.test_disclaimer
+        )
+
+        self.assertNotIn(
+            "\n",
+            returned.replace("\r\n", ""),
+            "Payload has mixed line endings: %r" % returned
+        )
+
+        self.assertEqual(
+            base64.b64decode(returned),
+            self.test_text + self.test_disclaimer,
+            "Payload was unexpectedly decoded to %s" % returned
+        )
+
+    def test_base64_broken(self):
+
+        """ A payload not aligned to base64 quanta can't be appended to
+        """
+
+        self.assertIsNone(
+            encoding_helper.append_base64("VGVzd", self.test_disclaimer),
+            "Appending to a broken payload didn't fail"
+        )
+
+    def test_quoted_printable(self):
+
+        """ Appending to a quoted-printable payload should keep all but the
+            last line and decode to the concatenated text
+        """
+
+        payload = _qencode(self.test_text)
+
+        returned = encoding_helper.append_quoted_printable(
+            payload,
+            self.test_disclaimer
+        )
+
+        self.assertEqual(
+            quopri.decodestring(returned),
+            self.test_text + self.test_disclaimer,
+            "Payload was unexpectedly decoded to %s" % returned
+        )
+
+        self.assertTrue(
+            returned.startswith(payload),
+            "The unmodified lines of the payload weren't kept"
+        )
@@ -0,0 +1,85 @@
+""" Logging helper testing """
+import logging
+import threading
+
+from django.test import TestCase
+from disclaimr import logging_helper
+
+
+class LoggingHelperTestCase(TestCase):
+
+    """ Check, that the queue id is taken from the log context of the current
+        thread
+    """
+
+    def tearDown(self):
+
+        logging_helper.set_queueid()
+
+    def get_queueid(self):
+
+        """ Filter a log record and return its queue id
+
+        :return: The queueid attribute of the filtered record
+        """
+
+        record = logging.LogRecord(
+            "disclaimr", logging.INFO, __file__, 0, "Test", (), None
+        )
+
+        logging_helper.queueFilter().filter(record)
+
+        return record.queueid
+
+    def test_queueid(self):
+
+        """ The queue id is added until it's cleared
+        """
+
+        self.assertEqual(self.get_queueid(), "")
+
+        logging_helper.set_queueid("ABC123")
+
+        self.assertEqual(self.get_queueid(), "ABC123: ")
+
+        logging_helper.set_queueid()
+
+        self.assertEqual(self.get_queueid(), "")
+
+    def test_queueid_thread(self):
+
+        """ Every thread has its own queue id
+        """
+
+        logging_helper.set_queueid("ABC123")
+
+        result = []
+
+        def other():
+
+            result.append(self.get_queueid())
+
+            logging_helper.set_queueid("DEF456")
+
+            result.append(self.get_queueid())
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(result, ["", "DEF456: "])
+
+        self.assertEqual(self.get_queueid(), "ABC123: ")
+
+    def test_single_filter(self):
+
+        """ Setting a queue id doesn't add filters to the logger
+        """
+
+        filters = len(logging_helper.syslog.filters)
+
+        for queue_id in ("A", "B", "C"):
+
+            logging_helper.set_queueid(queue_id)
+
+        self.assertEqual(len(logging_helper.syslog.filters), filters)
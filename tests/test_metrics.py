@@ -0,0 +1,151 @@
+""" Metrics testing """
+import json
+
+from django.test import TestCase
+from disclaimr import metrics
+from disclaimr.query_cache import QueryCache
+from disclaimrwebadmin import models
+
+
+class MetricsTestCase(TestCase):
+
+    """ Record, aggregate and render metrics
+    """
+
+    def setUp(self):
+
+        metrics.after_fork()
+
+        metrics.enabled = True
+
+    def tearDown(self):
+
+        metrics.enabled = False
+
+        metrics.after_fork()
+
+    def test_disabled(self):
+
+        """ Nothing is recorded, until the metrics are started
+        """
+
+        metrics.enabled = False
+
+        metrics.inc("test_total")
+        metrics.observe("test_seconds", 0.1)
+
+        self.assertEqual(metrics.registry.counters, {})
+        self.assertEqual(metrics.registry.histograms, {})
+
+    def test_render(self):
+
+        """ Counters and histograms are rendered in the Prometheus text
+        format
+        """
+
+        metrics.inc("test_total", rule="Rule \"1\"")
+        metrics.inc("test_total", 2, rule="Rule \"1\"")
+
+        metrics.observe("test_seconds", 0.003, callback="eob")
+        metrics.observe("test_seconds", 20, callback="eob")
+
+        text = metrics.registry.render()
+
+        self.assertIn("# TYPE test_total counter\n", text)
+        self.assertIn('test_total{rule="Rule \\"1\\""} 3\n', text)
+
+        self.assertIn("# TYPE test_seconds histogram\n", text)
+        self.assertIn(
+            'test_seconds_bucket{callback="eob",le="0.0025"} 0\n', text
+        )
+        self.assertIn(
+            'test_seconds_bucket{callback="eob",le="0.005"} 1\n', text
+        )
+        self.assertIn('test_seconds_bucket{callback="eob",le="10.0"} 1\n', text)
+        self.assertIn('test_seconds_bucket{callback="eob",le="+Inf"} 2\n', text)
+        self.assertIn('test_seconds_count{callback="eob"} 2\n', text)
+
+    def test_merge(self):
+
+        """ Metrics drained from a forked process add up in the collecting
+        process
+        """
+
+        metrics.inc("test_total", rule=u"R\xfcle")
+        metrics.observe("test_seconds", 0.003, callback="eob")
+
+        data = json.loads(json.dumps(metrics.registry.drain()))
+
+        self.assertEqual(metrics.registry.counters, {})
+
+        metrics.inc("test_total", rule=u"R\xfcle")
+        metrics.observe("test_seconds", 0.3, callback="eob")
+
+        metrics.registry.merge(data)
+
+        self.assertEqual(
+            metrics.registry.counters[
+                ("test_total", metrics.label_key({"rule": u"R\xfcle"}))
+            ],
+            2
+        )
+
+        histogram = metrics.registry.histograms[
+            ("test_seconds", metrics.label_key({"callback": "eob"}))
+        ]
+
+        self.assertEqual(histogram[1], 2)
+        self.assertAlmostEqual(histogram[2], 0.303)
+
+    def test_timed(self):
+
+        """ The run time of a decorated function is observed
+        """
+
+        @metrics.timed("test_seconds", callback="test")
+        def test_function():
+
+            return "result"
+
+        self.assertEqual(test_function(), "result")
+
+        histogram = metrics.registry.histograms[
+            ("test_seconds", metrics.label_key({"callback": "test"}))
+        ]
+
+        self.assertEqual(histogram[1], 1)
+
+    def test_query_cache(self):
+
+        """ Query cache hits and misses are counted
+        """
+
+        directory_server = models.DirectoryServer()
+        directory_server.id = 1
+        directory_server.cache_timeout = 60
+
+        QueryCache.get(directory_server, "test")
+
+        QueryCache.set(directory_server, "test", "data")
+
+        QueryCache.get(directory_server, "test")
+
+        del(QueryCache.cache[directory_server.id])
+
+        counters = metrics.registry.counters
+
+        self.assertEqual(
+            counters[(
+                "disclaimr_query_cache_total",
+                metrics.label_key({"result": "miss"})
+            )],
+            1
+        )
+
+        self.assertEqual(
+            counters[(
+                "disclaimr_query_cache_total",
+                metrics.label_key({"result": "hit"})
+            )],
+            1
+        )
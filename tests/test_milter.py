@@ -0,0 +1,547 @@
+""" Milter daemon testing """
+import argparse
+import cPickle
+import imp
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import thread
+import threading
+from email.mime.text import MIMEText
+
+import libmilter as lm
+from django.test import TestCase
+from benchmarks import loadgen
+from disclaimr import milter_factory
+from disclaimr.configuration_helper import build_configuration
+from disclaimr.mime_skeleton import LimitExceeded
+from disclaimr.supervisor import Supervisor
+from disclaimrwebadmin import models, constants
+
+# The daemon script is shadowed by the disclaimr package
+
+milter = imp.load_source(
+    "disclaimr_milter",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "disclaimr.py")
+)
+
+
+def make_options(**values):
+
+    """ Build the command line options of the daemon
+
+    :param values: Options overriding the defaults
+    :return: The options
+    """
+
+    options = argparse.Namespace(
+        socket="inet:127.0.0.1:5000",
+        mode="threads",
+        threads=32,
+        workers=0,
+        snapshot=None,
+        log_body=False,
+        encrypted_policy="process",
+        max_body_size=0,
+        max_parts=0,
+        max_depth=0,
+        max_time=0
+    )
+
+    for (name, value) in values.items():
+
+        setattr(options, name, value)
+
+    return options
+
+
+class TestMilter(lm.ThreadMixin, milter.DisclaimrProtocol):
+
+    """ The daemon's milter protocol handling a connection in a thread
+    """
+
+    def __init__(self):
+
+        lm.ThreadMixin.__init__(self)
+        milter.DisclaimrProtocol.__init__(self, lm.SMFIF_CHGBODY)
+
+
+class FailingMilter(TestMilter):
+
+    """ A milter, whose thread can't be started
+    """
+
+    def start(self):
+
+        raise thread.error("can't start new thread")
+
+
+class WatchingFactory(object):
+
+    """ Records, wether a connection waits to become writable
+    """
+
+    def __init__(self):
+
+        self.writable = False
+
+    def watch_writable(self, connection, watch):
+
+        self.writable = watch
+
+
+class MilterTestCase(TestCase):
+
+    """ Talk to the daemon's milter protocol like an MTA
+    """
+
+    def setUp(self):
+
+        """ A basic rule adding a disclaimer to all mails
+        """
+
+        disclaimer = models.Disclaimer()
+
+        disclaimer.name = "Test"
+        disclaimer.text = "Test-Disclaimer"
+
+        disclaimer.save()
+
+        rule = models.Rule()
+        rule.save()
+
+        action = models.Action()
+
+        action.action = constants.ACTION_ACTION_ADD
+        action.disclaimer = disclaimer
+        action.rule = rule
+        action.position = 0
+
+        action.save()
+
+        requirement = models.Requirement()
+
+        requirement.rule = rule
+        requirement.action = constants.REQ_ACTION_ACCEPT
+
+        requirement.save()
+
+        self.client = None
+
+        self.milter = None
+
+    def tearDown(self):
+
+        if self.client is not None:
+
+            self.client.close()
+
+            self.milter.join(5)
+
+    def start_milter(self, **values):
+
+        """ Start a milter connection with the given options
+
+        :param values: Options overriding the defaults
+        """
+
+        milter.options = make_options(**values)
+
+        milter.configuration = build_configuration(
+            milter.options.encrypted_policy,
+            {"body_size": milter.options.max_body_size}
+        )
+
+        (client_socket, milter_socket) = socket.socketpair()
+
+        # Fail instead of waiting for a reply, that isn't sent
+
+        client_socket.settimeout(10)
+
+        self.milter = TestMilter()
+        self.milter.transport = milter_socket
+        self.milter.daemon = True
+        self.milter.start()
+
+        self.client = loadgen.MilterClient(client_socket)
+
+    def send_envelope(self, offered=loadgen.OFFERED_PROTOCOL):
+
+        """ Negotiate and send the envelope and headers of a mail
+
+        :param offered: The protocol options offered to the milter
+        """
+
+        self.client.send(
+            lm.SMFIC_OPTNEG, struct.pack("!III", 6, lm.SMFIF_ALLOPTS, offered)
+        )
+
+        (reply, data) = self.client.receive()
+
+        self.assertEqual(reply, lm.SMFIC_OPTNEG)
+
+        self.client.protocol = struct.unpack("!III", data[:12])[2]
+
+        self.assertEqual(
+            self.client.connect("localhost", "127.0.0.1"), lm.SMFIR_CONTINUE
+        )
+
+        self.client.request(
+            lm.SMFIC_MAIL, "<sender@company.com>\0", lm.SMFIP_NR_MAIL
+        )
+
+        self.client.request(
+            lm.SMFIC_RCPT, "<recipient@company.com>\0", lm.SMFIP_NR_RCPT
+        )
+
+        self.client.request(
+            lm.SMFIC_HEADER, "From\0sender@company.com\0", lm.SMFIP_NR_HDR
+        )
+
+        if not self.client.skips(lm.SMFIP_NOEOH):
+
+            self.assertEqual(
+                self.client.request(lm.SMFIC_EOH, "", lm.SMFIP_NR_EOH),
+                lm.SMFIR_CONTINUE
+            )
+
+    def send_body(self, chunk):
+
+        """ Send a body chunk
+
+        :param chunk: The chunk
+        :return: The reply character
+        """
+
+        return self.client.request(lm.SMFIC_BODY, chunk, lm.SMFIP_NR_BODY)
+
+    def test_skip_inline_pgp(self):
+
+        """ The MTA is told to skip the rest of an inline PGP body
+        """
+
+        self.start_milter(encrypted_policy="accept")
+
+        self.send_envelope()
+
+        self.assertTrue(self.client.protocol & lm.SMFIP_SKIP)
+
+        self.assertEqual(
+            self.send_body("-----BEGIN PGP MESSAGE-----\n\nhQEMA\n"),
+            lm.SMFIR_SKIP
+        )
+
+        self.assertEqual(self.client.end_of_body(), (lm.SMFIR_CONTINUE, []))
+
+    def test_no_skip(self):
+
+        """ Without the MTA supporting it, the milter doesn't skip
+        """
+
+        self.start_milter(encrypted_policy="accept")
+
+        self.send_envelope(loadgen.OFFERED_PROTOCOL & ~lm.SMFIP_SKIP)
+
+        self.assertEqual(
+            self.send_body("-----BEGIN PGP MESSAGE-----\n\nhQEMA\n"),
+            lm.SMFIR_CONTINUE
+        )
+
+        self.assertEqual(self.client.end_of_body(), (lm.SMFIR_CONTINUE, []))
+
+    def test_skip_body_size(self):
+
+        """ The MTA is told to skip the rest of a body larger than the limit
+        """
+
+        self.start_milter(max_body_size=100)
+
+        self.send_envelope()
+
+        self.assertEqual(self.send_body("x" * 60), lm.SMFIR_CONTINUE)
+
+        self.assertEqual(self.send_body("x" * 60), lm.SMFIR_SKIP)
+
+        self.assertEqual(self.client.end_of_body(), (lm.SMFIR_CONTINUE, []))
+
+    def test_reload_workers(self):
+
+        """ A worker restarted after SIGHUP gets the reloaded rules of the
+            supervisor
+        """
+
+        milter.options = make_options(workers=1)
+
+        milter.configuration = milter.load_configuration()
+
+        self.assertEqual(len(milter.configuration["requirements"]), 1)
+
+        requirement = models.Requirement()
+
+        requirement.rule = models.Rule.objects.get()
+        requirement.action = constants.REQ_ACTION_DENY
+
+        requirement.save()
+
+        (read_fd, write_fd) = os.pipe()
+
+        def worker(index):
+
+            os.write(write_fd, str(len(milter.configuration["requirements"])))
+
+        supervisor = Supervisor(1, worker)
+
+        milter.reload_workers(supervisor)
+
+        # Restart the worker like after a crash
+
+        supervisor.spawn(0)
+
+        (pid, status) = os.wait()
+
+        os.close(write_fd)
+
+        self.assertEqual(os.read(read_fd, 10), "2")
+
+        os.close(read_fd)
+
+    def test_async(self):
+
+        """ The async mode rewrites the mail in the process pool and sends the
+            reply from the event loop
+        """
+
+        milter.options = make_options(mode="async", threads=1)
+
+        milter.configuration = milter.load_configuration()
+
+        milter.worker_pool = milter.start_worker_pool()
+
+        directory = tempfile.mkdtemp()
+
+        path = os.path.join(directory, "milter.sock")
+
+        factory = milter_factory.AsyncFactory(
+            path,
+            milter.AsyncDisclaimrMilter,
+            lm.SMFIF_CHGBODY | lm.SMFIF_ADDHDRS | lm.SMFIF_CHGHDRS
+        )
+
+        factory.listener = milter_factory.create_listener(path)
+
+        self.milter = threading.Thread(target=factory.run)
+        self.milter.daemon = True
+        self.milter.start()
+
+        try:
+
+            self.client = loadgen.MilterClient(loadgen.open_socket(path, 10))
+
+            self.send_envelope()
+
+            self.send_body(MIMEText("Testmail").get_payload())
+
+            (reply, modifications) = self.client.end_of_body()
+
+            self.assertEqual(reply, lm.SMFIR_CONTINUE)
+
+            self.assertIn(lm.SMFIR_REPLBODY, modifications)
+
+        finally:
+
+            factory.call_in_loop(factory.close)
+
+            milter.worker_pool.terminate()
+
+            milter.worker_pool = None
+
+            shutil.rmtree(directory)
+
+    def test_async_abort(self):
+
+        """ The result of an aborted mail is dropped
+        """
+
+        milter.options = make_options(mode="async")
+
+        milter.configuration = build_configuration()
+
+        (client_socket, milter_socket) = socket.socketpair()
+
+        protocol = milter.AsyncDisclaimrMilter(lm.SMFIF_CHGBODY)
+        protocol.transport = milter_socket
+
+        pending_eob = object()
+
+        protocol.pending_eob = pending_eob
+
+        protocol.abort()
+
+        protocol.finish_eob(
+            pending_eob, cPickle.dumps((protocol.helper, None, False, None))
+        )
+
+        client_socket.setblocking(0)
+
+        self.assertRaises(socket.error, client_socket.recv, 1)
+
+        client_socket.close()
+
+        milter_socket.close()
+
+    def test_thread_start_error(self):
+
+        """ The connection slot is released, if the thread can't be started
+        """
+
+        milter.options = make_options()
+
+        milter.configuration = build_configuration()
+
+        directory = tempfile.mkdtemp()
+
+        path = os.path.join(directory, "milter.sock")
+
+        factory = milter_factory.ThreadFactory(
+            path, FailingMilter, lm.SMFIF_CHGBODY
+        )
+
+        factory.listener = milter_factory.create_listener(path)
+
+        factory.slots = threading.BoundedSemaphore(1)
+
+        factory_thread = threading.Thread(target=factory.run)
+        factory_thread.daemon = True
+        factory_thread.start()
+
+        try:
+
+            # With a lost slot, the second connection wouldn't be accepted
+
+            for index in range(2):
+
+                client_socket = loadgen.open_socket(path, 10)
+
+                self.assertEqual(client_socket.recv(1), "")
+
+                client_socket.close()
+
+        finally:
+
+            factory.close()
+
+            factory_thread.join(5)
+
+            shutil.rmtree(directory)
+
+    def test_async_error(self):
+
+        """ The MTA gets a reply, even if the pool can't process the mail
+        """
+
+        milter.options = make_options(mode="async")
+
+        milter.configuration = build_configuration()
+
+        result = milter.process_eob("no helper", {}, "", False)
+
+        self.assertEqual(cPickle.loads(result), (None, None, True, None))
+
+        (client_socket, milter_socket) = socket.socketpair()
+
+        client_socket.settimeout(10)
+
+        protocol = milter.AsyncDisclaimrMilter(lm.SMFIF_CHGBODY)
+        protocol.transport = milter_socket
+
+        pending_eob = object()
+
+        protocol.pending_eob = pending_eob
+
+        protocol.finish_eob(pending_eob, result)
+
+        self.assertEqual(
+            loadgen.MilterClient(client_socket).receive()[0],
+            lm.SMFIR_CONTINUE
+        )
+
+        client_socket.close()
+
+        milter_socket.close()
+
+    def test_buffered_connection(self):
+
+        """ Sending to a slow MTA doesn't block. The rest is sent, when the
+            socket is writable.
+        """
+
+        (client_socket, milter_socket) = socket.socketpair()
+
+        factory = WatchingFactory()
+
+        connection = milter_factory.BufferedConnection(milter_socket, factory)
+
+        data = "x" * 1000000
+
+        connection.sendall(data)
+
+        connection.sendall("end")
+
+        self.assertTrue(factory.writable)
+
+        received = ""
+
+        while len(received) < len(data) + 3:
+
+            received += client_socket.recv(65536)
+
+            connection.flush()
+
+        self.assertEqual(received, data + "end")
+
+        self.assertFalse(factory.writable)
+
+        connection.close()
+
+        client_socket.close()
+
+    def test_limit_while_sending(self):
+
+        """ A mail is passed unmodified, if the processing time is up before
+            the new body is sent, and deferred, if the MTA already got a part
+            of it
+        """
+
+        milter.options = make_options()
+
+        milter.configuration = build_configuration()
+
+        protocol = TestMilter()
+
+        chunks = []
+
+        protocol.replBody = chunks.append
+
+        def new_body(sent):
+
+            for chunk in sent:
+
+                yield chunk
+
+            raise LimitExceeded("Processing took longer than 1 seconds")
+
+        self.assertEqual(
+            protocol.modify({"repl_body": new_body([])}), lm.CONTINUE
+        )
+
+        self.assertEqual(chunks, [])
+
+        self.assertFalse(protocol.helper.enabled)
+
+        self.assertEqual(
+            protocol.modify({"repl_body": new_body(["chunk"])}), lm.TEMPFAIL
+        )
+
+        self.assertEqual(chunks, ["chunk"])
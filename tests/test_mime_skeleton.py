@@ -0,0 +1,179 @@
+""" MIME skeleton testing """
+import email
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from django.test import TestCase
+from disclaimr import mime_skeleton
+
+
+class MimeSkeletonTestCase(TestCase):
+
+    """ Parse different mails and check the skeleton
+    """
+
+    def setUp(self):
+
+        """ A nested mail with an alternative part, an attached mail and a
+            binary attachment
+        """
+
+        alternative = MIMEMultipart("alternative")
+        alternative.attach(MIMEText("TestPlain", "plain", "UTF-8"))
+        alternative.attach(MIMEText("<p>TestHTML</p>", "html", "UTF-8"))
+
+        self.test_mail = MIMEMultipart("mixed")
+        self.test_mail.preamble = "Preamble"
+        self.test_mail.epilogue = "Epilogue"
+        self.test_mail.attach(alternative)
+        self.test_mail.attach(MIMEMessage(MIMEText("Forwarded")))
+        self.test_mail.attach(MIMEApplication("\x00\x01" * 100))
+
+        self.test_paths = [
+            ("multipart/mixed", "multipart/alternative", "text/plain"),
+            ("multipart/mixed", "multipart/alternative", "text/html"),
+            ("multipart/mixed", "message/rfc822", "text/plain"),
+            ("multipart/mixed", "application/octet-stream")
+        ]
+
+    def test_paths(self):
+
+        """ The skeleton should find all non-multipart parts
+        """
+
+        skeleton = mime_skeleton.parse_mail(self.test_mail.as_string())
+
+        self.assertEqual(
+            skeleton.get_paths(),
+            self.test_paths,
+            "Unexpected skeleton %s" % skeleton.get_paths()
+        )
+
+    def test_serialize_unmodified(self):
+
+        """ An unmodified skeleton should serialize to the original mail,
+            regardless of the line endings
+        """
+
+        for mail_text in (
+            self.test_mail.as_string(),
+            self.test_mail.as_string().replace("\n", "\r\n")
+        ):
+
+            skeleton = mime_skeleton.parse_mail(mail_text)
+
+            self.assertFalse(
+                skeleton.is_modified(),
+                "Skeleton was modified without replacing a part"
+            )
+
+            self.assertEqual(
+                "".join(skeleton.serialize()),
+                mail_text,
+                "Mail was unexpectedly serialized"
+            )
+
+    def test_serialize_modified(self):
+
+        """ Replace a part and check, that only this part was modified
+        """
+
+        mail_text = self.test_mail.as_string()
+
+        skeleton = mime_skeleton.parse_mail(mail_text)
+
+        part = skeleton.children[0].children[0]
+
+        message = part.get_message()
+        message.set_payload("Modified")
+
+        part.set_message(message)
+
+        self.assertTrue(
+            skeleton.is_modified(),
+            "Skeleton wasn't modified after replacing a part"
+        )
+
+        returned_mail = email.message_from_string(
+            "".join(skeleton.serialize())
+        )
+
+        self.assertEqual(
+            returned_mail.get_payload()[0].get_payload()[0].get_payload(),
+            "Modified",
+            "Part wasn't replaced"
+        )
+
+        self.assertEqual(
+            returned_mail.get_payload()[2].get_payload(),
+            self.test_mail.get_payload()[2].get_payload(),
+            "Attachment was unexpectedly modified"
+        )
+
+    def test_make_chunks(self):
+
+        """ The serialized mail should be regrouped into chunks of the
+            given size without losing anything
+        """
+
+        mail_text = self.test_mail.as_string()
+
+        skeleton = mime_skeleton.parse_mail(mail_text)
+
+        chunks = list(mime_skeleton.make_chunks(skeleton.serialize(), 100))
+
+        self.assertEqual(
+            "".join(chunks),
+            mail_text,
+            "Mail was unexpectedly chunked"
+        )
+
+        self.assertEqual(
+            [len(chunk) for chunk in chunks[:-1]],
+            [100] * (len(chunks) - 1),
+            "Chunks have unexpected sizes"
+        )
+
+    def test_make_chunks_large_piece(self):
+
+        """ A piece much larger than the chunk size should be split up
+            after smaller pieces without losing anything
+        """
+
+        pieces = ["abc", "x" * 1050 + "y", "", "z" * 7]
+
+        chunks = list(mime_skeleton.make_chunks(pieces, 100))
+
+        self.assertEqual("".join(chunks), "".join(pieces))
+
+        self.assertEqual(
+            [len(chunk) for chunk in chunks],
+            [100] * 10 + [61]
+        )
+
+    def test_limits(self):
+
+        """ Parsing should stop, if the mail exceeds the limits
+        """
+
+        mail_text = self.test_mail.as_string()
+
+        # The mail has 7 parts nested up to a depth of 2
+
+        mime_skeleton.parse_mail(mail_text, mime_skeleton.ParseLimits(7, 2))
+
+        self.assertRaises(
+            mime_skeleton.LimitExceeded,
+            mime_skeleton.parse_mail,
+            mail_text,
+            mime_skeleton.ParseLimits(6, 0)
+        )
+
+        self.assertRaises(
+            mime_skeleton.LimitExceeded,
+            mime_skeleton.parse_mail,
+            mail_text,
+            mime_skeleton.ParseLimits(0, 1)
+        )
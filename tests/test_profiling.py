@@ -0,0 +1,169 @@
+""" Profiling testing """
+import os
+import pstats
+import shutil
+import StringIO
+import tempfile
+
+from django.test import TestCase
+from disclaimr import profiling
+
+
+def work():
+
+    """ Something to profile """
+
+    return sum(range(100))
+
+
+class ProfilingTestCase(TestCase):
+
+    """ Profile the requested mails and dump the stacks
+    """
+
+    def setUp(self):
+
+        self.directory = profiling.directory
+
+        profiling.directory = tempfile.mkdtemp()
+
+        profiling.after_fork()
+
+    def tearDown(self):
+
+        shutil.rmtree(profiling.directory)
+
+        profiling.directory = self.directory
+
+        profiling.shared = None
+
+        profiling.after_fork()
+
+    def test_not_requested(self):
+
+        """ Mails aren't profiled without a request
+        """
+
+        self.assertIsNone(profiling.start())
+
+    def test_profile(self):
+
+        """ The stats of the requested mails are written, when the last one
+            is done
+        """
+
+        profiling.request(2)
+
+        first = profiling.start()
+        second = profiling.start()
+
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(profiling.start())
+
+        work()
+
+        profiling.finish(first)
+
+        self.assertEqual(os.listdir(profiling.directory), [])
+
+        profiling.finish(second)
+
+        files = os.listdir(profiling.directory)
+
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(".prof"))
+
+        stats = pstats.Stats(os.path.join(profiling.directory, files[0]))
+
+        self.assertIn(
+            "work", [function for (path, line, function) in stats.stats]
+        )
+
+    def test_cancel(self):
+
+        """ A connection without a mail leaves the request to the next one
+        """
+
+        profiling.request(1)
+
+        profile = profiling.start()
+
+        profiling.cancel(profile)
+
+        self.assertEqual(os.listdir(profiling.directory), [])
+
+        profile = profiling.start()
+
+        self.assertIsNotNone(profile)
+        self.assertIsNone(profiling.start())
+
+        profiling.finish(profile)
+
+        self.assertEqual(len(os.listdir(profiling.directory)), 1)
+
+    def test_shared(self):
+
+        """ Forked processes take the mails from the shared request and the
+            last one sums up their stats
+        """
+
+        profiling.share()
+
+        profiling.request(2)
+
+        pids = []
+
+        for index in range(2):
+
+            pid = os.fork()
+
+            if pid == 0:
+
+                profiling.after_fork()
+
+                profile = profiling.start()
+
+                work()
+
+                profiling.finish(profile)
+
+                os._exit(0)
+
+            pids.append(pid)
+
+        for pid in pids:
+
+            os.waitpid(pid, 0)
+
+        self.assertIsNone(profiling.start())
+
+        files = os.listdir(profiling.directory)
+
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(".prof"))
+
+        stats = pstats.Stats(os.path.join(profiling.directory, files[0]))
+
+        # Both mails called work once
+
+        self.assertEqual(
+            [
+                calls for ((path, line, function), (primitive, calls, _, _, _))
+                in stats.stats.items() if function == "work"
+            ],
+            [2]
+        )
+
+    def test_dump(self):
+
+        """ The stacks and the object counts are dumped
+        """
+
+        out = StringIO.StringIO()
+
+        profiling.dump(out)
+
+        self.assertIn("Thread MainThread", out.getvalue())
+        self.assertIn("test_dump", out.getvalue())
+        self.assertIn("Tracked objects", out.getvalue())
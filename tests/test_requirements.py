@@ -106,6 +106,30 @@ class RequirementsTestCase(TestCase):
             "Helper was enabled after connecting with the wrong IP"
         )
 
+    def test_network(self):
+
+        """ A requirement requiring a network should only match the
+            addresses of the network in the same IP version
+        """
+
+        requirement = self.tool_basic_requirement()
+
+        requirement.sender_ip = "2001:db8::"
+        requirement.sender_ip_cidr = "32"
+
+        requirement.save()
+
+        for ip, enabled in (("2001:db8::1", True),
+                            ("2001:db8:ffff:ffff::1", True),
+                            ("2001:db9::1", False),
+                            ("32.1.13.184", False)):
+
+            helper = self.tool_get_helper()
+
+            helper.connect("", "", ip, "", {})
+
+            self.assertEqual(helper.enabled, enabled, ip)
+
     def test_wrong_sender(self):
 
         """ A requirement requiring a specific sender should work when
@@ -407,3 +431,80 @@ class RequirementsTestCase(TestCase):
             helper.enabled,
             "Helper was unexpectedly enabled"
         )
+
+    def test_stages(self):
+
+        """ Only the stages needed by the requirements should be requested
+            from the MTA
+        """
+
+        # No requirements, no stages
+
+        stages = build_configuration()["stages"]
+
+        self.assertFalse(
+            any(stages.values()),
+            "Stages were requested without any requirement: %s" % stages
+        )
+
+        # A basic requirement doesn't need the end of the headers
+
+        requirement = self.tool_basic_requirement()
+        requirement.save()
+
+        stages = build_configuration()["stages"]
+
+        self.assertTrue(
+            stages["envelope"] and stages["headers"] and stages["body"],
+            "Stages needed for the actions weren't requested: %s" % stages
+        )
+
+        self.assertFalse(
+            stages["helo"] or stages["eoh"],
+            "Unneeded stages were requested: %s" % stages
+        )
+
+        # A header requirement needs the end of the headers
+
+        requirement.header = "Test: Test"
+        requirement.save()
+
+        self.assertTrue(
+            build_configuration()["stages"]["eoh"],
+            "The end of the headers wasn't requested for a header requirement"
+        )
+
+    def test_reset(self):
+
+        """ A mail not matching the sender requirement shouldn't disable the
+            helper for the next mail over the same connection
+        """
+
+        requirement = self.tool_basic_requirement()
+
+        requirement.sender = "test@company.com"
+
+        requirement.save()
+
+        self.assertTrue(
+            build_configuration()["stages"]["eoh"],
+            "The end of the headers wasn't requested for a sender requirement"
+        )
+
+        helper = self.tool_get_helper()
+
+        helper.connect("", "", "1.1.1.1", "", {})
+        helper.mail_from("wrong@company.com", {})
+        self.assertFalse(
+            helper.enabled,
+            "Helper was enabled after sending from the wrong address"
+        )
+
+        helper.reset()
+
+        helper.mail_from("test@company.com", {})
+
+        self.assertTrue(
+            helper.enabled,
+            "Helper wasn't enabled for the next mail from the right address"
+        )
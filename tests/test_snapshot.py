@@ -0,0 +1,298 @@
+""" Snapshot testing """
+import json
+import os
+import shutil
+import stat
+import StringIO
+import sys
+import tempfile
+from email.mime.text import MIMEText
+
+from django.core.management import call_command
+from django.test import TestCase
+from disclaimr import snapshot
+from disclaimr.configuration_helper import build_configuration, preload
+from disclaimr.milter_helper import MilterHelper
+from disclaimrwebadmin import models, constants
+
+
+class SnapshotTestCase(TestCase):
+
+    """ Export the rule set to a snapshot and run the milter from it
+    """
+
+    def setUp(self):
+
+        """ A rule with a disclaimer, a directory server, an enabled and a
+            disabled action and requirement
+        """
+
+        self.directory = tempfile.mkdtemp()
+
+        self.path = os.path.join(self.directory, "rules.json")
+
+        self.disclaimer = models.Disclaimer()
+
+        self.disclaimer.name = "Test"
+        self.disclaimer.text = "Test-Disclaimer"
+
+        self.disclaimer.save()
+
+        self.directory_server = models.DirectoryServer()
+
+        self.directory_server.name = "Test"
+        self.directory_server.base_dn = "dc=example,dc=com"
+        self.directory_server.search_query = "mail=%s"
+
+        self.directory_server.save()
+
+        for position, url in enumerate(
+                ("ldap://ldap2.example.com", "ldap://ldap1.example.com")):
+
+            directory_server_url = models.DirectoryServerURL()
+
+            directory_server_url.directory_server = self.directory_server
+            directory_server_url.url = url
+            directory_server_url.position = position
+
+            directory_server_url.save()
+
+        self.rule = models.Rule()
+        self.rule.save()
+
+        for position, enabled in ((1, True), (0, False)):
+
+            action = models.Action()
+
+            action.action = constants.ACTION_ACTION_ADD
+            action.disclaimer = self.disclaimer
+            action.rule = self.rule
+            action.position = position
+            action.enabled = enabled
+
+            action.save()
+
+            action.directory_servers.add(self.directory_server)
+
+        for enabled in (True, False):
+
+            requirement = models.Requirement()
+
+            requirement.rule = self.rule
+            requirement.action = constants.REQ_ACTION_ACCEPT
+            requirement.enabled = enabled
+
+            requirement.save()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+
+        """ Only the active requirements and actions are exported with the
+            objects they use
+        """
+
+        rule_snapshot = snapshot.export()
+
+        self.assertEqual(rule_snapshot["format"], snapshot.FORMAT)
+        self.assertEqual(rule_snapshot["version"], snapshot.VERSION)
+
+        self.assertEqual(len(rule_snapshot["rules"]), 1)
+        self.assertEqual(len(rule_snapshot["requirements"]), 1)
+        self.assertEqual(len(rule_snapshot["actions"]), 1)
+        self.assertEqual(len(rule_snapshot["disclaimers"]), 1)
+        self.assertEqual(len(rule_snapshot["directory_servers"]), 1)
+
+        self.assertEqual(
+            rule_snapshot["actions"][0]["directory_servers"],
+            [self.directory_server.id]
+        )
+
+        self.assertEqual(
+            rule_snapshot["directory_servers"][0]["urls"],
+            ["ldap://ldap2.example.com", "ldap://ldap1.example.com"]
+        )
+
+    def test_export_queries(self):
+
+        """ The number of queries doesn't grow with the rule set
+        """
+
+        with self.assertNumQueries(7):
+
+            snapshot.export()
+
+        for index in range(3):
+
+            rule = models.Rule()
+            rule.position = index + 1
+            rule.save()
+
+            action = models.Action()
+
+            action.action = constants.ACTION_ACTION_ADD
+            action.disclaimer = self.disclaimer
+            action.rule = rule
+            action.position = 0
+
+            action.save()
+
+            action.directory_servers.add(self.directory_server)
+
+            requirement = models.Requirement()
+
+            requirement.rule = rule
+            requirement.action = constants.REQ_ACTION_ACCEPT
+
+            requirement.save()
+
+        with self.assertNumQueries(7):
+
+            rule_snapshot = snapshot.export()
+
+        self.assertEqual(len(rule_snapshot["actions"]), 4)
+
+        for action in rule_snapshot["actions"]:
+
+            self.assertEqual(
+                action["directory_servers"], [self.directory_server.id]
+            )
+
+    def test_write(self):
+
+        """ The snapshot is only readable by its owner and can be read back
+        """
+
+        rule_snapshot = snapshot.export()
+
+        snapshot.write(rule_snapshot, self.path)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+        self.assertEqual(snapshot.read(self.path), rule_snapshot)
+
+        self.assertEqual(os.listdir(self.directory), ["rules.json"])
+
+    def test_read_invalid(self):
+
+        """ Missing files, other files and other versions are refused
+        """
+
+        self.assertRaises(snapshot.SnapshotError, snapshot.read, self.path)
+
+        for content in ("no json", [], {"format": "other"},
+                        {"format": snapshot.FORMAT,
+                         "version": snapshot.VERSION + 1}):
+
+            with open(self.path, "w") as snapshot_file:
+
+                if isinstance(content, str):
+
+                    snapshot_file.write(content)
+
+                else:
+
+                    json.dump(content, snapshot_file)
+
+            self.assertRaises(snapshot.SnapshotError, snapshot.read, self.path)
+
+    def test_build_records(self):
+
+        """ The records are linked like the model objects
+        """
+
+        records = snapshot.build_records(snapshot.export())
+
+        rule = records["rules"][self.rule.id]
+
+        self.assertEqual(len(records["requirements"]), 1)
+
+        self.assertIs(records["requirements"].values()[0].rule, rule)
+
+        self.assertEqual(len(rule.actions), 1)
+
+        action = rule.actions[0]
+
+        self.assertEqual(action.disclaimer.text, "Test-Disclaimer")
+
+        self.assertEqual(
+            [url.url for url in action.directory_servers[0].urls],
+            ["ldap://ldap2.example.com", "ldap://ldap1.example.com"]
+        )
+
+    def test_invalid_pattern(self):
+
+        """ Requirements with an invalid regular expression are left out
+        """
+
+        rule_snapshot = snapshot.export()
+
+        rule_snapshot["requirements"][0]["sender"] = "(unbalanced"
+
+        records = snapshot.build_records(rule_snapshot)
+
+        self.assertEqual(records["requirements"], {})
+
+        self.assertEqual(len(records["rules"]), 1)
+
+    def test_preload(self):
+
+        """ The modules needed by the actions are imported before forking
+        """
+
+        configuration = build_configuration()
+
+        sys.modules.pop("lxml.etree", None)
+
+        preload(configuration)
+
+        self.assertIn("lxml.etree", sys.modules)
+
+    def test_command(self):
+
+        """ The management command writes the snapshot
+        """
+
+        out = StringIO.StringIO()
+
+        call_command("export_snapshot", "--output", self.path, stdout=out)
+
+        self.assertIn("1 rules", out.getvalue())
+
+        self.assertEqual(
+            len(snapshot.read(self.path)["requirements"]), 1
+        )
+
+    def test_milter(self):
+
+        """ The milter processes mails from a snapshot without the database
+        """
+
+        snapshot.write(snapshot.export(), self.path)
+
+        models.Rule.objects.all().delete()
+
+        models.Disclaimer.objects.all().delete()
+
+        helper = MilterHelper(
+            build_configuration(rule_snapshot=snapshot.read(self.path))
+        )
+
+        helper.connect("", "", "1.1.1.1", "", {})
+
+        self.assertTrue(helper.enabled)
+
+        helper.mail_from("test@company.com", {})
+        helper.rcpt("test@company.com", {})
+        helper.header("From", "nobody", {})
+        helper.eoh({})
+
+        helper.body(MIMEText("Testmail").as_string(), {})
+
+        with self.assertNumQueries(0):
+
+            returned = helper.eob({})
+
+        self.assertIn("Test-Disclaimer", "".join(returned["repl_body"]))